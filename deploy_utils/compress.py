@@ -0,0 +1,208 @@
+'''
+Precompressed gzip/brotli variants of text static assets.
+
+Each compressible file saved during a deploy also gets a ``.gz`` (and, if
+the ``brotli`` package is installed, ``.br``) copy saved next to it. The
+copies get the original Content-Type and the matching Content-Encoding, so
+they can be served as-is by CloudFront or nginx's ``gzip_static``.
+Compression runs on a process pool so it doesn't compete with the upload
+threads for the GIL. Files on disk are read by the process that compresses
+them, rather than being read and sent to it.
+
+Storages that gzip text themselves (``AWS_IS_GZIPPED``) save the variants
+as they are, rather than compressing them a second time; see
+``deploy_utils.storage.PrecompressMixin``.
+'''
+
+from __future__ import unicode_literals
+
+import gzip
+import io
+import mimetypes
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.map')
+
+ENCODING_EXTENSIONS = {
+    'gzip': '.gz',
+    'br': '.br',
+}
+
+# Content that isn't a file on disk has to be sent to the process pool, so
+# bigger content isn't precompressed. CloudFront doesn't compress objects
+# over 10MB either.
+MAX_IN_MEMORY_SIZE = 10 * 1024 * 1024
+
+
+def get_encodings(encodings=None):
+    """
+    Return the configured encodings that can actually be produced here.
+    """
+    if encodings is None:
+        encodings = ('gzip', 'br')
+    return [encoding for encoding in encodings
+            if encoding == 'gzip' or (encoding == 'br' and brotli is not None)]
+
+
+def is_compressible(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def compress_content(data, encodings):
+    """
+    Compress ``data`` with each of ``encodings``, returning a list of
+    ``(encoding, compressed_data)`` pairs for the ones that came out
+    smaller than the original.
+    """
+    variants = []
+    for encoding in encodings:
+        if encoding == 'gzip':
+            buf = io.BytesIO()
+            # A fixed mtime keeps the output (and so its ETag) stable
+            # across deploys of the same content.
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                               mtime=0) as gz:
+                gz.write(data)
+            compressed = buf.getvalue()
+        elif encoding == 'br':
+            compressed = brotli.compress(data)
+        else:
+            continue
+        if len(compressed) < len(data):
+            variants.append((encoding, compressed))
+    return variants
+
+
+def compress_file(path, encodings):
+    """
+    Like ``compress_content``, for the content of the file at ``path``.
+    """
+    with open(path, 'rb') as fp:
+        return compress_content(fp.read(), encodings)
+
+
+def get_process_pool(workers):
+    """
+    Return a pool of ``workers`` processes that any thread can submit to.
+
+    A process forked while other threads hold locks can deadlock, so the
+    workers are spawned instead where the pool allows it (Python 3.7 and
+    later). Older pools fork every worker on the first ``submit``, so that
+    happens here, before the deploy starts any threads.
+    """
+    try:
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        executor.submit(get_encodings).result()
+        return executor
+
+
+class Precompressor(object):
+    """
+    Compress assets on a process pool and save the smaller variants to
+    ``storage``. Create it before starting any threads that use it (see
+    ``get_process_pool``).
+
+    ``submit`` may be called from several upload threads at once. At most
+    ``workers * 4`` files are waiting to be compressed at any time; beyond
+    that the caller saves the oldest result itself before carrying on.
+    Content that has to be sent to the pool (see ``fits``) is limited to
+    ``max_size`` bytes. Files that fail to compress or save are collected in
+    ``failed`` as ``(name, error)`` pairs rather than raised.
+    """
+    def __init__(self, storage, workers=None, encodings=None,
+                 max_size=MAX_IN_MEMORY_SIZE):
+        self.storage = storage
+        self.encodings = get_encodings(encodings)
+        self.max_size = max_size
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = get_process_pool(self.workers)
+        self.pending = deque()
+        self.saved_names = []
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def wants(self, name):
+        """
+        Return whether the file ``name`` gets precompressed variants.
+        """
+        return bool(self.encodings) and is_compressible(name)
+
+    def fits(self, size):
+        """
+        Return whether content of ``size`` bytes that isn't a file on disk
+        may be read into memory and submitted.
+        """
+        return self.max_size is None or size <= self.max_size
+
+    def submit(self, name, data=None, path=None):
+        """
+        Compress the content of the file saved as ``name``: either ``data``,
+        or the file on disk at ``path``, which is read by the worker.
+        """
+        if not self.wants(name):
+            return
+        if path is not None:
+            future = self.executor.submit(compress_file, path,
+                                          self.encodings)
+        else:
+            future = self.executor.submit(compress_content, data,
+                                          self.encodings)
+        with self._lock:
+            self.pending.append((name, future))
+            oldest = None
+            if len(self.pending) > self.workers * 4:
+                oldest = self.pending.popleft()
+        if oldest is not None:
+            self._save_variants(*oldest)
+
+    def finish(self):
+        """
+        Wait for every outstanding file, save its variants and shut the pool
+        down. Returns the names of all the variants that were saved.
+        """
+        while True:
+            with self._lock:
+                if not self.pending:
+                    break
+                name, future = self.pending.popleft()
+            self._save_variants(name, future)
+        self.executor.shutdown()
+        return self.saved_names
+
+    def _save_variants(self, name, future):
+        try:
+            self._save_variants_for(name, future.result())
+        except Exception as e:
+            with self._lock:
+                self.failed.append((name, e))
+
+    def _save_variants_for(self, name, variants):
+        content_type = mimetypes.guess_type(name)[0]
+        for encoding, data in variants:
+            variant_name = name + ENCODING_EXTENSIONS[encoding]
+            variant = ContentFile(data)
+            # Saved with this Content-Encoding by PrecompressMixin
+            variant.content_encoding = encoding
+            if content_type:
+                variant.content_type = content_type
+            if self.storage.exists(variant_name):
+                self.storage.delete(variant_name)
+            self.storage.save(variant_name, variant)
+            with self._lock:
+                self.saved_names.append(variant_name)
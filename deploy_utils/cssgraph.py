@@ -0,0 +1,148 @@
+'''
+Reverse-dependency graph of the ``url()`` and ``@import`` references in
+static stylesheets.
+
+CachedFilesMixin rewrites those references to hashed names when it
+post-processes a stylesheet, so when an image, font or imported stylesheet
+changes, every stylesheet that references it (directly or through another
+stylesheet) has to be post-processed again, after it.
+'''
+
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import posixpath
+import re
+
+from django.conf import settings
+
+
+# The same references CachedFilesMixin rewrites
+CSS_REFERENCE_PATTERNS = (
+    re.compile(r"""url\(['"]{0,1}\s*(.*?)["']{0,1}\)"""),
+    re.compile(r"""@import\s*["']\s*(.*?)["']"""),
+)
+
+
+def get_css_references(rel_path, content):
+    """
+    Return the sorted relative static paths referenced from the stylesheet
+    ``rel_path`` with the given ``content``.
+    """
+    static_url = getattr(settings, 'STATIC_URL', None) or ''
+    references = set()
+    for pattern in CSS_REFERENCE_PATTERNS:
+        for url in pattern.findall(content):
+            url = url.strip()
+            # Ignore data URIs, fragments and other sites, as
+            # CachedFilesMixin does
+            if (not url or url.startswith(('#', '//')) or
+                    re.match(r'^[a-z]+:', url)):
+                continue
+            url = url.split('#', 1)[0].split('?', 1)[0]
+            if static_url and url.startswith(static_url):
+                reference = url[len(static_url):]
+            elif url.startswith('/'):
+                continue
+            else:
+                reference = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(rel_path), url))
+            if reference and not reference.startswith('..'):
+                references.add(reference)
+    return sorted(references)
+
+
+class CssReferenceGraph(object):
+    """
+    Mapping of stylesheet -> the static paths it references, stored as
+    JSON at ``path`` between deploys.
+    """
+    version = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.references = {}
+
+    def load(self):
+        """
+        Load the graph from ``path``. Returns ``False`` if there is no usable
+        saved copy.
+        """
+        if not self.path or not os.path.isfile(self.path):
+            return False
+        with open(self.path, 'rb') as fp:
+            data = json.loads(fp.read().decode('utf-8'))
+        if data.get('version') != self.version:
+            return False
+        self.references = data['references']
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        data = json.dumps({'version': self.version,
+                           'references': self.references},
+                          indent=0, sort_keys=True)
+        with open(self.path, 'wb') as fp:
+            fp.write(data.encode('utf-8'))
+
+    def update(self, rel_path, abs_path):
+        """
+        (Re-)read the references of the stylesheet at ``abs_path``.
+        """
+        if not rel_path.endswith('.css'):
+            return
+        with io.open(abs_path, encoding='utf-8', errors='replace') as fp:
+            self.references[rel_path] = get_css_references(rel_path,
+                                                           fp.read())
+
+    def build(self, static_files):
+        """
+        Build the graph from scratch out of every ``(abs_path, rel_path)``
+        pair in ``static_files``.
+        """
+        self.references = {}
+        for abs_path, rel_path in static_files:
+            self.update(rel_path, abs_path)
+
+    def levels(self, changed):
+        """
+        Return ``changed`` plus every stylesheet that depends on any of
+        them, grouped into a list of levels: each level only references
+        files in earlier levels, so processing the levels in order means a
+        stylesheet is only rewritten once everything it references has its
+        new hashed name. Stylesheets caught in an ``@import`` cycle end up
+        together in the last level.
+        """
+        dependents = {}
+        for css, references in self.references.items():
+            for reference in references:
+                dependents.setdefault(reference, set()).add(css)
+
+        # Everything that needs processing: the changed files and, in turn,
+        # everything that references them
+        nodes = set()
+        queue = list(changed)
+        while queue:
+            node = queue.pop()
+            if node not in nodes:
+                nodes.add(node)
+                queue.extend(dependents.get(node, ()))
+
+        waiting_on = dict(
+            (node, (set(self.references.get(node, ())) & nodes) - set([node]))
+            for node in nodes)
+        levels = []
+        while waiting_on:
+            level = sorted(node for node, references in waiting_on.items()
+                           if not references)
+            if not level:
+                level = sorted(waiting_on)
+            levels.append(level)
+            for node in level:
+                del waiting_on[node]
+            for references in waiting_on.values():
+                references.difference_update(level)
+        return levels
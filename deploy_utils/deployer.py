@@ -0,0 +1,436 @@
+'''
+Streams a deploy's static files through a pipeline of overlapping stages:
+
+    discover -> classify -> read -> upload -> pack -> hash
+
+The caller discovers and classifies the files that may need
+post-processing up front (so every package they belong to is known before
+the first upload), while copy-only files can still be discovered lazily.
+Files are read (hashed and checked against the manifest) and uploaded on a
+pool of worker threads, and each pipeline package is packed (and saved) on
+a separate pool of threads as soon as every changed file it includes has
+been uploaded, while the remaining uploads carry on. The final hashing
+pass (CachedFilesMixin) runs once everything has been uploaded and packed.
+Every hand-off between stages is bounded, so memory use depends on the
+queue depth rather than the size of the deploy.
+'''
+
+from __future__ import unicode_literals
+
+import itertools
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.contrib.staticfiles import finders
+from django.utils.six.moves import queue
+
+from .file_utils import copy_static_file, get_static_storage, \
+    post_process_static_files, run_in_parallel
+from .journal import COPIED, PROCESSED
+from .manifest import get_file_hash
+from .profiling import DeployProfiler
+
+
+# A file to deploy; ``post_process`` is False for files (such as NPM-built
+# assets) that are only copied.
+StaticFile = namedtuple('StaticFile',
+                        ('abs_path', 'relative_path', 'post_process'))
+
+
+class StaticDeployer(object):
+    """
+    Deploy a stream of ``StaticFile``s, reporting progress to ``stdout``.
+
+    ``workers`` files are read and uploaded at once, and at most
+    ``queue_size`` (by default ``workers * 2``) files or packages are
+    waiting between any two stages.
+
+    Given a ``DeployJournal``, each completed step is recorded in it, and
+    steps it shows were already done (by a deploy that was interrupted) are
+    skipped. The time each file spends being read and uploaded is recorded
+    in ``profiler``.
+
+    Given a ``shard`` (see ``deploy_utils.sharding``), only the files (and
+    stylesheets referencing them) and packages belonging to it are
+    deployed; the rest of ``static_files`` are left to the other shards,
+    but still count as changed for the packages and stylesheets that
+    include them.
+    """
+    def __init__(self, stdout, workers=1, manifest=None, css_graph=None,
+                 force=False, queue_size=None, journal=None, profiler=None,
+                 shard=None):
+        self.stdout = stdout
+        self.workers = max(1, workers)
+        self.manifest = manifest
+        self.css_graph = css_graph
+        self.force = force
+        self.journal = journal
+        self.profiler = profiler or DeployProfiler()
+        self.shard = shard
+        self.queue_size = queue_size or self.workers * 2
+        self.failed_files = []
+        # Every file discovered, and the ones left to other shards that
+        # need post-processing; relative path -> absolute path
+        self.local_files = {}
+        self.elsewhere = OrderedDict()
+        self._write_lock = threading.Lock()
+
+    def write(self, message):
+        with self._write_lock:
+            self.stdout.write(message)
+
+    def deploy(self, static_files, copy_only_files=()):
+        """
+        Deploy every ``StaticFile`` in the list ``static_files``, followed by
+        those in the iterable ``copy_only_files``, which mustn't need
+        post-processing (and so can't be in any package). Returns a list of
+        ``(relative_path, error)`` pairs for the files that failed.
+        """
+        static_storage = get_static_storage()
+        if hasattr(static_storage, 'local_files'):
+            static_storage.local_files = self.local_files
+        # Packages can be packed before their files are uploaded (or when
+        # other shards upload them), so they're read from their local copies
+        self.local_files.update(
+            (static_file.relative_path, static_file.abs_path)
+            for static_file in static_files)
+        packer = PackageQueue(self, static_storage, self.queue_size)
+        packer.start()
+        copied = OrderedDict()
+        try:
+            packer.track(static_files)
+            with self.profiler.phase('upload'):
+                self._deploy_files(
+                    itertools.chain(static_files, copy_only_files), packer,
+                    copied)
+        finally:
+            packed = packer.finish()
+        with self.profiler.phase('post_process'):
+            self.post_process_files(copied, packed, packer.changed_elsewhere)
+        return self.failed_files
+
+    def owns(self, relative_path):
+        return self.shard is None or self.shard.owns(relative_path)
+
+    def select(self, static_files):
+        """
+        Pass on the files in ``static_files`` that belong to this shard,
+        noting where every file is.
+        """
+        for static_file in static_files:
+            abs_path, relative_path, post_process = static_file
+            self.local_files[relative_path] = abs_path
+            if self.owns(relative_path):
+                yield static_file
+            elif post_process:
+                self.elsewhere[relative_path] = abs_path
+
+    def _deploy_files(self, static_files, packer, copied):
+        for static_file, copied_file, error in run_in_parallel(
+                self.copy_file, self.select(static_files), self.workers):
+            relative_path = static_file.relative_path
+            if error is not None:
+                self.failed_files.append((relative_path, error))
+            elif copied_file is None:
+                self.write('\tunchanged %s ' % relative_path)
+            else:
+                _abs, _rel, file_hash, size, mtime = copied_file
+                if not self.force and self.journal is not None and \
+                        self.journal.get(COPIED, relative_path, file_hash):
+                    self.write('\talready copied %s ' % relative_path)
+                else:
+                    self.write('\tcopied %s ' % relative_path)
+                    if self.journal is not None:
+                        self.journal.record(
+                            COPIED, relative_path, file_hash, size=size,
+                            mtime=mtime,
+                            post_process=static_file.post_process)
+                if static_file.post_process:
+                    copied[relative_path] = copied_file
+                elif self.manifest is not None:
+                    self.manifest.record(relative_path, file_hash, size,
+                                         mtime=mtime)
+            packer.done(static_file, copied_file is not None and
+                        error is None)
+
+    def copy_file(self, static_file):
+        """
+        Copy a single ``StaticFile`` with storage, returning ``(abs_path,
+        relative_path, file_hash, size, mtime)``, or ``None`` if it doesn't
+        need deploying (see ``check_file``). Files the journal shows were
+        copied but not post-processed aren't copied again.
+        """
+        abs_path, relative_path, post_process = static_file
+        with self.profiler.timer('read', relative_path):
+            checked = self.check_file(abs_path, relative_path, post_process)
+        if checked is None:
+            return None
+        file_hash, size, mtime, copied = checked
+        if not copied:
+            with self.profiler.timer('upload', relative_path, size):
+                copy_static_file(abs_path, relative_path)
+        return abs_path, relative_path, file_hash, size, mtime
+
+    def check_file(self, abs_path, relative_path, post_process=True):
+        """
+        Return ``None`` if the manifest or the storage's inventory shows the
+        file is unchanged or the journal shows it was already deployed
+        (unless ``force`` is set). Otherwise return its ``(file_hash, size,
+        mtime, copied)``, where ``copied`` is whether the journal shows it
+        was already copied. In the inventory, files that are
+        ``post_process``ed only count as unchanged if their hashed copy is
+        there too; copy-only files just need a matching ETag.
+
+        Unchanged files are skipped without touching storage. Files whose
+        size and modification time match the manifest (or the journal)
+        aren't even read; the rest are hashed to tell a real change from a
+        touched file.
+        """
+        static_storage = get_static_storage()
+        manifest = self.manifest
+        # Forced deploys upload everything, even files an interrupted deploy
+        # already did, but still record their progress in the journal
+        journal = self.journal if not self.force else None
+        inventory = getattr(static_storage, 'inventory', None)
+        stat = os.stat(abs_path)
+        size, mtime = stat.st_size, stat.st_mtime
+        if manifest is None and inventory is None and self.journal is None:
+            return None, size, mtime, False
+
+        if (not self.force and manifest is not None and
+                manifest.is_unchanged_stat(relative_path, size, mtime)):
+            return None
+        if journal is not None:
+            if journal.is_done(relative_path, size=size, mtime=mtime):
+                return None
+            entry = journal.get(COPIED, relative_path, size=size, mtime=mtime)
+            if entry is not None:
+                return entry['hash'], size, mtime, True
+        file_hash = get_file_hash(abs_path)
+        if journal is not None:
+            if journal.is_done(relative_path, file_hash):
+                return None
+            if journal.get(COPIED, relative_path, file_hash):
+                return file_hash, size, mtime, True
+        if not self.force and manifest is not None and \
+                manifest.is_unchanged(relative_path, file_hash, size):
+            # Only touched; remember the new mtime so it isn't hashed again
+            manifest.record(relative_path, mtime=mtime)
+            return None
+        if not self.force and inventory is not None and \
+                static_storage.is_unchanged(relative_path, file_hash,
+                                            post_process):
+            return None
+        return file_hash, size, mtime, False
+
+    def post_process_files(self, copied, packed=(), packages=()):
+        """
+        Post-process the ``copied`` files (a dict of relative path ->
+        ``copy_file`` result). Given a ``css_graph``, every stylesheet that
+        references them (or the files left to other shards) is
+        post-processed too, in dependency order (one pass per level of the
+        graph). Packages in ``packed`` have already been packed and are only
+        hashed. The hashed names of those stylesheets take the referenced
+        files' new hashes into account (see ``ReferenceHashMixin``), so they
+        get new names rather than being rewritten in place.
+
+        The packages with output filenames in ``packages`` are packed and
+        hashed along with the last level, although none of the copied files
+        are in them: they belong to this shard, but only files deployed by
+        other shards changed.
+
+        Post-processing is only recorded in the journal once every level
+        has succeeded, since a stylesheet in a later level depends on the
+        files before it.
+        """
+        if not copied and not packages:
+            return
+        if self.css_graph is None:
+            levels = [list(copied)]
+        else:
+            levels = self.css_graph.levels(
+                list(copied) + list(self.elsewhere))
+        # Other shards deal with their own files, and the stylesheets that
+        # belong to them
+        levels = [level for level in (
+            [relative_path for relative_path in level
+             if relative_path in copied or (
+                 relative_path not in self.elsewhere and
+                 self.owns(relative_path))]
+            for level in levels) if level]
+        if packages:
+            levels = levels or [[]]
+            levels[-1] = levels[-1] + sorted(packages)
+
+        manifest = self.manifest
+        level_error = None
+        processed = {}
+        for level in levels:
+            if level_error is not None:
+                # Later levels depend on the one that failed
+                self.failed_files.extend((relative_path, level_error)
+                                         for relative_path in level)
+                continue
+
+            paths = []
+            level_packages = []
+            for relative_path in level:
+                if relative_path in packages:
+                    level_packages.append(relative_path)
+                elif relative_path in copied:
+                    paths.append((copied[relative_path][0], relative_path))
+                else:
+                    # A stylesheet that references a changed file; it
+                    # needs rewriting but not copying again
+                    abs_path = finders.find(relative_path)
+                    if abs_path:
+                        paths.append((abs_path, relative_path))
+            try:
+                hashed_names = post_process_static_files(
+                    paths, packed=packed, packages=level_packages)
+            except Exception as e:
+                level_error = e
+                self.failed_files.extend((relative_path, e)
+                                         for relative_path in level)
+                continue
+
+            processed.update(hashed_names)
+            for abs_path, relative_path in paths:
+                processed.setdefault(relative_path, None)
+                if relative_path not in copied:
+                    self.write('\treprocessed %s ' % relative_path)
+                    continue
+                self.write('\tprocessed %s ' % relative_path)
+                if manifest is not None:
+                    _abs, _rel, file_hash, size, mtime = copied[relative_path]
+                    manifest.record(relative_path, file_hash, size,
+                                    hashed_names.pop(relative_path, None),
+                                    mtime)
+            if manifest is not None:
+                # Whatever is left are pipeline package outputs and
+                # rewritten stylesheets
+                for name, hashed_name in hashed_names.items():
+                    manifest.record(name, hashed_name=hashed_name)
+
+        if self.journal is not None and level_error is None:
+            for relative_path, hashed_name in processed.items():
+                # Package outputs and rewritten stylesheets get no hash, so
+                # they never count as deployed files in their own right
+                file_hash = size = mtime = None
+                if relative_path in copied:
+                    _abs, _rel, file_hash, size, mtime = copied[relative_path]
+                self.journal.record(PROCESSED, relative_path, file_hash,
+                                    size=size, mtime=mtime,
+                                    hashed_name=hashed_name)
+
+
+class PackageQueue(object):
+    """
+    Packs pipeline packages on a pool of background threads (as many as
+    the storage's ``get_pack_workers()``), each one as soon as every
+    changed file it includes has been uploaded.
+
+    ``track`` is given every file that may need post-processing before any
+    of them are uploaded, so a package is never packed before all of its
+    changed files are known. ``track`` and ``done`` are called from the
+    thread that consumes upload results; only the bounded queue of packages
+    ready to pack is shared with the packing threads.
+    """
+    def __init__(self, deployer, storage, queue_size):
+        self.deployer = deployer
+        self.storage = storage
+        self.enabled = hasattr(storage, 'packages_for') and \
+            getattr(storage, 'packing', False)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.packages = {}
+        self.pending = {}
+        self.changed = set()
+        # Packages changed only by files other shards deploy
+        self.changed_elsewhere = set()
+        self.queued = set()
+        self.packed = set()
+        self.threads = []
+        if self.enabled:
+            for _i in range(storage.get_pack_workers()):
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                self.threads.append(thread)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def track(self, static_files):
+        """
+        Note which packages each of ``static_files`` belongs to, and queue
+        the ones that are only changed by files other shards deploy.
+        """
+        for static_file in static_files:
+            if self.enabled and static_file.post_process:
+                relative_path = static_file.relative_path
+                packages = self.storage.packages_for([relative_path])
+                elsewhere = not self.deployer.owns(relative_path)
+                for output_file, package in packages.items():
+                    self.packages[output_file] = package
+                    pending = self.pending.setdefault(output_file, set())
+                    if elsewhere:
+                        # Another shard deploys the file, but it's still a
+                        # change to this shard's package, which is packed
+                        # from the local copy (see LocalSourceCompressor)
+                        if output_file not in self.changed:
+                            self.changed_elsewhere.add(output_file)
+                        self.changed.add(output_file)
+                    else:
+                        pending.add(relative_path)
+        for output_file in list(self.pending):
+            self._queue_if_ready(output_file)
+
+    def done(self, static_file, copied):
+        """
+        Note that ``static_file`` has been dealt with, and queue any of its
+        packages that are now ready to pack.
+        """
+        if not self.enabled or not static_file.post_process:
+            return
+        for output_file, files in self.pending.items():
+            if static_file.relative_path in files:
+                files.discard(static_file.relative_path)
+                if copied:
+                    self.changed.add(output_file)
+                    self.changed_elsewhere.discard(output_file)
+                self._queue_if_ready(output_file)
+
+    def _queue_if_ready(self, output_file):
+        if (not self.pending[output_file] and
+                output_file in self.changed and
+                output_file not in self.queued):
+            self.queued.add(output_file)
+            self.queue.put((output_file,) + self.packages[output_file])
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            output_file, kind, package = item
+            try:
+                self.storage.pack_package(kind, package)
+            except Exception as e:
+                # Left unpacked; post-processing will try again
+                self.deployer.write('\tfailed to pack %s, will retry: %s' % (
+                    output_file, e))
+            else:
+                self.packed.add(output_file)
+                self.deployer.write('\tpacked %s ' % output_file)
+
+    def finish(self):
+        """
+        Wait for every queued package to be packed, returning the output
+        filenames of the packages that were.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.packed
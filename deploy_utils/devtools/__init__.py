@@ -0,0 +1,6 @@
+'''
+Tools for trying out and benchmarking deploys locally: an in-memory S3
+(``runfakes3``) and the deploy benchmarks (``benchmarkdeploy``). Add
+``deploy_utils.devtools`` to INSTALLED_APPS to use their commands; nothing
+in deploy_utils itself depends on them.
+'''
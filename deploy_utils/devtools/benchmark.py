@@ -0,0 +1,414 @@
+'''
+Benchmarks the deploy against an in-memory S3 (deploy_utils.devtools.fakes3)
+using generated static trees, so that performance regressions show up
+before a real deploy does.
+
+Each scenario generates a tree of static files and times:
+
+* ``get_files``: walking the tree
+* ``get_static_file_path``: classifying each file as a static file
+* ``deploystatic``: deploying every file
+* ``post_process``: DummyPipelineMixin.post_process over every file,
+  including packing the tree's pipeline packages
+
+The ``import`` scenario instead times importing deploy_utils' storages and
+deploystatic in a fresh interpreter (using DJANGO_SETTINGS_MODULE), noting
+which of boto, django-storages and django-pipeline each one imports.
+
+python manage.py benchmarkdeploy --output=benchmark.json
+python manage.py benchmarkdeploy --baseline=benchmark.json --scenario=small
+'''
+
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+from .fakes3 import FakeS3Server, FaultInjector
+from ..file_utils import get_static_storage, post_process_static_files, \
+    reset_static_storage
+from ..profiling import DeployProfiler
+from ..storage import StaticPathIndex, get_files
+
+
+MB = 1024 * 1024
+BENCHMARK_BUCKET = 'benchmark'
+IGNORE_PATTERNS = ['CVS', '.*', '*~']
+
+
+class StaticTreeGenerator(object):
+    """
+    Writes a synthetic static tree under ``root``. ``scale`` multiplies the
+    number of files in each scenario.
+    """
+    def __init__(self, root, scale=1.0, seed=0):
+        self.root = root
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.files = []
+        self.packages = {'css': OrderedDict(), 'js': OrderedDict()}
+
+    def count(self, number):
+        return max(1, int(number * self.scale))
+
+    def write(self, rel_path, content):
+        path = os.path.join(self.root, rel_path)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        self.files.append(rel_path)
+
+    def text(self, extension, size):
+        if extension == 'css':
+            line = '.rule-%d { color: #%06x; margin: %dpx; }\n'
+        else:
+            line = 'function f%d() { return [0x%06x, %d]; }\n'
+        lines = []
+        length = 0
+        while length < size:
+            lines.append(line % (len(lines), self.random.getrandbits(24),
+                                 self.random.randint(0, 100)))
+            length += len(lines[-1])
+        return ''.join(lines).encode('utf-8')
+
+    def binary(self, size):
+        return os.urandom(size)
+
+    def small(self):
+        """
+        Many small files in a shallow tree.
+        """
+        for i in range(self.count(2000)):
+            extension = ('css', 'js', 'png')[i % 3]
+            rel_path = 'small/dir%02d/file%05d.%s' % (i % 20, i, extension)
+            size = self.random.randint(512, 4096)
+            if extension == 'png':
+                self.write(rel_path, self.binary(size))
+            else:
+                self.write(rel_path, self.text(extension, size))
+
+    def huge(self):
+        """
+        A few files big enough to be sent as multipart uploads.
+        """
+        for i in range(self.count(3)):
+            self.write('huge/video%02d.mp4' % i, self.binary(24 * MB))
+
+    def deep(self):
+        """
+        Files spread through deeply nested directories.
+        """
+        for i in range(self.count(300)):
+            depth = 4 + i % 9
+            directories = '/'.join('level%d-%d' % (level, (i >> level) % 3)
+                                   for level in range(depth))
+            self.write('deep/%s/file%04d.js' % (directories, i),
+                       self.text('js', 1024))
+
+    def bundles(self):
+        """
+        Large pipeline packages, each made up of many source files.
+        """
+        for i in range(self.count(10)):
+            for kind in ('css', 'js'):
+                sources = []
+                for j in range(40):
+                    rel_path = 'bundles/%s/package%02d/source%02d.%s' % (
+                        kind, i, j, kind)
+                    self.write(rel_path, self.text(kind, 8 * 1024))
+                    sources.append(rel_path)
+                self.packages[kind]['package%02d' % i] = {
+                    'source_filenames': sources,
+                    'output_filename': 'bundles/%s/package%02d.%s' % (
+                        kind, i, kind),
+                }
+
+    def generate(self, scenario):
+        getattr(self, scenario)()
+        return self.files
+
+
+SCENARIOS = ('small', 'huge', 'deep', 'bundles', 'import')
+
+# Name and statement of each import timed by the ``import`` scenario
+IMPORTS = (
+    ('storage', 'import deploy_utils.storage'),
+    ('storage_filesystem', 'from deploy_utils.storage import '
+                           'OverwriteFilesystemStorage'),
+    ('storage_s3', 'from deploy_utils.storage import S3StaticStorage'),
+    ('deploystatic', 'import deploy_utils.management.commands.deploystatic'),
+)
+HEAVY_PACKAGES = ('boto', 'storages', 'pipeline')
+
+# Run in a fresh interpreter, after setting Django up, printing how long
+# the statement took and which heavy packages it imported.
+IMPORT_SCRIPT = '''
+import json, sys, time
+import django
+django.setup()
+before = set(sys.modules)
+start = time.time()
+%s
+seconds = time.time() - start
+print(json.dumps({'seconds': seconds, 'imported': sorted(set(
+    name.split('.')[0] for name in set(sys.modules) - before
+    if name.split('.')[0] in %r))}))
+'''
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def make_result(scenario, name, count, seconds, size=None, latencies=None):
+    """
+    Return the numbers for one benchmark: how many items it handled in how
+    many seconds, the throughput, and the latency percentiles (in
+    milliseconds) of ``latencies`` if given.
+    """
+    result = OrderedDict((
+        ('scenario', scenario),
+        ('benchmark', name),
+        ('count', count),
+        ('seconds', seconds),
+        ('per_second', count / seconds if seconds else None),
+    ))
+    if size is not None:
+        result['bytes'] = size
+        result['mb_per_second'] = size / float(MB) / seconds if seconds \
+            else None
+    if latencies:
+        result['p50_ms'] = percentile(latencies, 0.5) * 1000
+        result['p95_ms'] = percentile(latencies, 0.95) * 1000
+        result['max_ms'] = max(latencies) * 1000
+    return result
+
+
+class DeployBenchmark(object):
+    """
+    Runs the benchmarks for each scenario in a temporary directory under
+    ``work_dir``, against a fake S3 on localhost:4567 that delays every
+    request by ``latency`` seconds. Deploys use ``workers`` threads.
+    """
+    def __init__(self, stdout, workers=4, latency=0, scale=1.0,
+                 work_dir=None, keep=False):
+        self.stdout = stdout
+        self.workers = workers
+        self.latency = latency
+        self.scale = scale
+        self.work_dir = work_dir
+        self.keep = keep
+
+    def run(self, scenarios=SCENARIOS):
+        # django-storages reads its credentials from settings at import
+        # time; without any, boto looks in the environment. The fake S3
+        # doesn't check them.
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        results = []
+        faults = FaultInjector(latency=self.latency) if self.latency else None
+        server = FakeS3Server(faults=faults).start()
+        try:
+            for scenario in scenarios:
+                self.stdout.write('Benchmarking %s...' % scenario)
+                if scenario == 'import':
+                    results.extend(self.bench_imports())
+                else:
+                    results.extend(self.run_scenario(scenario, server))
+        finally:
+            server.stop()
+        return results
+
+    def bench_imports(self, runs=5):
+        """
+        Time each of ``IMPORTS`` (the median of ``runs`` fresh interpreters).
+        """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        results = []
+        for name, statement in IMPORTS:
+            timings = []
+            for _run in range(runs):
+                output = subprocess.check_output(
+                    [sys.executable, '-c',
+                     IMPORT_SCRIPT % (statement, HEAVY_PACKAGES)], env=env)
+                timings.append(json.loads(output.decode('utf-8').strip(
+                    ).splitlines()[-1]))
+            seconds = percentile([timing['seconds'] for timing in timings],
+                                 0.5)
+            result = make_result('import', name, 1, seconds,
+                                 latencies=[timing['seconds']
+                                            for timing in timings])
+            result['imported'] = timings[-1]['imported']
+            results.append(result)
+        return results
+
+    def run_scenario(self, scenario, server):
+        root = tempfile.mkdtemp(prefix='deploy-benchmark-%s-' % scenario,
+                                dir=self.work_dir)
+        try:
+            static_root = os.path.join(root, 'static')
+            generator = StaticTreeGenerator(static_root, self.scale)
+            files = generator.generate(scenario)
+            # A fresh bucket for each scenario
+            with server.lock:
+                server.buckets[BENCHMARK_BUCKET] = {}
+            with override_settings(**self.get_settings(root,
+                                                       generator.packages)):
+                return [
+                    self.bench_get_files(scenario, static_root),
+                    self.bench_get_static_file_path(scenario, static_root,
+                                                    files),
+                    self.bench_deploystatic(scenario, root, files),
+                    self.bench_post_process(scenario, static_root, files),
+                ]
+        finally:
+            reset_static_storage()
+            if self.keep:
+                self.stdout.write('Kept %s' % root)
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+    def get_settings(self, root, packages):
+        pipeline = {
+            'PIPELINE_ENABLED': True,
+            'STYLESHEETS': packages['css'],
+            'JAVASCRIPT': packages['js'],
+            'CSS_COMPRESSOR': None,
+            'JS_COMPRESSOR': None,
+        }
+        return dict(
+            STATICFILES_DIRS=[os.path.join(root, 'static')],
+            STATIC_ROOT=os.path.join(root, 'collected'),
+            STATICFILES_FINDERS=[
+                'django.contrib.staticfiles.finders.FileSystemFinder'],
+            STATICFILES_STORAGE='deploy_utils.storage.S3StaticStorage',
+            PROXY_S3=True,
+            AWS_STATIC_BUCKET_NAME=BENCHMARK_BUCKET,
+            CLOUDFRONT_ENABLED=False,
+            DEPLOY_MANIFEST_PATH=None,
+            DEPLOY_MANIFEST_NAME=None,
+            DEPLOY_INVENTORY=False,
+            DEPLOY_CSS_GRAPH_PATH=None,
+            DEPLOY_PRECOMPRESS=False,
+            DEPLOY_JOURNAL_PATH=os.path.join(root, 'journal'),
+            NPM_ROOT_PATH='',
+            # django-pipeline 1.6 and later
+            PIPELINE=pipeline,
+            # django-pipeline 1.5
+            PIPELINE_ENABLED=True,
+            PIPELINE_CSS=packages['css'],
+            PIPELINE_JS=packages['js'],
+            PIPELINE_CSS_COMPRESSOR=None,
+            PIPELINE_JS_COMPRESSOR=None,
+        )
+
+    def bench_get_files(self, scenario, static_root):
+        storage = FileSystemStorage(location=static_root)
+        start = time.time()
+        count = sum(1 for _path in get_files(storage, IGNORE_PATTERNS))
+        return make_result(scenario, 'get_files', count, time.time() - start)
+
+    def bench_get_static_file_path(self, scenario, static_root, files):
+        start = time.time()
+        static_path_index = StaticPathIndex()
+        latencies = []
+        for rel_path in files:
+            file_start = time.time()
+            static_path_index.find(os.path.join(static_root, rel_path))
+            latencies.append(time.time() - file_start)
+        return make_result(scenario, 'get_static_file_path', len(files),
+                           time.time() - start, latencies=latencies)
+
+    def bench_deploystatic(self, scenario, root, files):
+        report_path = os.path.join(root, 'report.json')
+        start = time.time()
+        call_command('deploystatic', path=root, interactive=False,
+                     workers=self.workers, report=report_path,
+                     filelist=[os.path.join('static', rel_path)
+                               for rel_path in files],
+                     stdout=StringIO())
+        seconds = time.time() - start
+        with io.open(report_path, encoding='utf-8') as fp:
+            report = json.load(fp)
+        latencies = [timings['upload'] for timings in report['files']
+                     if 'upload' in timings]
+        return make_result(scenario, 'deploystatic', len(files), seconds,
+                           report['bytes_sent'], latencies)
+
+    def bench_post_process(self, scenario, static_root, files):
+        # A fresh storage, so nothing is cached from the deploy
+        reset_static_storage()
+        profiler = DeployProfiler()
+        get_static_storage().profiler = profiler
+        paths = [(os.path.join(static_root, rel_path), rel_path)
+                 for rel_path in files]
+        start = time.time()
+        post_process_static_files(paths)
+        seconds = time.time() - start
+        result = make_result(scenario, 'post_process', len(files), seconds)
+        pack_times = [pack_seconds for _output, pack_seconds
+                      in profiler.slowest_packages()]
+        if pack_times:
+            result['packages'] = len(pack_times)
+            result['pack_p50_ms'] = percentile(pack_times, 0.5) * 1000
+            result['pack_max_ms'] = max(pack_times) * 1000
+        return result
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    Compare the throughput of each of ``results`` with the same benchmark
+    in ``baseline``. Returns the comparison lines and the list of
+    benchmarks more than ``tolerance`` (a fraction) slower.
+    """
+    previous = dict(((result['scenario'], result['benchmark']), result)
+                    for result in baseline)
+    lines = []
+    regressions = []
+    for result in results:
+        key = (result['scenario'], result['benchmark'])
+        before = previous.get(key)
+        if not before or not before.get('per_second') or \
+                not result.get('per_second'):
+            continue
+        change = result['per_second'] / before['per_second'] - 1
+        regressed = change < -tolerance
+        if regressed:
+            regressions.append(key)
+        lines.append('%-10s %-22s %+7.1f%%%s' % (
+            key[0], key[1], change * 100, '  REGRESSION' if regressed else ''))
+    return lines, regressions
+
+
+def format_results(results):
+    lines = ['%-10s %-22s %8s %9s %11s %9s %9s' % (
+        'Scenario', 'Benchmark', 'Count', 'Seconds', 'Per second', 'MB/s',
+        'p95 ms')]
+    for result in results:
+        lines.append('%-10s %-22s %8d %9.3f %11.1f %9s %9s' % (
+            result['scenario'], result['benchmark'], result['count'],
+            result['seconds'], result['per_second'] or 0,
+            '%.2f' % result['mb_per_second']
+            if result.get('mb_per_second') is not None else '-',
+            '%.2f' % result['p95_ms'] if 'p95_ms' in result else '-') + (
+            '  imports %s' % ', '.join(result['imported'])
+            if result.get('imported') else ''))
+    return lines
@@ -0,0 +1,430 @@
+'''
+An in-memory stand-in for S3, for trying deploys out locally.
+
+It answers the requests boto makes for the storages in this package (bucket
+listing, object PUT/GET/HEAD/DELETE, multi-object delete and multipart
+uploads) on ``localhost:4567``, which is where ``S3ProxyConnection`` sends
+requests when ``PROXY_S3`` is set. A ``FaultInjector`` can make it throttle
+(``503 SlowDown``), fail (``500``), reset connections or respond slowly, to
+see how a deploy copes.
+
+python manage.py runfakes3 --slowdown-rate=0.1 --reset-rate=0.02
+'''
+
+from __future__ import unicode_literals
+
+import hashlib
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import namedtuple
+from email.utils import formatdate
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qs, unquote, urlsplit
+
+
+FakeObject = namedtuple('FakeObject', ('data', 'etag', 'headers',
+                                       'last_modified'))
+
+# Headers stored with an object and returned when it is fetched
+STORED_HEADERS = ('content-type', 'content-encoding', 'cache-control',
+                  'content-disposition', 'expires')
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class FaultInjector(object):
+    """
+    Decide which requests to object keys fail, and how. Each request is
+    throttled with probability ``slowdown_rate``, answered with a ``500``
+    with probability ``error_rate``, or has its connection reset with
+    probability ``reset_rate``. Requests beyond ``max_concurrency`` in
+    flight are always throttled, as S3 does under load. Every request is
+    delayed by ``latency`` seconds.
+    """
+    def __init__(self, slowdown_rate=0, error_rate=0, reset_rate=0,
+                 latency=0, max_concurrency=None, seed=None):
+        self.slowdown_rate = slowdown_rate
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.latency = latency
+        self.max_concurrency = max_concurrency
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.stats = dict.fromkeys(
+            ('requests', 'slowdown', 'error', 'reset'), 0)
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """
+        Start a request, returning the fault to inject, if any: one of
+        ``'slowdown'``, ``'error'`` or ``'reset'``.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.in_flight += 1
+            self.stats['requests'] += 1
+            roll = self.random.random()
+            if (self.max_concurrency is not None and
+                    self.in_flight > self.max_concurrency):
+                fault = 'slowdown'
+            elif roll < self.slowdown_rate:
+                fault = 'slowdown'
+            elif roll < self.slowdown_rate + self.error_rate:
+                fault = 'error'
+            elif roll < self.slowdown_rate + self.error_rate + \
+                    self.reset_rate:
+                fault = 'reset'
+            else:
+                fault = None
+            if fault is not None:
+                self.stats[fault] += 1
+            return fault
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this each response
+    # with a body stalls on a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        path = unquote(url.path).lstrip('/')
+        bucket_name, _slash, key_name = path.partition('/')
+        query = dict((name, values[0]) for name, values in
+                     parse_qs(url.query, keep_blank_values=True).items())
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        faults = self.server.faults
+        if not key_name or faults is None:
+            # Faults are only injected into requests for objects; a bucket
+            # that seems to be missing would fail the deploy outright.
+            return self.handle_request(method, bucket_name, key_name, query,
+                                       body)
+        fault = faults.begin()
+        try:
+            if fault == 'slowdown':
+                self.send_error_response(503, 'SlowDown',
+                                         'Please reduce your request rate.')
+            elif fault == 'error':
+                self.send_error_response(500, 'InternalError',
+                                         'We encountered an internal error.')
+            elif fault == 'reset':
+                self.reset_connection()
+            else:
+                self.handle_request(method, bucket_name, key_name, query,
+                                    body)
+        finally:
+            faults.end()
+
+    def handle_request(self, method, bucket_name, key_name, query, body):
+        server = self.server
+        with server.lock:
+            bucket = server.buckets.get(bucket_name)
+        if method == 'PUT' and not key_name:
+            with server.lock:
+                server.buckets.setdefault(bucket_name, {})
+            return self.send_xml_response(200, None)
+        if bucket is None:
+            return self.send_error_response(404, 'NoSuchBucket',
+                                            'The bucket does not exist.')
+
+        if not key_name:
+            if method == 'HEAD':
+                return self.send_xml_response(200, None)
+            if method == 'GET':
+                return self.list_bucket(bucket_name, bucket, query)
+            if method == 'POST' and 'delete' in query:
+                return self.delete_objects(bucket, body)
+        elif method == 'POST' and 'uploads' in query:
+            return self.initiate_upload(bucket_name, key_name)
+        elif method == 'POST' and 'uploadId' in query:
+            return self.complete_upload(bucket, bucket_name, key_name,
+                                        query['uploadId'], body)
+        elif method == 'GET' and 'uploadId' in query:
+            return self.list_parts(bucket_name, key_name, query['uploadId'])
+        elif method == 'PUT' and 'uploadId' in query:
+            return self.upload_part(query['uploadId'],
+                                    int(query['partNumber']), body)
+        elif method == 'DELETE' and 'uploadId' in query:
+            with server.lock:
+                server.uploads.pop(query['uploadId'], None)
+            return self.send_xml_response(204, None)
+        elif method == 'PUT':
+            return self.put_object(bucket, key_name, body)
+        elif method in ('GET', 'HEAD'):
+            return self.get_object(bucket, key_name, method == 'GET')
+        elif method == 'DELETE':
+            with server.lock:
+                bucket.pop(key_name, None)
+            return self.send_xml_response(204, None)
+        self.send_error_response(400, 'InvalidRequest',
+                                 'Unsupported request.')
+
+    def put_object(self, bucket, key_name, body):
+        copy_source = self.headers.get('x-amz-copy-source')
+        if copy_source:
+            source_bucket, _slash, source_key = unquote(
+                copy_source).lstrip('/').partition('/')
+            with self.server.lock:
+                source = self.server.buckets.get(
+                    source_bucket, {}).get(source_key)
+            if source is None:
+                return self.send_error_response(
+                    404, 'NoSuchKey', 'The specified key does not exist.')
+            body = source.data
+        obj = self.server.store(bucket, key_name, body,
+                                self.stored_headers())
+        if copy_source:
+            return self.send_xml_response(200, self.xml(
+                'CopyObjectResult', ('LastModified', iso8601(
+                    obj.last_modified)), ('ETag', obj.etag)))
+        self.send_xml_response(200, None, {'ETag': obj.etag})
+
+    def get_object(self, bucket, key_name, send_body):
+        with self.server.lock:
+            obj = bucket.get(key_name)
+        if obj is None:
+            return self.send_error_response(
+                404, 'NoSuchKey', 'The specified key does not exist.',
+                send_body)
+        headers = dict(obj.headers)
+        headers.setdefault('content-type', 'binary/octet-stream')
+        headers['ETag'] = obj.etag
+        headers['Last-Modified'] = formatdate(obj.last_modified,
+                                              usegmt=True)
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(obj.data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(obj.data)
+
+    def list_bucket(self, bucket_name, bucket, query):
+        prefix = query.get('prefix', '')
+        marker = query.get('marker', '')
+        delimiter = query.get('delimiter', '')
+        max_keys = int(query.get('max-keys') or 1000)
+        with self.server.lock:
+            names = sorted(name for name in bucket
+                           if name.startswith(prefix) and name > marker)
+            objects = [(name, bucket[name]) for name in names]
+
+        contents = []
+        common_prefixes = []
+        truncated = False
+        last_name = ''
+        for name, obj in objects:
+            if len(contents) + len(common_prefixes) >= max_keys:
+                truncated = True
+                break
+            if delimiter and delimiter in name[len(prefix):]:
+                common_prefix = name[:name.index(
+                    delimiter, len(prefix)) + len(delimiter)]
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+            else:
+                contents.append(('Contents', ('Key', name), (
+                    'LastModified', iso8601(obj.last_modified)),
+                    ('ETag', obj.etag), ('Size', str(len(obj.data))),
+                    ('StorageClass', 'STANDARD')))
+            last_name = name
+
+        elements = [('Name', bucket_name), ('Prefix', prefix),
+                    ('Marker', marker), ('MaxKeys', str(max_keys)),
+                    ('IsTruncated', 'true' if truncated else 'false')]
+        if truncated:
+            elements.append(('NextMarker', last_name))
+        elements.extend(contents)
+        elements.extend(('CommonPrefixes', ('Prefix', common_prefix))
+                        for common_prefix in common_prefixes)
+        self.send_xml_response(200, self.xml('ListBucketResult', *elements))
+
+    def delete_objects(self, bucket, body):
+        tree = ElementTree.fromstring(body)
+        deleted = []
+        with self.server.lock:
+            for key in tree.iter():
+                if local_name(key.tag) == 'Key':
+                    bucket.pop(key.text, None)
+                    deleted.append(('Deleted', ('Key', key.text)))
+        self.send_xml_response(200, self.xml('DeleteResult', *deleted))
+
+    def initiate_upload(self, bucket_name, key_name):
+        upload_id = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.uploads[upload_id] = (self.stored_headers(), {})
+        self.send_xml_response(200, self.xml(
+            'InitiateMultipartUploadResult', ('Bucket', bucket_name),
+            ('Key', key_name), ('UploadId', upload_id)))
+
+    def upload_part(self, upload_id, part_num, body):
+        with self.server.lock:
+            upload = self.server.uploads.get(upload_id)
+            if upload is not None:
+                upload[1][part_num] = body
+        if upload is None:
+            return self.send_error_response(
+                404, 'NoSuchUpload', 'The specified upload does not exist.')
+        self.send_xml_response(200, None, {
+            'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+
+    def list_parts(self, bucket_name, key_name, upload_id):
+        with self.server.lock:
+            _headers, parts = self.server.uploads.get(upload_id, (None, {}))
+            parts = sorted(parts.items())
+        self.send_xml_response(200, self.xml(
+            'ListPartsResult', ('Bucket', bucket_name), ('Key', key_name),
+            ('UploadId', upload_id), ('IsTruncated', 'false'),
+            *[('Part', ('PartNumber', str(num)), ('ETag', '"%s"' % (
+                hashlib.md5(data).hexdigest())), ('Size', str(len(data))))
+              for num, data in parts]))
+
+    def complete_upload(self, bucket, bucket_name, key_name, upload_id, body):
+        part_nums = [int(element.text)
+                     for element in ElementTree.fromstring(body).iter()
+                     if local_name(element.tag) == 'PartNumber']
+        with self.server.lock:
+            headers, parts = self.server.uploads.pop(upload_id, (None, {}))
+        if headers is None or any(num not in parts for num in part_nums):
+            return self.send_error_response(
+                400, 'InvalidPart', 'One or more parts could not be found.')
+        data = b''.join(parts[num] for num in part_nums)
+        digests = b''.join(hashlib.md5(parts[num]).digest()
+                           for num in part_nums)
+        etag = '"%s-%d"' % (hashlib.md5(digests).hexdigest(), len(part_nums))
+        obj = self.server.store(bucket, key_name, data, headers, etag)
+        self.send_xml_response(200, self.xml(
+            'CompleteMultipartUploadResult',
+            ('Location', 'http://%s/%s/%s' % (self.headers.get('host'),
+                                              bucket_name, key_name)),
+            ('Bucket', bucket_name), ('Key', key_name), ('ETag', obj.etag)))
+
+    def stored_headers(self):
+        return dict((name, value) for name, value in self.headers.items()
+                    if name.lower() in STORED_HEADERS or
+                    name.lower().startswith('x-amz-meta-'))
+
+    def reset_connection(self):
+        # Close with SO_LINGER 0, so the client sees a reset rather than a
+        # clean end of stream.
+        self.close_connection = True
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.connection.close()
+
+    def xml(self, root, *elements):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<%s xmlns="%s">%s' \
+            '</%s>' % (root, S3_NAMESPACE, ''.join(
+                render_element(element) for element in elements), root)
+
+    def send_xml_response(self, status, xml, headers=None):
+        body = xml.encode('utf-8') if xml is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if xml is not None:
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_response(self, status, code, message, send_body=True):
+        xml = self.xml('Error', ('Code', code), ('Message', message))
+        if not send_body:
+            xml = None
+        self.send_xml_response(status, xml)
+
+
+class FakeS3Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An in-memory S3 on ``host:port``, optionally injecting ``faults`` (a
+    ``FaultInjector``) into requests for objects.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='localhost', port=4567, faults=None,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeS3Handler)
+        self.faults = faults
+        self.verbose = verbose
+        self.buckets = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def store(self, bucket, key_name, data, headers, etag=None):
+        obj = FakeObject(data, etag or '"%s"' % hashlib.md5(data).hexdigest(),
+                         headers, time.time())
+        with self.lock:
+            bucket[key_name] = obj
+        return obj
+
+    def start(self):
+        """
+        Serve requests on a background thread until ``stop`` is called.
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def local_name(tag):
+    # Strip the namespace ElementTree puts in front of tag names
+    return tag.rpartition('}')[2]
+
+
+def iso8601(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def render_element(element):
+    name, children = element[0], element[1:]
+    if len(children) == 1 and not isinstance(children[0], tuple):
+        content = escape(children[0])
+    else:
+        content = ''.join(render_element(child) for child in children)
+    return '<%s>%s</%s>' % (name, content, name)
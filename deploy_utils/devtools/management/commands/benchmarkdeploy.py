@@ -0,0 +1,85 @@
+'''
+python manage.py benchmarkdeploy
+python manage.py benchmarkdeploy --scenario=small --scenario=bundles --scale=0.5
+python manage.py benchmarkdeploy --latency=0.02 --output=benchmark.json
+python manage.py benchmarkdeploy --baseline=benchmark.json --tolerance=0.15
+python manage.py benchmarkdeploy --scenario=import
+'''
+
+import io
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from deploy_utils.devtools.benchmark import SCENARIOS, DeployBenchmark, \
+    compare_results, format_results
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--scenario', action='append', type='choice',
+                    choices=SCENARIOS, dest='scenarios', default=[],
+                    help='Which scenarios (%s) do you want to run? " \
+                        "Defaults to all of them.' % ', '.join(SCENARIOS)),
+        make_option('--scale', action='store', type='float', dest='scale',
+                    default=1.0, help='How much bigger (or smaller) do " \
+                        "you want the generated trees?'),
+        make_option('-w', '--workers', action='store', type='int',
+                    dest='workers', default=4,
+                    help='How many files do you want to upload at once?'),
+        make_option('--latency', action='store', type='float',
+                    dest='latency', default=0, help='How many seconds do " \
+                        "you want each request to the fake S3 delayed by?'),
+        make_option('--output', action='store', type='string',
+                    dest='output', default=None, help='Where do you want " \
+                        "to write the results as JSON?'),
+        make_option('--baseline', action='store', type='string',
+                    dest='baseline', default=None, help='Which earlier " \
+                        "results (from --output) do you want to compare " \
+                        "with?'),
+        make_option('--tolerance', action='store', type='float',
+                    dest='tolerance', default=0.1, help='How much slower " \
+                        "(as a fraction) can a benchmark get before it " \
+                        "counts as a regression?'),
+        make_option('--work-dir', action='store', type='string',
+                    dest='work_dir', default=None, help='Where do you " \
+                        "want the static trees generated?'),
+        make_option('--keep', action='store_true', dest='keep',
+                    default=False, help='Do you want to keep the " \
+                        "generated static trees?'),
+        )
+
+    help = 'Benchmark deploystatic and the static file helpers against a " \
+        "local fake S3 using generated static trees'
+
+    def handle(self, **options):
+        benchmark = DeployBenchmark(
+            self.stdout,
+            workers=int(options.get('workers') or 4),
+            latency=options.get('latency') or 0,
+            scale=options.get('scale') or 1.0,
+            work_dir=options.get('work_dir'),
+            keep=options.get('keep', False))
+        results = benchmark.run(options.get('scenarios') or SCENARIOS)
+
+        for line in format_results(results):
+            self.stdout.write(line)
+
+        output = options.get('output')
+        if output:
+            with io.open(output, 'w', encoding='utf-8') as fp:
+                fp.write(json.dumps(results, indent=2))
+
+        baseline_path = options.get('baseline')
+        if baseline_path:
+            with io.open(baseline_path, encoding='utf-8') as fp:
+                baseline = json.load(fp)
+            lines, regressions = compare_results(
+                results, baseline, options.get('tolerance', 0.1))
+            self.stdout.write('Compared with %s:' % baseline_path)
+            for line in lines:
+                self.stdout.write(line)
+            if regressions:
+                raise CommandError('%d benchmark(s) regressed' % (
+                    len(regressions)))
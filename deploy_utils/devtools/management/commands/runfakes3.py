@@ -0,0 +1,67 @@
+'''
+python manage.py runfakes3
+python manage.py runfakes3 --slowdown-rate=0.1 --reset-rate=0.02 --max-concurrency=4
+
+Run with PROXY_S3 = True (and any AWS keys) in settings, so the S3 storages
+talk to it instead of S3.
+'''
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from deploy_utils.devtools.fakes3 import FakeS3Server, FaultInjector
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--host', action='store', type='string', dest='host',
+                    default='localhost',
+                    help='What address do you want to listen on?'),
+        make_option('--port', action='store', type='int', dest='port',
+                    default=4567, help='What port do you want to listen on?'),
+        make_option('--slowdown-rate', action='store', type='float',
+                    dest='slowdown_rate', default=0, help='What fraction " \
+                        "of requests do you want throttled (503 SlowDown)?'),
+        make_option('--error-rate', action='store', type='float',
+                    dest='error_rate', default=0, help='What fraction of " \
+                        "requests do you want to fail with a 500?'),
+        make_option('--reset-rate', action='store', type='float',
+                    dest='reset_rate', default=0, help='What fraction of " \
+                        "connections do you want reset?'),
+        make_option('--latency', action='store', type='float',
+                    dest='latency', default=0, help='How many seconds do " \
+                        "you want each request delayed by?'),
+        make_option('--max-concurrency', action='store', type='int',
+                    dest='max_concurrency', default=None, help='How many " \
+                        "requests can be in flight before the rest are " \
+                        "throttled?'),
+        make_option('--seed', action='store', type='int', dest='seed',
+                    default=None, help='What random seed do you want " \
+                        "faults injected with?'),
+        )
+
+    help = 'Run an in-memory stand-in for S3, optionally injecting faults, " \
+        "to try deploys against'
+
+    def handle(self, **options):
+        faults = FaultInjector(
+            slowdown_rate=options.get('slowdown_rate') or 0,
+            error_rate=options.get('error_rate') or 0,
+            reset_rate=options.get('reset_rate') or 0,
+            latency=options.get('latency') or 0,
+            max_concurrency=options.get('max_concurrency'),
+            seed=options.get('seed'))
+        server = FakeS3Server(options.get('host', 'localhost'),
+                              options.get('port', 4567), faults,
+                              verbose=int(options.get('verbosity', 1)) > 1)
+        self.stdout.write('Fake S3 listening on %s:%d' % (
+            server.server_address[0], server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write('Injected faults: %s' % ', '.join(
+                '%s=%d' % item for item in sorted(faults.stats.items())))
@@ -1,28 +1,127 @@
 from __future__ import unicode_literals
 __author__ = 'Philip Roche'
 
-from django.core.files.base import ContentFile
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.staticfiles.finders import get_finders
+from django.core.files.base import File
 
 from .storage import  DummyStorage
 
 
-def copy_static_file(path, dest_path):
+_static_storage = None
+_static_storage_lock = threading.Lock()
+
+
+def get_static_storage():
+    """
+    Return the storage shared by every file operation of a deploy.
+
+    The storage (and, for S3, its connections) is only built once per
+    process, so copying and post-processing a file doesn't pay for a new
+    storage instance and TLS handshake each time.
+    """
+    global _static_storage
+    with _static_storage_lock:
+        if _static_storage is None:
+            static_storage = DummyStorage()
+            # Set up the wrapped storage now, while holding the lock, so
+            # worker threads never race to build it.
+            static_storage._setup()
+            _static_storage = static_storage
+    return _static_storage
+
+
+def reset_static_storage():
+    """
+    Discard the shared storage so the next deploy builds a new one.
+    """
+    global _static_storage
+    with _static_storage_lock:
+        _static_storage = None
+
+
+def copy_static_file(path, dest_path, static_storage=None):
     """
     Attempt to copy ``path`` with storage
+
+    The file is streamed to storage in chunks rather than read into memory,
+    so memory use per copy doesn't grow with the size of the file.
     """
-    static_storage = DummyStorage()
+    if static_storage is None:
+        static_storage = get_static_storage()
     with open(path, "rb") as source_file:
-        static_storage.save(dest_path, ContentFile(source_file.read()))
+        static_storage.save(dest_path, File(source_file))
+
 
+def post_process_static_file(path, rel_path, dry_run=False,
+                             static_storage=None):
+    return post_process_static_files([(path, rel_path)], dry_run=dry_run,
+                                     static_storage=static_storage)
 
-def post_process_static_file(path, rel_path, dry_run=False):
-    static_storage = DummyStorage()
+
+def post_process_static_files(paths, dry_run=False, static_storage=None,
+                              **options):
+    """
+    Post-process every ``(path, rel_path)`` pair in ``paths`` with storage
+    in a single pass, returning a dict mapping each processed name
+    (including any pipeline package outputs) to its hashed name. Any
+    ``options`` are passed on to the storage's ``post_process``.
+    """
+    if static_storage is None:
+        static_storage = get_static_storage()
+    hashed_names = {}
     if hasattr(static_storage, 'post_process'):
-        processor = static_storage.post_process([(path, rel_path)], dry_run=dry_run)
-        post_processed_files = []
+        processor = static_storage.post_process(list(paths), dry_run=dry_run,
+                                                **options)
         for original_path, processed_path, processed in processor:
+            if isinstance(processed, Exception):
+                raise processed
             if processed:
-                post_processed_files.append(original_path)
+                hashed_names[original_path] = processed_path
+    return hashed_names
+
+
+def run_in_parallel(func, items, workers=1):
+    """
+    Call ``func`` with each of ``items`` on a pool of ``workers`` threads.
+
+    Yields ``(item, result, error)`` tuples in the same order as ``items``.
+    An exception raised for one item is yielded as its ``error`` instead of
+    being raised, so one failure doesn't abort the rest of the batch. At most
+    ``workers * 2`` items are in flight at any time.
+    """
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= workers * 2:
+                yield _collect(*pending.popleft())
+        while pending:
+            yield _collect(*pending.popleft())
+
+
+def _collect(item, future):
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+def list_static_files(ignore_patterns=None):
+    """
+    Yield ``(abs_path, rel_path)`` for every file the configured static
+    file finders can list.
+    """
+    for finder in get_finders():
+        for path, storage in finder.list(ignore_patterns or []):
+            prefix = getattr(storage, 'prefix', None)
+            rel_path = os.path.join(prefix, path) if prefix else path
+            yield storage.path(path), rel_path
 
 
 def get_changed_files_local(filelist):
@@ -0,0 +1,114 @@
+'''
+An in-memory index of the objects in an S3 bucket.
+
+The bucket is listed once (boto pages through LIST requests 1000 keys at a
+time) and ``exists``/``size``/change checks are answered from the index
+instead of a HEAD request per file. The index can be cached on disk between
+deploys and is kept up to date as the storage saves and deletes objects.
+'''
+
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+from collections import namedtuple
+
+
+class InventoryEntry(namedtuple('InventoryEntry',
+                                ('etag', 'size', 'last_modified'))):
+
+    @property
+    def md5(self):
+        """
+        The md5 hex digest of the object, if known. S3 ETags are the md5 of
+        the content except for multipart uploads, whose ETags contain a
+        ``-``.
+        """
+        if not self.etag:
+            return None
+        etag = self.etag.strip('"')
+        if '-' in etag:
+            return None
+        return etag
+
+
+class BucketInventory(object):
+    """
+    Key -> ``InventoryEntry`` index of a bucket, safe to use from several
+    upload threads at once.
+    """
+    version = 1
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, bucket, prefix=''):
+        """
+        Rebuild the index from a full (paginated) listing of ``bucket``.
+        """
+        entries = {}
+        for key in bucket.list(prefix=prefix):
+            entries[key.name] = InventoryEntry(key.etag, key.size,
+                                               key.last_modified)
+        with self._lock:
+            self.entries = entries
+
+    def load(self):
+        """
+        Load the index from ``cache_path``. Returns ``False`` if there is no
+        usable cached copy.
+        """
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return False
+        with open(self.cache_path, 'rb') as fp:
+            data = json.loads(fp.read().decode('utf-8'))
+        if data.get('version') != self.version:
+            return False
+        with self._lock:
+            self.entries = dict(
+                (name, InventoryEntry(*entry))
+                for name, entry in data['entries'].items())
+        return True
+
+    def save(self):
+        if not self.cache_path:
+            return
+        with self._lock:
+            data = {'version': self.version, 'entries': self.entries}
+            data = json.dumps(data, indent=0, sort_keys=True)
+        with open(self.cache_path, 'wb') as fp:
+            fp.write(data.encode('utf-8'))
+
+    def get(self, name):
+        with self._lock:
+            return self.entries.get(name)
+
+    def exists(self, name):
+        return self.get(name) is not None
+
+    def size(self, name):
+        entry = self.get(name)
+        return entry.size if entry is not None else 0
+
+    def is_changed(self, name, md5):
+        """
+        Return whether the object ``name`` differs from content with the
+        given ``md5`` (or doesn't exist). Objects whose checksum isn't known
+        are treated as changed.
+        """
+        entry = self.get(name)
+        return entry is None or entry.md5 != md5
+
+    def record(self, name, etag=None, size=None, last_modified=None):
+        """
+        Record that ``name`` has just been saved.
+        """
+        with self._lock:
+            self.entries[name] = InventoryEntry(etag, size, last_modified)
+
+    def invalidate(self, name):
+        with self._lock:
+            self.entries.pop(name, None)
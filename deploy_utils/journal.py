@@ -0,0 +1,147 @@
+'''
+Records the progress of a deploy, so an interrupted deploy can be resumed
+without uploading or post-processing again the files it had already done.
+'''
+
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+
+COPIED = 'copy'
+PROCESSED = 'process'
+
+
+class DeployJournal(object):
+    """
+    An append-only log of the steps a deploy has completed: one JSON object
+    per line for each file copied and each file post-processed, with the
+    content hash of the file it was done for.
+
+    Each line is flushed as soon as it is written, so everything up to an
+    interruption (even a killed process) is kept. A line cut short by a
+    crash is ignored when the journal is read back.
+    """
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {COPIED: {}, PROCESSED: {}}
+        self._fp = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Read the steps recorded by an earlier deploy, returning whether
+        there were any.
+        """
+        if not os.path.isfile(self.path):
+            return False
+        with io.open(self.path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('step') in self.entries:
+                    self.entries[entry['step']][entry['path']] = entry
+        return any(self.entries.values())
+
+    def open(self, resume=False):
+        """
+        Start recording, after the steps already in the journal when
+        ``resume`` is set, or else in a new journal.
+        """
+        self._fp = io.open(self.path, 'a' if resume else 'w',
+                           encoding='utf-8')
+        self._write({'step': 'start', 'version': self.version,
+                     'time': time.time(), 'resume': resume})
+
+    def close(self, complete=False):
+        """
+        Stop recording. A ``complete`` deploy leaves nothing to resume, so
+        its journal is removed.
+        """
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if complete and os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def _write(self, entry):
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            self._fp.write(line + '\n')
+            self._fp.flush()
+
+    def record(self, step, path, file_hash, **fields):
+        """
+        Record that ``step`` (``COPIED`` or ``PROCESSED``) has been done for
+        the version of ``path`` with content hash ``file_hash``.
+        """
+        entry = dict(fields, step=step, path=path, hash=file_hash)
+        self.entries[step][path] = entry
+        if self._fp is not None:
+            self._write(entry)
+
+    def is_done(self, path, file_hash=None, size=None, mtime=None):
+        """
+        Return whether every step for this version of ``path`` is done:
+        it was post-processed, or copied and needs no post-processing.
+        """
+        entry = self.get(PROCESSED, path, file_hash, size, mtime)
+        if entry is None:
+            entry = self.get(COPIED, path, file_hash, size, mtime)
+            return entry is not None and not entry.get('post_process')
+        return True
+
+    def replay(self, manifest):
+        """
+        Record every file the journal shows is done in ``manifest``, so
+        files skipped on resuming are kept in it.
+        """
+        for path, entry in self.entries[COPIED].items():
+            processed = self.entries[PROCESSED].get(path)
+            if entry.get('post_process'):
+                if processed is None or processed['hash'] != entry['hash']:
+                    continue
+                manifest.record(path, entry['hash'], entry.get('size'),
+                                processed.get('hashed_name'),
+                                entry.get('mtime'))
+            else:
+                manifest.record(path, entry['hash'], entry.get('size'),
+                                mtime=entry.get('mtime'))
+        for path, processed in self.entries[PROCESSED].items():
+            if path not in self.entries[COPIED]:
+                # Package outputs and rewritten stylesheets
+                manifest.record(path, hashed_name=processed.get('hashed_name'))
+
+    def get(self, step, path, file_hash=None, size=None, mtime=None):
+        """
+        Return the entry recording that ``step`` was done for ``path``, if
+        it was done for the same content: identified by ``file_hash``, or
+        else by ``size`` and ``mtime``. Returns None otherwise.
+        """
+        entry = self.entries[step].get(path)
+        if entry is None:
+            return None
+        if file_hash is not None:
+            return entry if entry['hash'] == file_hash else None
+        if size is not None and entry.get('size') == size and \
+                entry.get('mtime') == mtime:
+            return entry
+        return None
+
+
+def get_journal_path():
+    """
+    Where deploys are journaled by default: ``DEPLOY_JOURNAL_PATH``, or
+    None (no journal) if it isn't set.
+    """
+    return getattr(settings, 'DEPLOY_JOURNAL_PATH', None)
@@ -4,20 +4,36 @@ Created on 21 May 2014
 @author: philroche
 
 python manage.py deploystatic --commit=3b282d9a07db7ab7e317944208b92cf66e1294c5
+python manage.py deploystatic --commit=v1.4.0..v1.5.0
+python manage.py deploystatic --working-tree
+python manage.py deploystatic --commit=v1.5.0 --journal=deploy.journal
+python manage.py deploystatic --commit=v1.5.0 --journal=deploy.journal --resume
+python manage.py deploystatic --commit=v1.5.0 --report=deploy-v1.5.0.json
+python manage.py deploystatic --commit=v1.5.0 --noinput --shard=2/4
 python manage.py deploystatic --file=media/css/all.css --file=media/js/fb.js
 '''
 
 from optparse import make_option
+import itertools
 import os
 import six
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.contrib.staticfiles.finders import get_finders, get_finder
+from django.contrib.staticfiles.finders import get_finder
 
-from deploy_utils.vcs_utils import get_changed_files_git
+from deploy_utils.vcs_utils import get_changes_git, DELETED
 from deploy_utils.file_utils import get_changed_files_local, \
-    post_process_static_file, copy_static_file
+    reset_static_storage, get_static_storage, list_static_files
+from deploy_utils.deployer import StaticDeployer, StaticFile
+from deploy_utils.storage import StaticPathIndex, get_files
+from deploy_utils.compress import MAX_IN_MEMORY_SIZE, Precompressor
+from deploy_utils.cssgraph import CssReferenceGraph
+from deploy_utils.manifest import DeployManifest, is_manifest_enabled
+from deploy_utils.journal import DeployJournal, get_journal_path
+from deploy_utils.profiling import DeployProfiler
+from deploy_utils.sharding import Shard
 
 
 try:
@@ -82,43 +98,21 @@ def prompt_bool(name, default=False,
             return rv
 
 
-def get_static_file_path(abs_path):
+def get_static_file_path(abs_path, static_path_index=None):
     """
     Check if the given file path represents a static file, and if so return
     the corresponding relative path (i.e. relative to the static folder it
     belongs to); otherwise return None.
+
+    Pass a ``StaticPathIndex`` when classifying many files so the static
+    roots are only collected once.
     """
-    rel_path = None
-
-    # First check if the file is in one of our STATICFILES_DIRS
-    for static_dir in settings.STATICFILES_DIRS:
-        static_dir = os.path.abspath(os.path.normpath(static_dir))
-        if static_dir in abs_path:
-            rel_path = abs_path[len(static_dir) + 1:]
-            break
-
-    if not rel_path:
-        # Check if the file appears to be in one of the installed apps'
-        # 'static' subdirectories
-        static_dir = "{}static{}".format(os.path.sep, os.path.sep)
-        index = abs_path.rfind(static_dir)
-        if index != -1:
-            # Path contains '/static/'; take the part after this
-            rel_path = abs_path[index + len(static_dir):]
-
-    if rel_path:
-        # Have a relative path; now check if it is actually is a static
-        # file by seeing if any of our static file finders returns it
-        for finder in get_finders():
-            # If the given relative path is a static file, then one of our
-            # finders should return the corresponding absolute path
-            found_paths = finder.find(rel_path, all=True)
-            if abs_path in found_paths:
-                # Return the relative static path (e.g. 'img/icons/arrow.png')
-                return rel_path
-
-    # Return None to indicate that this is not a static file
-    return None
+    if static_path_index is None:
+        static_path_index = StaticPathIndex()
+    # Return the relative static path (e.g. 'img/icons/arrow.png'), or None
+    # to indicate that this is not a static file
+    rel_path, _storage = static_path_index.find(abs_path)
+    return rel_path
 
 
 class Command(BaseCommand):
@@ -128,7 +122,13 @@ class Command(BaseCommand):
                         "list all the files without actually saving them?'),
         make_option('-c', '--commit', action='store', type="string",
                     dest='commit', default=None,
-                    help='What revision/commit do you want to deploy?'),
+                    help='What revision/commit (or A..B range of " \
+                        "commits) do you want to deploy?'),
+        make_option('--working-tree', action='store_true',
+                    dest='working_tree', default=False,
+                    help='Do you want to deploy uncommitted changes in the " \
+                        "working copy (relative to a single --commit or " \
+                        "HEAD)?'),
         make_option('-p', '--path', action='store', type="string", dest='path',
             default=None, help='What is the path to the working copy?'),
         make_option('-f', '--file', action='append', type="string",
@@ -137,6 +137,35 @@ class Command(BaseCommand):
         make_option('--noinput', action='store_false', dest='interactive',
                     default=True, help='Tells the command to NOT prompt the " \
                             "user to confirm whether or not to proceed.'),
+        make_option('-w', '--workers', action='store', type="int",
+                    dest='workers', default=1,
+                    help='How many files do you want to upload at once?'),
+        make_option('--force', action='store_true', dest='force',
+                    default=False, help='Do you want to upload files even " \
+                        "if the deploy manifest says they are unchanged?'),
+        make_option('--precompress', action='store_true', dest='precompress',
+                    default=False, help='Do you want to save gzip/brotli " \
+                        "variants of text assets alongside them?'),
+        make_option('--refresh-inventory', action='store_true',
+                    dest='refresh_inventory', default=False,
+                    help='Do you want to re-list the bucket rather than " \
+                        "use the cached inventory?'),
+        make_option('--resume', action='store_true', dest='resume',
+                    default=False, help='Do you want to skip the files an " \
+                        "interrupted deploy (recorded in its journal) " \
+                        "already deployed?'),
+        make_option('--journal', action='store', type="string",
+                    dest='journal', default=None, help='Where do you want " \
+                        "to record the progress of the deploy (by default " \
+                        "DEPLOY_JOURNAL_PATH, if set)?'),
+        make_option('--report', action='store', type="string",
+                    dest='report', default=None, help='Where do you want " \
+                        "to write a JSON report of where the deploy spent " \
+                        "its time?'),
+        make_option('--shard', action='store', type="string",
+                    dest='shard', default=None, help='Which share (i/N, " \
+                        "e.g. 2/4) of the deploy do you want this process " \
+                        "to do? Merge the shards with mergedeployshards.'),
         )
 
     help = 'Management command to deploy static files to S3 (or similar) " \
@@ -150,6 +179,36 @@ class Command(BaseCommand):
         path = options.get('path', None)
         verbosity = int(options.get('verbosity', 1))
         interactive = options.get('interactive', True)
+        workers = int(options.get('workers', 1) or 1)
+        force = options.get('force', False)
+        precompress = options.get('precompress', False) or getattr(
+            settings, 'DEPLOY_PRECOMPRESS', False)
+        refresh_inventory = options.get('refresh_inventory', False)
+        working_tree = options.get('working_tree', False)
+        resume = options.get('resume', False)
+        journal_path = options.get('journal', None) or get_journal_path()
+        report_path = options.get('report', None)
+        profiler = DeployProfiler()
+
+        if resume and not journal_path:
+            raise CommandError('--resume needs a journal to resume from; '
+                               'pass --journal or set DEPLOY_JOURNAL_PATH.')
+
+        shard = None
+        if options.get('shard', None):
+            try:
+                shard = Shard.parse(options['shard'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            if not getattr(settings, 'DEPLOY_MANIFEST_NAME', None):
+                # Shards may run on different machines, so they can only
+                # share the copy of the manifest in storage
+                raise CommandError('--shard needs DEPLOY_MANIFEST_NAME, so '
+                                   'the shards can be merged.')
+            # Each shard keeps its own journal and report
+            journal_path = shard.path(journal_path)
+            report_path = shard.path(report_path)
+            profiler.extra['shard'] = str(shard)
 
         verbose_output = False
         if verbosity > 1:
@@ -159,8 +218,6 @@ class Command(BaseCommand):
         if len(filelist) == 0:
             vcs = True
 
-        get_changed_files = get_changed_files_git
-
         if path == None:
             # Look in the parent directory
             path = '..'
@@ -177,9 +234,21 @@ class Command(BaseCommand):
             return
 
         if vcs:
-            if not commit:
+            if not commit and not working_tree:
                 commit = prompt("What commit do you want to deploy?")
-            message, files_changed = get_changed_files(commit, path)
+            # A single diff, however many commits are in the range
+            with profiler.phase('vcs'):
+                message, changes = get_changes_git(commit, path,
+                                                   working_tree)
+            files_changed = []
+            for file_changed, status in changes.items():
+                if status == DELETED:
+                    self.stdout.write('%s was deleted and will not be ' \
+                        'deployed' % file_changed)
+                else:
+                    files_changed.append(file_changed)
+            if working_tree:
+                commit = 'working tree'
         else:
             message, files_changed = get_changed_files_local(filelist)
 
@@ -207,18 +276,175 @@ class Command(BaseCommand):
             self.stdout.write('Deployment aborted')
             return
 
+        # Start a fresh storage session for this deploy; every file operation
+        # below shares it (and its connections).
+        reset_static_storage()
+
+        # Throttled, failed and dropped requests to storage are retried, and
+        # fewer are sent at once while storage is throttling them.
+        throttle = None
+        if hasattr(get_static_storage(), 'throttle') and not dry_run:
+            # Only S3 storages have a throttle, and it imports boto
+            from deploy_utils.throttle import ThrottleController
+            throttle = ThrottleController.from_settings(
+                max_concurrency=workers)
+            get_static_storage().throttle = throttle
+
+        # List the bucket once up front, so existence and change checks
+        # don't need a request per file.
+        inventory = None
+        if (getattr(settings, 'DEPLOY_INVENTORY', False) and not dry_run and
+                hasattr(get_static_storage(), 'load_inventory')):
+            inventory = get_static_storage().load_inventory(
+                getattr(settings, 'DEPLOY_INVENTORY_PATH', None),
+                refresh=refresh_inventory)
+
+        # Files whose content matches the deploy manifest are skipped
+        # before any upload is attempted.
+        manifest = None
+        if is_manifest_enabled() and not dry_run:
+            manifest = DeployManifest.load(get_static_storage(),
+                                           local=shard is None)
+
+        # Each file copied and post-processed is recorded as it's done, so
+        # an interrupted deploy can be resumed with --resume.
+        journal = None
+        if journal_path and not dry_run:
+            journal = DeployJournal(journal_path)
+            if resume and journal.load():
+                self.stdout.write('Resuming the deploy recorded in %s' % (
+                    journal_path))
+                if manifest is not None:
+                    journal.replay(manifest)
+            elif resume:
+                self.stdout.write('There is no deploy to resume in %s' % (
+                    journal_path))
+            journal.open(resume)
+
+        # Time spent packing each package is recorded too. Only this
+        # shard's packages are packed.
+        if hasattr(get_static_storage(), 'pack_package'):
+            get_static_storage().profiler = profiler
+            get_static_storage().shard = shard
+            if shard is not None:
+                self.stdout.write('Deploying shard %s' % shard)
+
+        # Every text asset saved from here on (copies, hashed names and
+        # pipeline packages) is compressed on a process pool, whose workers
+        # are started before the deploy starts any threads.
+        precompressor = None
+        if precompress and not dry_run:
+            precompressor = Precompressor(
+                get_static_storage(),
+                encodings=getattr(settings, 'DEPLOY_PRECOMPRESS_ENCODINGS',
+                                  None),
+                max_size=getattr(settings, 'DEPLOY_PRECOMPRESS_MAX_SIZE',
+                                 MAX_IN_MEMORY_SIZE))
+            get_static_storage().precompressor = precompressor
+
+        # Stylesheets that reference a changed file are post-processed again
+        # after it, so they pick up its new hashed name.
+        css_graph = None
+        css_graph_path = getattr(settings, 'DEPLOY_CSS_GRAPH_PATH', None)
+        if css_graph_path and not dry_run:
+            css_graph = self.load_css_graph(css_graph_path)
+
+        static_files, npm_collect_required = self.discover_files(
+            files_changed, path, css_graph, verbose_output, profiler)
+        copy_only_files = ()
+        if npm_collect_required:
+            copy_only_files = self.discover_npm_files()
+        failed_files = []
+        if dry_run:
+            # Only report what would be deployed
+            for static_file in itertools.chain(static_files, copy_only_files):
+                self.stdout.write('\twould copy %s ' %
+                                  static_file.relative_path)
+        else:
+            # NPM-built files are uploaded (and packages packed) while the
+            # rest are still being discovered; see deploy_utils.deployer
+            deployer = StaticDeployer(
+                self.stdout, workers=workers, manifest=manifest,
+                css_graph=css_graph, force=force, journal=journal,
+                profiler=profiler, shard=shard)
+            failed_files.extend(deployer.deploy(static_files,
+                                                copy_only_files))
+
+        if precompressor is not None:
+            get_static_storage().precompressor = None
+            with profiler.phase('precompress'):
+                for variant_name in precompressor.finish():
+                    self.stdout.write('\tcompressed %s ' % variant_name)
+            failed_files.extend(precompressor.failed)
+
+        with profiler.phase('save'):
+            if manifest is not None and shard is not None:
+                # Just what this shard deployed, for mergedeployshards
+                manifest.updates().save(get_static_storage(), shard.suffix,
+                                        local=False)
+            elif manifest is not None:
+                # Save even if some files failed, so the ones that made it
+                # aren't uploaded again next time.
+                manifest.save(get_static_storage())
+
+            # Each shard only knows about its own uploads, so the inventory
+            # is refreshed by mergedeployshards instead
+            if inventory is not None and shard is None:
+                inventory.save()
+
+            # Every shard sees every changed file, so one copy will do
+            if css_graph is not None and (shard is None or shard.index == 1):
+                css_graph.save()
+
+        if throttle is not None:
+            self.stdout.write(throttle.report())
+            profiler.extra['throttle'] = throttle.stats
+
+        if not dry_run:
+            profiler.finish()
+            profiler.extra['failed'] = [relative_path for relative_path, error
+                                        in failed_files]
+            for line in profiler.summary():
+                self.stdout.write(line)
+            if report_path:
+                profiler.save(report_path)
+
+        if journal is not None:
+            # Only a deploy with nothing left to do is finished with
+            journal.close(complete=not failed_files)
+
+        if failed_files:
+            for relative_path, error in failed_files:
+                self.stderr.write('%s failed to deploy: %s' % (
+                    relative_path, error))
+            raise CommandError('%d file(s) failed to deploy' % (
+                len(failed_files)))
+
+    def discover_files(self, files_changed, path, css_graph=None,
+                       verbose_output=False, profiler=None):
+        """
+        Work out which of ``files_changed`` are static files that need to be
+        saved using the static storage (S3 in this case). Returns a list of
+        a ``StaticFile`` for each one, and whether any front-end source
+        changed, so the NPM-built distribution files need deploying too
+        (see ``discover_npm_files``).
+        """
+        static_files = []
         npm_collect_required = False
         npm_root_path = getattr(settings, "NPM_ROOT_PATH", "")
         if npm_root_path:
             npm_root_path = os.path.normpath(npm_root_path)
 
-        # loop through all files and save each one using the default storage
-        # (s3 is this case) if it is a static file
+        static_path_index = StaticPathIndex()
         for file_changed in files_changed:
             abs_path = os.path.join(os.path.abspath(path),
                                     file_changed)
 
-            relative_path = get_static_file_path(abs_path)
+            start = time.time()
+            relative_path = get_static_file_path(abs_path, static_path_index)
+            if profiler is not None:
+                profiler.record('classify', relative_path or file_changed,
+                                time.time() - start)
 
             if verbose_output:
                 self.stdout.write('file_changed = %s ' % file_changed)
@@ -239,27 +465,44 @@ class Command(BaseCommand):
                                   "deployed" % abs_path)
             else:
                 # this is a valid static file and we'll
-                # post-process it now
-                if not dry_run:
-                    copy_static_file(abs_path, relative_path)
-                    self.stdout.write('\tcopied %s ' % relative_path)
-                    post_process_static_file(abs_path, relative_path)
-                    self.stdout.write('\tprocessed %s ' % relative_path)
-
-        if npm_collect_required:
-            self.stdout.write("Collecting NPM-built assets...")
-            finder = get_finder(
-                    "django.contrib.staticfiles.finders.FileSystemFinder")
-            ignore_patterns = ['CVS', '.*', '*~']
-            for relative_path, storage in finder.list(ignore_patterns):
-                location = storage.location
-                if npm_root_path in location and not dry_run:
-                    abs_path = os.path.join(storage.location, relative_path)
-                    copy_static_file(abs_path, relative_path)
-                    self.stdout.write('\tcopied %s ' % relative_path)
-
-                    # For now we assume no post-processing needs to be done
-                    # (i.e. npm itself will have done any minification and
-                    # packaging of assets)
-                    # post_process_static_file(abs_path, relative_path)
-                    # self.stdout.write('\tprocessed %s ' % relative_path)
+                # post-process it once it has been copied
+                if css_graph is not None:
+                    css_graph.update(relative_path, abs_path)
+                static_files.append(StaticFile(abs_path, relative_path, True))
+        return static_files, npm_collect_required
+
+    def discover_npm_files(self):
+        """
+        Yield a ``StaticFile`` for each NPM-built distribution file, as the
+        locations NPM builds into are walked.
+        """
+        npm_root_path = os.path.normpath(
+            getattr(settings, "NPM_ROOT_PATH", ""))
+        self.stdout.write("Collecting NPM-built assets...")
+        finder = get_finder(
+                "django.contrib.staticfiles.finders.FileSystemFinder")
+        ignore_patterns = ['CVS', '.*', '*~']
+        # Only walk the locations NPM builds into
+        for prefix, root in finder.locations:
+            storage = finder.storages[root]
+            if npm_root_path not in storage.location:
+                continue
+            for relative_path in get_files(storage, ignore_patterns):
+                abs_path = os.path.join(storage.location, relative_path)
+                if prefix:
+                    relative_path = os.path.join(prefix, relative_path)
+                # For now we assume no post-processing needs to be done
+                # (i.e. npm itself will have done any minification and
+                # packaging of assets)
+                yield StaticFile(abs_path, relative_path, False)
+
+    def load_css_graph(self, path):
+        """
+        Load the stylesheet reference graph from ``path``, building it from
+        every static stylesheet the first time.
+        """
+        css_graph = CssReferenceGraph(path)
+        if not css_graph.load():
+            self.stdout.write("Building CSS reference graph...")
+            css_graph.build(list_static_files(['CVS', '.*', '*~']))
+        return css_graph
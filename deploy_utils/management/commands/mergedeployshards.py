@@ -0,0 +1,93 @@
+'''
+python manage.py mergedeployshards --shards=4
+python manage.py mergedeployshards --shards=4 --report=deploy-v1.5.0.json
+'''
+
+import io
+import json
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from deploy_utils.file_utils import get_static_storage, reset_static_storage
+from deploy_utils.manifest import DeployManifest
+from deploy_utils.profiling import merge_reports
+from deploy_utils.sharding import all_shards
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--shards', action='store', type='int',
+                    dest='shards', default=None, help='How many shards " \
+                        "(the N in deploystatic --shard=i/N) was the " \
+                        "deploy split into?'),
+        make_option('--report', action='store', type='string',
+                    dest='report', default=None, help='Where do you want " \
+                        "the shards\' reports (passed to deploystatic as " \
+                        "--report) combined?'),
+        )
+
+    help = 'Combine the manifests (and reports) written by each shard of a " \
+        "deploystatic run with --shard'
+
+    def handle(self, **options):
+        count = options.get('shards')
+        if not count or count < 1:
+            raise CommandError('How many shards? Use --shards=N')
+        shards = all_shards(count)
+        report_path = options.get('report')
+        # deploystatic --shard only reads and writes the copy of the
+        # manifest in storage, so that's the one merged into
+        if not getattr(settings, 'DEPLOY_MANIFEST_NAME', None):
+            raise CommandError('Sharded deploys need DEPLOY_MANIFEST_NAME.')
+
+        reset_static_storage()
+        static_storage = get_static_storage()
+
+        # Check every shard finished before touching anything
+        missing = ['manifest of shard %s' % shard for shard in shards
+                   if not DeployManifest.exists(static_storage, shard.suffix,
+                                                local=False)]
+        if report_path:
+            missing.extend('report of shard %s' % shard for shard in shards
+                           if not os.path.isfile(shard.path(report_path)))
+        if missing:
+            raise CommandError('There is no %s' % ', '.join(missing))
+
+        manifest = DeployManifest.load(static_storage, local=False)
+        for shard in shards:
+            shard_manifest = DeployManifest.load(static_storage, shard.suffix,
+                                                 local=False)
+            manifest.merge(shard_manifest)
+            self.stdout.write('Merged %d file(s) from shard %s' % (
+                len(shard_manifest.files), shard))
+        manifest.save(static_storage, local=False)
+        for shard in shards:
+            DeployManifest.delete(static_storage, shard.suffix, local=False)
+
+        # No shard saved the inventory, as each one only knew about its own
+        # uploads
+        if (getattr(settings, 'DEPLOY_INVENTORY', False) and
+                hasattr(static_storage, 'load_inventory')):
+            self.stdout.write('Refreshing the bucket inventory...')
+            static_storage.load_inventory(
+                getattr(settings, 'DEPLOY_INVENTORY_PATH', None),
+                refresh=True).save()
+
+        if report_path:
+            reports = []
+            for shard in shards:
+                with io.open(shard.path(report_path), encoding='utf-8') as fp:
+                    reports.append(json.load(fp))
+            report = merge_reports(reports)
+            with io.open(report_path, 'w', encoding='utf-8') as fp:
+                fp.write(json.dumps(report, indent=2))
+            for shard in shards:
+                os.remove(shard.path(report_path))
+            self.stdout.write('Deploy took %.2fs over %d shard(s), sending %d '
+                              'bytes' % (report['duration'], count,
+                                         report['bytes_sent']))
+            for relative_path in report['failed']:
+                self.stderr.write('%s failed to deploy' % relative_path)
@@ -0,0 +1,106 @@
+'''
+python manage.py prunestatic --dry-run
+python manage.py prunestatic --keep=5 --workers=8 --noinput
+'''
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from deploy_utils.file_utils import get_static_storage, reset_static_storage
+from deploy_utils.management.commands.deploystatic import prompt_bool
+from deploy_utils.manifest import DeployManifest, is_manifest_enabled
+from deploy_utils.prune import delete_keys, find_stale_keys
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-k', '--keep', action='store', type='int',
+                    dest='keep', default=None, help='How many generations " \
+                        "of each file do you want to keep (default " \
+                        "DEPLOY_PRUNE_KEEP, or 3)?'),
+        make_option('-d', '--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Do you want to only report what " \
+                        "would be deleted, and how many bytes that would " \
+                        "reclaim?'),
+        make_option('-w', '--workers', action='store', type='int',
+                    dest='workers', default=4, help='How many batches of " \
+                        "files do you want to delete at once?'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True, help='Tells the command to NOT prompt the " \
+                            "user to confirm whether or not to proceed.'),
+        )
+
+    help = 'Delete the hashed copies of static files older than the last " \
+        "few generations (from the deploy manifest) from the static bucket'
+
+    def handle(self, **options):
+        keep = options.get('keep')
+        if keep is None:
+            keep = getattr(settings, 'DEPLOY_PRUNE_KEEP', 3)
+        dry_run = options.get('dry_run', False)
+        workers = int(options.get('workers') or 4)
+        interactive = options.get('interactive', True)
+        verbosity = int(options.get('verbosity', 1))
+
+        if keep < 1:
+            raise CommandError('At least one generation has to be kept')
+        if not is_manifest_enabled():
+            raise CommandError('Pruning needs the deploy manifest; set " \
+                "DEPLOY_MANIFEST_PATH or DEPLOY_MANIFEST_NAME')
+
+        reset_static_storage()
+        static_storage = get_static_storage()
+        if not hasattr(static_storage, 'load_inventory'):
+            self.stdout.write("Looks like you are not using S3 storage for " \
+                "static files - as such there is nothing to prune.")
+            return
+
+        manifest = DeployManifest.load(static_storage)
+        if not manifest.hashed_names():
+            self.stdout.write('The deploy manifest has no hashed names, so " \
+                "there is nothing to prune.')
+            return
+
+        self.stdout.write('Listing the static bucket...')
+        inventory = static_storage.load_inventory(
+            getattr(settings, 'DEPLOY_INVENTORY_PATH', None), refresh=True)
+        stale = find_stale_keys(manifest, inventory.entries, keep,
+                                static_storage.location)
+        reclaimed = sum(stale_key.size for stale_key in stale)
+        if verbosity > 1 or dry_run:
+            for stale_key in stale:
+                self.stdout.write('\t%s (%d bytes)' % (stale_key.name,
+                                                       stale_key.size))
+        self.stdout.write('%d stale file(s) of %d static file(s), %d bytes' % (
+            len(stale), len(set(stale_key.original for stale_key in stale)),
+            reclaimed))
+
+        if dry_run:
+            self.stdout.write('Would reclaim %d bytes' % reclaimed)
+            return
+        if not stale:
+            return
+        if interactive and not prompt_bool(
+                'Are you sure you want to delete %d file(s)' % len(stale)):
+            self.stdout.write('Pruning aborted')
+            return
+
+        failed = dict(delete_keys(static_storage,
+                                  [stale_key.name for stale_key in stale],
+                                  workers))
+        for stale_key in stale:
+            if stale_key.name not in failed:
+                inventory.invalidate(stale_key.name)
+        inventory.save()
+        self.stdout.write('Reclaimed %d bytes' % sum(
+            stale_key.size for stale_key in stale
+            if stale_key.name not in failed))
+
+        if failed:
+            for key_name, error in sorted(failed.items()):
+                self.stderr.write('%s could not be deleted: %s' % (
+                    key_name, error))
+            raise CommandError('%d file(s) could not be deleted' % (
+                len(failed)))
@@ -0,0 +1,187 @@
+'''
+Keeps track of what was last deployed for each static file, so that
+deploystatic can skip files whose content hasn't changed without touching
+the network.
+'''
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+
+def get_file_hash(path, chunk_size=64 * 1024):
+    """
+    Return the md5 hex digest of the file at ``path``, reading it in chunks.
+
+    md5 is what CachedFilesMixin uses to build hashed names, so the digest
+    recorded here lines up with the hash part of those names.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class DeployManifest(object):
+    """
+    Mapping of relative static path to the content hash, size, local
+    modification time and hashed name of the version that was last
+    deployed.
+
+    The manifest can be kept in a local file (``DEPLOY_MANIFEST_PATH``)
+    and/or as an object in the static storage (``DEPLOY_MANIFEST_NAME``).
+    Passing ``local=False`` leaves the local file alone, for readers that
+    must all see the same copy. Entries may be recorded from several upload
+    threads at once.
+
+    ``suffix`` is appended to both, for the manifests of deploy shards
+    (see ``deploy_utils.sharding``).
+    """
+    version = 1
+
+    def __init__(self, files=None):
+        self.files = files or {}
+        # Names recorded since loading
+        self.recorded = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, data):
+        manifest = json.loads(data)
+        if manifest.get('version') != cls.version:
+            return cls()
+        return cls(manifest.get('files', {}))
+
+    def to_json(self):
+        with self._lock:
+            return json.dumps({'version': self.version, 'files': self.files},
+                              indent=0, sort_keys=True)
+
+    @classmethod
+    def exists(cls, static_storage=None, suffix='', local=True):
+        path, name = get_manifest_location(suffix)
+        return bool((local and path and os.path.isfile(path)) or (
+            name and static_storage is not None and
+            static_storage.exists(name)))
+
+    @classmethod
+    def load(cls, static_storage=None, suffix='', local=True):
+        """
+        Load the manifest from the configured local path (unless ``local``
+        is False), falling back to the copy in ``static_storage``. Returns an
+        empty manifest if neither exists.
+        """
+        path, name = get_manifest_location(suffix)
+        if local and path and os.path.isfile(path):
+            with open(path, 'rb') as fp:
+                return cls.from_json(fp.read().decode('utf-8'))
+        if name and static_storage is not None and static_storage.exists(name):
+            with static_storage.open(name) as fp:
+                return cls.from_json(fp.read().decode('utf-8'))
+        return cls()
+
+    def save(self, static_storage=None, suffix='', local=True):
+        """
+        Write the manifest to the configured local path (unless ``local``
+        is False) and/or ``static_storage``.
+        """
+        path, name = get_manifest_location(suffix)
+        data = self.to_json().encode('utf-8')
+        if local and path:
+            with open(path, 'wb') as fp:
+                fp.write(data)
+        if name and static_storage is not None:
+            if static_storage.exists(name):
+                static_storage.delete(name)
+            static_storage.save(name, ContentFile(data))
+
+    def is_unchanged(self, rel_path, file_hash, size):
+        with self._lock:
+            entry = self.files.get(rel_path)
+        return (entry is not None and entry.get('hash') == file_hash and
+                entry.get('size') == size)
+
+    def is_unchanged_stat(self, rel_path, size, mtime):
+        """
+        Cheap check, before hashing, that a file has the same size and
+        modification time as when it was last deployed from this machine.
+        """
+        with self._lock:
+            entry = self.files.get(rel_path)
+        return (entry is not None and 'hash' in entry and
+                entry.get('size') == size and entry.get('mtime') == mtime)
+
+    def hashed_names(self):
+        """
+        Return a dict mapping each recorded name to its hashed name.
+        """
+        with self._lock:
+            return dict((name, entry['hashed_name'])
+                        for name, entry in self.files.items()
+                        if entry.get('hashed_name'))
+
+    def record(self, rel_path, file_hash=None, size=None, hashed_name=None,
+               mtime=None):
+        """
+        Record a deployed file. Fields left as ``None`` keep their previous
+        value, so post-processed outputs (which have no local source) can be
+        recorded with just their hashed name.
+        """
+        with self._lock:
+            entry = self.files.setdefault(rel_path, {})
+            for key, value in (('hash', file_hash), ('size', size),
+                               ('hashed_name', hashed_name),
+                               ('mtime', mtime)):
+                if value is not None:
+                    entry[key] = value
+            self.recorded.add(rel_path)
+
+    def updates(self):
+        """
+        Return a manifest of just the entries recorded since loading.
+        """
+        with self._lock:
+            return DeployManifest(dict((name, dict(self.files[name]))
+                                       for name in self.recorded))
+
+    def merge(self, other):
+        """
+        Record every entry of the manifest ``other`` in this one.
+        """
+        with other._lock:
+            files = dict((name, dict(entry))
+                         for name, entry in other.files.items())
+        with self._lock:
+            self.files.update(files)
+            self.recorded.update(files)
+
+    @classmethod
+    def delete(cls, static_storage=None, suffix='', local=True):
+        path, name = get_manifest_location(suffix)
+        if local and path and os.path.isfile(path):
+            os.remove(path)
+        if name and static_storage is not None and \
+                static_storage.exists(name):
+            static_storage.delete(name)
+
+
+def get_manifest_location(suffix=''):
+    """
+    Return the local path and storage name of the manifest (either may be
+    None), with ``suffix`` appended.
+    """
+    path = getattr(settings, 'DEPLOY_MANIFEST_PATH', None)
+    name = getattr(settings, 'DEPLOY_MANIFEST_NAME', None)
+    return path and path + suffix, name and name + suffix
+
+
+def is_manifest_enabled():
+    return bool(getattr(settings, 'DEPLOY_MANIFEST_PATH', None) or
+                getattr(settings, 'DEPLOY_MANIFEST_NAME', None))
@@ -0,0 +1,203 @@
+'''
+The storages deploystatic uses to post-process (and pack) changed files
+with django-pipeline, for ``PipelineStorage`` and ``PipelineCachedStorage``.
+
+Import them from ``deploy_utils.storage``, which only imports this module
+(and django-pipeline) when one of them is first used.
+'''
+
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+from pipeline.compressors import Compressor
+from pipeline.packager import Packager
+from pipeline.storage import PipelineMixin
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import CachedStaticFilesStorage, \
+    StaticFilesStorage
+from django.core.files.base import File
+from django.utils.six.moves.urllib.parse import unquote, urlsplit
+
+from .storage import PrecompressMixin, ReferenceHashMixin
+
+
+class LocalSourceCompressor(Compressor):
+    """
+    Read the sources of a package that are being deployed from their local
+    copies (``storage.local_files``), rather than through
+    ``staticfiles_storage``, which may still have the old version or (when
+    another shard deploys them) not have them at all yet.
+    """
+    def read_bytes(self, path):
+        local_files = getattr(self.storage, 'local_files', None)
+        abs_path = local_files.get(path) if local_files else None
+        if abs_path is None:
+            return super(LocalSourceCompressor, self).read_bytes(path)
+        with open(abs_path, 'rb') as fp:
+            return fp.read()
+
+
+class DummyPipelineMixin(PipelineMixin):
+    """
+    Post-process a batch of changed files, packing each pipeline package
+    that includes any of them exactly once.
+
+    Packages are packed ``get_pack_workers()`` at a time, and each one is
+    saved as soon as it is packed. The compressors pipeline runs are
+    mostly external programs, so threads are enough to keep every core
+    busy.
+
+    Given a ``profiler`` (a ``DeployProfiler``), the time taken to pack
+    each package is recorded in it.
+
+    Given a ``shard`` (a ``deploy_utils.sharding.Shard``), only packages
+    whose output filename belongs to it are packed. ``local_files`` maps
+    the relative paths of files being deployed to their local copies,
+    which are packed (see ``LocalSourceCompressor``) and hashed (for the
+    hashed names of the files that reference them) instead of the copies
+    in storage, which may not have been uploaded yet.
+    """
+    _package_index_lock = threading.Lock()
+    profiler = None
+    shard = None
+    local_files = None
+
+    def get_package_index(self):
+        """
+        Return a dict mapping each source path to the ``(kind, package)``
+        pairs that include it.
+
+        The index (and the glob expansion of each package's source
+        filenames) is built from the PIPELINE settings the first time it is
+        needed and then reused for the lifetime of the storage, i.e. for the
+        whole deploy.
+        """
+        with self._package_index_lock:
+            if getattr(self, '_package_index', None) is None:
+                packager = Packager(storage=self)
+                packager.compressor = LocalSourceCompressor(
+                    storage=self, verbose=packager.verbose)
+                package_index = {}
+                package_outputs = {}
+                for kind in ('css', 'js'):
+                    for package_name in packager.packages[kind]:
+                        package = packager.package_for(kind, package_name)
+                        package_outputs[package.output_filename] = (
+                            kind, package)
+                        for path in package.paths:
+                            package_index.setdefault(path, []).append(
+                                (kind, package))
+                self._packager = packager
+                self._package_outputs = package_outputs
+                self._package_index = package_index
+        return self._package_index
+
+    def packages_for(self, rel_paths):
+        """
+        Return the ``(kind, package)`` pairs that include any of
+        ``rel_paths``, each one only once, keyed by output filename.
+        Packages belonging to another shard are left out.
+        """
+        package_index = self.get_package_index()
+        packages = OrderedDict()
+        for rel_path in rel_paths:
+            for kind, package in package_index.get(rel_path, ()):
+                if self.shard is None or self.shard.owns(
+                        package.output_filename):
+                    packages.setdefault(package.output_filename,
+                                        (kind, package))
+        return packages
+
+    def get_pack_workers(self):
+        """
+        How many packages to pack at once: ``DEPLOY_PACK_WORKERS``, or by
+        default the number of CPUs.
+        """
+        return max(1, getattr(settings, 'DEPLOY_PACK_WORKERS', None) or
+                   cpu_count())
+
+    def pack_packages(self, packages):
+        """
+        Pack each of ``packages`` (``(kind, package)`` pairs) on a pool of
+        threads. If any fail, the first error is raised once the rest are
+        done.
+        """
+        packages = list(packages)
+        if len(packages) < 2:
+            for kind, package in packages:
+                self.pack_package(kind, package)
+            return
+        workers = min(self.get_pack_workers(), len(packages))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.pack_package, kind, package)
+                       for kind, package in packages]
+            for future in futures:
+                future.result()
+
+    def pack_package(self, kind, package):
+        start = time.time()
+        if kind == 'css':
+            self._packager.pack_stylesheets(package)
+        else:
+            self._packager.pack_javascripts(package)
+        if self.profiler is not None:
+            self.profiler.record_package(package.output_filename,
+                                         time.time() - start)
+
+    def hashed_name(self, name, content=None, *args, **kwargs):
+        if content is None and self.local_files:
+            clean_name = urlsplit(unquote(name)).path.strip()
+            abs_path = self.local_files.get(clean_name)
+            if abs_path is not None:
+                with File(open(abs_path, 'rb')) as content:
+                    return super(DummyPipelineMixin, self).hashed_name(
+                        name, content, *args, **kwargs)
+        return super(DummyPipelineMixin, self).hashed_name(
+            name, content, *args, **kwargs)
+
+    def post_process(self, paths, dry_run=False, **options):
+        # Output filenames of packages the caller has already packed
+        packed = options.pop('packed', ())
+        # Output filenames of packages to pack (and hash) even if none of
+        # ``paths`` are in them, e.g. when another shard deployed them
+        extra_packages = options.pop('packages', ())
+        if dry_run:
+            return
+
+        files_to_process = OrderedDict()
+        for _abs_path, rel_path in paths:
+            files_to_process[rel_path] = (self, rel_path)
+
+        packages = self.packages_for(files_to_process)
+        for output_file in extra_packages:
+            packages.setdefault(output_file,
+                                self._package_outputs[output_file])
+        if self.packing:
+            self.pack_packages(package for output_file, package
+                               in packages.items()
+                               if output_file not in packed)
+        for output_file in packages:
+            files_to_process[output_file] = (self, output_file)
+            yield output_file, output_file, True
+
+        super_class = super(PipelineMixin, self)
+
+        if hasattr(super_class, 'post_process'):
+            for name, hashed_name, processed in super_class.post_process(
+                    files_to_process.copy(), dry_run, **options):
+                yield name, hashed_name, processed
+
+
+class DummyPipelineStorage(PrecompressMixin, DummyPipelineMixin,
+                           StaticFilesStorage):
+    pass
+
+
+class DummyPipelineCachedStorage(PrecompressMixin, DummyPipelineMixin,
+                                 ReferenceHashMixin, CachedStaticFilesStorage):
+    pass
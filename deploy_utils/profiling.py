@@ -0,0 +1,202 @@
+'''
+Measures where the time in a deploy goes: how long each phase took, how
+long each file spent being classified, read, uploaded and post-processed,
+how long each pipeline package took to pack, and how many bytes were sent.
+'''
+
+from __future__ import unicode_literals
+
+import io
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class DeployProfiler(object):
+    """
+    Collects timings from any thread. Use ``phase`` to time a whole phase
+    of the deploy, ``timer`` (or ``record``) to time one stage of one file,
+    and ``record_package`` for pipeline packages.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.phases = OrderedDict()
+        self.files = {}
+        self.packages = {}
+        self.bytes_sent = 0
+        self.extra = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    @contextmanager
+    def timer(self, stage, path, size=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, path, time.time() - start, size)
+
+    def record(self, stage, path, seconds, size=None):
+        """
+        Record that ``stage`` took ``seconds`` for ``path``; ``size`` is the
+        number of bytes sent, for uploads.
+        """
+        with self._lock:
+            timings = self.files.setdefault(path, {})
+            timings[stage] = timings.get(stage, 0) + seconds
+            if size is not None:
+                timings['bytes'] = timings.get('bytes', 0) + size
+                self.bytes_sent += size
+
+    def record_package(self, output_filename, seconds):
+        with self._lock:
+            self.packages[output_filename] = self.packages.get(
+                output_filename, 0) + seconds
+
+    def finish(self):
+        self.finished = time.time()
+
+    def stage_totals(self):
+        """
+        Return an OrderedDict of stage -> ``{'count', 'total', 'max'}``.
+        """
+        totals = OrderedDict()
+        with self._lock:
+            for timings in self.files.values():
+                for stage, seconds in timings.items():
+                    if stage == 'bytes':
+                        continue
+                    total = totals.setdefault(
+                        stage, {'count': 0, 'total': 0, 'max': 0})
+                    total['count'] += 1
+                    total['total'] += seconds
+                    total['max'] = max(total['max'], seconds)
+        return totals
+
+    def slowest_files(self, limit=None):
+        """
+        Return ``(path, seconds, timings)`` for each file, slowest (over all
+        of its stages) first.
+        """
+        with self._lock:
+            files = [(path, sum(seconds for stage, seconds in timings.items()
+                                if stage != 'bytes'), dict(timings))
+                     for path, timings in self.files.items()]
+        files.sort(key=lambda item: item[1], reverse=True)
+        return files[:limit]
+
+    def slowest_packages(self, limit=None):
+        with self._lock:
+            packages = sorted(self.packages.items(), key=lambda item: item[1],
+                              reverse=True)
+        return packages[:limit]
+
+    def report(self):
+        """
+        Return the whole profile as a JSON-serializable dict.
+        """
+        finished = self.finished or time.time()
+        return OrderedDict((
+            ('started', self.started),
+            ('duration', finished - self.started),
+            ('bytes_sent', self.bytes_sent),
+            ('phases', self.phases),
+            ('stages', self.stage_totals()),
+            ('files', [OrderedDict([('path', path), ('seconds', seconds)] +
+                                   sorted(timings.items()))
+                       for path, seconds, timings in self.slowest_files()]),
+            ('packages', [OrderedDict((('output', output),
+                                       ('seconds', seconds)))
+                          for output, seconds in self.slowest_packages()]),
+            ) + tuple(self.extra.items()))
+
+    def save(self, path):
+        with io.open(path, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(self.report(), indent=2))
+
+    def summary(self, limit=10):
+        """
+        Return the lines of a table summarising the profile, with the
+        ``limit`` slowest files and packages.
+        """
+        finished = self.finished or time.time()
+        duration = finished - self.started
+        lines = ['Deploy took %.2fs' % duration,
+                 '%-24s %10s' % ('Phase', 'Seconds')]
+        lines.extend('%-24s %10.3f' % (name, seconds)
+                     for name, seconds in self.phases.items())
+        lines.append('%-24s %8s %10s %10s' % ('Stage', 'Files', 'Seconds',
+                                             'Slowest'))
+        lines.extend('%-24s %8d %10.3f %10.3f' % (
+            stage, total['count'], total['total'], total['max'])
+            for stage, total in self.stage_totals().items())
+        lines.append('%d bytes sent (%.1f KB/s)' % (
+            self.bytes_sent, self.bytes_sent / 1024.0 / (duration or 1)))
+        slowest_files = self.slowest_files(limit)
+        if slowest_files:
+            lines.append('Slowest files:')
+            lines.extend('%10.3f  %s' % (seconds, path)
+                         for path, seconds, _timings in slowest_files)
+        slowest_packages = self.slowest_packages(limit)
+        if slowest_packages:
+            lines.append('Slowest packages:')
+            lines.extend('%10.3f  %s' % (seconds, output)
+                         for output, seconds in slowest_packages)
+        return lines
+
+
+def merge_reports(reports):
+    """
+    Combine the ``report()``s of the shards of one deploy (see
+    ``deploy_utils.sharding``) into a single report. The shards run side by
+    side, so the deploy took as long as the slowest; phase and stage times
+    are the totals over every shard.
+    """
+    merged = OrderedDict((
+        ('started', min(report['started'] for report in reports)),
+        ('duration', max(report['started'] + report['duration']
+                         for report in reports)),
+        ('bytes_sent', sum(report['bytes_sent'] for report in reports)),
+        ('phases', OrderedDict()),
+        ('stages', OrderedDict()),
+        ('files', []),
+        ('packages', []),
+        ('failed', []),
+        ('shards', []),
+    ))
+    merged['duration'] -= merged['started']
+    for report in reports:
+        for name, seconds in report['phases'].items():
+            merged['phases'][name] = merged['phases'].get(name, 0) + seconds
+        for stage, total in report['stages'].items():
+            merged_total = merged['stages'].setdefault(
+                stage, {'count': 0, 'total': 0, 'max': 0})
+            merged_total['count'] += total['count']
+            merged_total['total'] += total['total']
+            merged_total['max'] = max(merged_total['max'], total['max'])
+        merged['files'].extend(report['files'])
+        merged['packages'].extend(report['packages'])
+        merged['failed'].extend(report.get('failed', ()))
+        merged['shards'].append(OrderedDict((
+            ('shard', report.get('shard')),
+            ('duration', report['duration']),
+            ('bytes_sent', report['bytes_sent']),
+            ('throttle', report.get('throttle')),
+        )))
+    merged['files'].sort(key=lambda timings: timings['seconds'],
+                         reverse=True)
+    merged['packages'].sort(key=lambda package: package['seconds'],
+                            reverse=True)
+    return merged
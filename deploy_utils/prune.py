@@ -0,0 +1,129 @@
+'''
+Finds and deletes the stale hashed copies CachedFilesMixin leaves in the
+static bucket: every deploy saves a new ``name.<hash>.ext`` for each
+changed file, and nothing ever removes the old ones.
+
+Only files the deploy manifest knows about (with the hashed name they were
+last deployed as) are considered. For each one, the last K generations
+(distinct hashes, newest first by modification time in the bucket) are
+kept, along with the one in the manifest, and every other hashed copy is
+stale, along with its precompressed variants.
+'''
+
+from __future__ import unicode_literals
+
+import re
+from collections import namedtuple
+
+from .compress import ENCODING_EXTENSIONS
+from .file_utils import run_in_parallel
+
+
+# S3 accepts at most this many keys in one multi-object delete
+DELETE_BATCH_SIZE = 1000
+
+# ``root.<12 hex digits>.ext``, as built by CachedFilesMixin.hashed_name
+HASHED_NAME_RE = re.compile(
+    r'^(?P<root>.+)\.(?P<hash>[0-9a-f]{12})(?P<ext>\.[^./]+)?$')
+
+StaleKey = namedtuple('StaleKey', ('name', 'size', 'original'))
+
+
+def parse_hashed_name(name, originals):
+    """
+    Return ``(original, file_hash)`` if ``name`` is a hashed copy (or a
+    precompressed variant of one) of one of ``originals``, or ``None``.
+    """
+    candidates = [name]
+    for extension in ENCODING_EXTENSIONS.values():
+        if name.endswith(extension):
+            candidates.append(name[:-len(extension)])
+    for candidate in candidates:
+        match = HASHED_NAME_RE.match(candidate)
+        if match is not None:
+            original = match.group('root') + (match.group('ext') or '')
+            if original in originals:
+                return original, match.group('hash')
+    return None
+
+
+def find_stale_keys(manifest, entries, keep=3, location=''):
+    """
+    Return a ``StaleKey`` for each object in ``entries`` (a dict of key
+    name -> ``InventoryEntry``, e.g. a ``BucketInventory``'s) that is a
+    hashed copy of a file in ``manifest`` older than the last ``keep``
+    generations and not the one in the manifest. ``location`` is the
+    storage's location within the bucket.
+
+    Generations with an object whose modification time isn't known count
+    as the newest, and are never stale.
+    """
+    prefix = location.strip('/') + '/' if location.strip('/') else ''
+    current = {}
+    for name, hashed_name in manifest.hashed_names().items():
+        parsed = parse_hashed_name(hashed_name, (name,))
+        if parsed is not None:
+            current[name] = parsed[1]
+
+    # original -> file hash -> [keys, newest modification time, whether
+    # any of the keys has no modification time]
+    generations = {}
+    for key_name, entry in entries.items():
+        if not key_name.startswith(prefix):
+            continue
+        parsed = parse_hashed_name(key_name[len(prefix):], current)
+        if parsed is None:
+            continue
+        original, file_hash = parsed
+        generation = generations.setdefault(original, {}).setdefault(
+            file_hash, [[], '', False])
+        generation[0].append((key_name, entry.size or 0))
+        if entry.last_modified:
+            generation[1] = max(generation[1], entry.last_modified)
+        else:
+            # Saved since the bucket was last listed
+            generation[2] = True
+
+    stale = []
+    for original, hashes in sorted(generations.items()):
+        newest_first = sorted(hashes, key=lambda file_hash: (
+            hashes[file_hash][2], hashes[file_hash][1]), reverse=True)
+        kept = set(newest_first[:keep])
+        kept.add(current[original])
+        kept.update(file_hash for file_hash in hashes
+                    if hashes[file_hash][2])
+        for file_hash in newest_first:
+            if file_hash not in kept:
+                stale.extend(StaleKey(key_name, size, original)
+                             for key_name, size in hashes[file_hash][0])
+    return stale
+
+
+def delete_keys(storage, key_names, workers=4,
+                batch_size=DELETE_BATCH_SIZE):
+    """
+    Delete ``key_names`` from ``storage``'s bucket with multi-object
+    deletes of ``batch_size`` keys, ``workers`` requests at a time.
+    Yields ``(key_name, error)`` for each key that couldn't be deleted.
+    """
+    batches = [key_names[start:start + batch_size]
+               for start in range(0, len(key_names), batch_size)]
+
+    def delete_batch(batch):
+        def delete():
+            # Each worker thread has its own connection and bucket
+            return storage.bucket.delete_keys(batch, quiet=True)
+        throttle = getattr(storage, 'throttle', None)
+        if throttle is not None:
+            return throttle.call(delete)
+        return delete()
+
+    for batch, result, error in run_in_parallel(delete_batch, batches,
+                                                workers):
+        if error is not None:
+            for key_name in batch:
+                yield key_name, error
+            continue
+        for delete_error in result.errors:
+            yield delete_error.key, '%s: %s' % (delete_error.code,
+                                                delete_error.message)
@@ -0,0 +1,528 @@
+'''
+The S3 storages (boto and django-storages): ``S3StaticStorage`` and
+``S3MediaStorage``, the mixins they are made of, and the storage
+deploystatic uses for ``S3StaticStorage``.
+
+Import them from ``deploy_utils.storage``, which only imports this module
+(and boto) when one of them is first used.
+'''
+
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
+from pipeline.storage import PipelineMixin
+from storages.backends.s3boto import S3BotoStorage
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import CachedFilesMixin, \
+    HashedFilesMixin
+from django.contrib.staticfiles.utils import matches_patterns
+from django.utils.six.moves.urllib.parse import unquote, urldefrag, \
+    urlsplit
+
+from .inventory import BucketInventory, InventoryEntry
+from .manifest import DeployManifest, get_manifest_location
+from .pipelinestorage import DummyPipelineMixin
+from .storage import PrecompressMixin, ReferenceHashMixin
+from .throttle import ThrottleController
+
+
+# This Proxy class is to allow the use of a Fake S3:
+# https://github.com/philroche/fake-s3
+class S3ProxyConnection(S3Connection):
+
+    def __init__(self, *args, **kwargs):
+        if getattr(settings, 'PROXY_S3', False):
+            kwargs['host'] = 'localhost'
+            kwargs['port'] = 4567
+            kwargs['is_secure'] = False
+            kwargs['calling_format'] = \
+                'boto.s3.connection.OrdinaryCallingFormat'
+        super(S3ProxyConnection, self).__init__(*args, **kwargs)
+
+
+class ThreadLocalConnectionMixin(object):
+    """
+    Keep a separate boto connection (and bucket) for each thread.
+
+    boto connections are not safe to share between threads, but each one
+    keeps its own pool of keep-alive HTTP connections. Storing them per
+    thread lets a single storage instance be shared by a pool of upload
+    workers, opening at most one connection per worker rather than one per
+    file.
+    """
+    def _thread_state(self):
+        return self.__dict__.setdefault('_local', threading.local())
+
+    @property
+    def _connection(self):
+        return getattr(self._thread_state(), 'connection', None)
+
+    @_connection.setter
+    def _connection(self, value):
+        self._thread_state().connection = value
+
+    @property
+    def _bucket(self):
+        return getattr(self._thread_state(), 'bucket', None)
+
+    @_bucket.setter
+    def _bucket(self, value):
+        self._thread_state().bucket = value
+
+
+# S3 rejects multipart uploads whose parts (other than the last) are smaller
+# than this.
+MULTIPART_MIN_CHUNK_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUploadMixin(object):
+    """
+    Upload large objects with S3 multipart uploads.
+
+    Content bigger than ``AWS_MULTIPART_THRESHOLD`` bytes is split into
+    ``AWS_MULTIPART_CHUNK_SIZE`` byte parts, ``AWS_MULTIPART_CONCURRENCY`` of
+    which are sent at a time. A failed part is retried on its own (by the
+    storage's ``throttle``, see ``RetryMixin``) before the whole upload is
+    abandoned, when the storage has one. Set ``AWS_MULTIPART_THRESHOLD`` to
+    ``None`` to always use a single PUT.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MultipartUploadMixin, self).__init__(*args, **kwargs)
+        self.multipart_threshold = getattr(
+            settings, 'AWS_MULTIPART_THRESHOLD', 16 * 1024 * 1024)
+        self.multipart_chunk_size = max(
+            getattr(settings, 'AWS_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024),
+            MULTIPART_MIN_CHUNK_SIZE)
+        self.multipart_concurrency = getattr(
+            settings, 'AWS_MULTIPART_CONCURRENCY', 4)
+
+    def _save_content(self, key, content, headers):
+        size = content.size
+        threshold = self.multipart_threshold
+        if threshold is None or size <= threshold:
+            return super(MultipartUploadMixin, self)._save_content(
+                key, content, headers)
+
+        kwargs = {}
+        if self.encryption:
+            kwargs['encrypt_key'] = self.encryption
+        upload = self.bucket.initiate_multipart_upload(
+            key.name, headers=headers, policy=self.default_acl,
+            reduced_redundancy=self.reduced_redundancy, **kwargs)
+
+        read_lock = threading.Lock()
+
+        def upload_part(part_num):
+            # Each part is only read once a worker is free to send it, so at
+            # most ``multipart_concurrency`` parts are held in memory.
+            with read_lock:
+                content.seek((part_num - 1) * self.multipart_chunk_size)
+                data = content.read(self.multipart_chunk_size)
+            self._upload_part(upload.id, upload.key_name, part_num, data)
+
+        part_count = (size + self.multipart_chunk_size - 1) // \
+            self.multipart_chunk_size
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=self.multipart_concurrency) as executor:
+                list(executor.map(upload_part, range(1, part_count + 1)))
+        except Exception:
+            upload.cancel_upload()
+            raise
+        completed = upload.complete_upload()
+        key.etag = getattr(completed, 'etag', None)
+
+    def _upload_part(self, upload_id, key_name, part_num, data):
+        def send_part():
+            # Rebuild the upload against this thread's own bucket and
+            # connection.
+            upload = MultiPartUpload(self.bucket)
+            upload.id = upload_id
+            upload.key_name = key_name
+            upload.upload_part_from_file(BytesIO(data), part_num)
+        throttle = getattr(self, 'throttle', None)
+        if throttle is None:
+            send_part()
+        else:
+            # The upload as a whole already holds a slot
+            throttle.retry(send_part)
+
+
+class RetryMixin(object):
+    """
+    Send requests to S3 through a ``ThrottleController``, so throttling
+    (``503 SlowDown``), server errors, timeouts and reset connections are
+    retried with jittered backoff, and the number of requests in flight
+    backs off while S3 is throttling.
+
+    boto's own retries are turned off on each connection, so that
+    throttling reaches the controller rather than being retried blindly.
+    Only the storages deploystatic uses have it; at runtime boto's retries
+    are left alone.
+    """
+    def __init__(self, *args, **kwargs):
+        super(RetryMixin, self).__init__(*args, **kwargs)
+        self.throttle = ThrottleController.from_settings()
+
+    @property
+    def connection(self):
+        connection = super(RetryMixin, self).connection
+        connection.num_retries = 0
+        return connection
+
+    def _save(self, name, content):
+        # S3BotoStorage gzips the content by swapping out its file, which a
+        # retry mustn't gzip again
+        original_file = getattr(content, 'file', None)
+
+        def save():
+            if original_file is not None:
+                content.file = original_file
+            content.seek(0)
+            return super(RetryMixin, self)._save(name, content)
+        return self.throttle.call(save)
+
+    def _open(self, name, mode='rb'):
+        def open_file():
+            s3_file = super(RetryMixin, self)._open(name, mode)
+            if 'r' in mode:
+                # Download now rather than on first read, so a failed
+                # download is retried too
+                s3_file.file
+            return s3_file
+        return self.throttle.call(open_file)
+
+    def _get_key(self, name):
+        return self.throttle.call(super(RetryMixin, self)._get_key, name)
+
+    def exists(self, name):
+        return self.throttle.call(super(RetryMixin, self).exists, name)
+
+    def delete(self, name):
+        return self.throttle.call(super(RetryMixin, self).delete, name)
+
+    def listdir(self, name):
+        return self.throttle.call(super(RetryMixin, self).listdir, name)
+
+
+class InventoryMixin(object):
+    """
+    Answer ``exists`` and ``size`` from a ``BucketInventory`` of the bucket,
+    once ``load_inventory`` has been called, instead of sending a HEAD
+    request per file.
+
+    When used with CachedFilesMixin (listed before it), hashed names of
+    files that aren't being processed are worked out from the ETag in the
+    inventory rather than by downloading and hashing the file.
+    """
+    inventory = None
+
+    def load_inventory(self, cache_path=None, refresh=False):
+        """
+        Build the inventory, from ``cache_path`` if it holds a cached copy
+        (unless ``refresh`` is set) or else by listing the bucket.
+        """
+        inventory = BucketInventory(cache_path)
+        if refresh or not inventory.load():
+            inventory.refresh(self.bucket, prefix=self.location)
+        self.inventory = inventory
+        return inventory
+
+    def _inventory_name(self, name):
+        return self._normalize_name(self._clean_name(name))
+
+    def is_unchanged(self, name, md5, post_process=True):
+        """
+        Return whether the inventory shows ``name`` is already stored with
+        content matching ``md5`` (and, for CachedFilesMixin storages, that
+        its hashed copy exists too, unless it isn't ``post_process``ed and
+        so has none).
+        """
+        if self.inventory is None or self.inventory.is_changed(
+                self._inventory_name(name), md5):
+            return False
+        if post_process and isinstance(self, CachedFilesMixin):
+            return self.inventory.exists(
+                self._inventory_name(self.hashed_name(name)))
+        return True
+
+    def exists(self, name):
+        if self.inventory is None:
+            return super(InventoryMixin, self).exists(name)
+        return self.inventory.exists(self._inventory_name(name))
+
+    def size(self, name):
+        if self.inventory is None:
+            return super(InventoryMixin, self).size(name)
+        return self.inventory.size(self._inventory_name(name))
+
+    def delete(self, name):
+        super(InventoryMixin, self).delete(name)
+        if self.inventory is not None:
+            self.inventory.invalidate(self._inventory_name(name))
+
+    def _save_content(self, key, content, headers):
+        super(InventoryMixin, self)._save_content(key, content, headers)
+        if self.inventory is not None:
+            # In the format S3 lists objects' modification times in
+            self.inventory.record(
+                key.name, getattr(key, 'etag', None), content.size,
+                time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()))
+
+    def hashed_name(self, name, content=None, *args, **kwargs):
+        # Gzipped objects' ETags are the checksum of the compressed bytes,
+        # which isn't what CachedFilesMixin hashes, and the names of files
+        # it adjusts may depend on their rewritten content (see
+        # ReferenceHashMixin).
+        clean_name = urlsplit(unquote(name)).path.strip()
+        if (content is None and self.inventory is not None and
+                not getattr(self, 'gzip', False) and
+                not matches_patterns(clean_name,
+                                     getattr(self, '_patterns', {}).keys())):
+            entry = self.inventory.get(self._inventory_name(clean_name))
+            if entry is not None and entry.md5:
+                content = entry
+        return super(InventoryMixin, self).hashed_name(
+            name, content, *args, **kwargs)
+
+    def file_hash(self, name, content=None):
+        if isinstance(content, InventoryEntry):
+            # CachedFilesMixin uses the first 12 characters of the md5
+            return content.md5[:12]
+        return super(InventoryMixin, self).file_hash(name, content)
+
+
+class SignedURLCacheMixin(object):
+    """
+    Cache the URLs ``url()`` returns, since with ``AWS_QUERYSTRING_AUTH``
+    each one is signed with an HMAC.
+
+    Time is split into windows of ``AWS_URL_CACHE_TTL`` seconds (by default
+    a quarter of ``AWS_QUERYSTRING_EXPIRE``, and never more than half of
+    it), and URLs are cached by name and window. A URL signed during a
+    window is only handed out until the window ends, so it is always valid
+    for at least ``querystring_expire - ttl`` more seconds. At most
+    ``AWS_URL_CACHE_SIZE`` URLs are kept, least recently used evicted first.
+    Setting either to 0 turns the cache off.
+
+    ``url_cache_stats`` counts the hits, misses and evictions.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SignedURLCacheMixin, self).__init__(*args, **kwargs)
+        ttl = getattr(settings, 'AWS_URL_CACHE_TTL', None)
+        if ttl is None:
+            ttl = self.querystring_expire / 4.0
+        self.url_cache_ttl = min(ttl, self.querystring_expire / 2.0)
+        self.url_cache_size = getattr(settings, 'AWS_URL_CACHE_SIZE', 2048)
+        self.url_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._signed_url_cache = OrderedDict()
+        self._signed_url_cache_lock = threading.Lock()
+
+    def url(self, name, headers=None, response_headers=None, expire=None):
+        if headers or response_headers or expire is not None or \
+                not self.url_cache_ttl or not self.url_cache_size:
+            kwargs = {}
+            if expire is not None:
+                # Only later versions of django-storages take an expiry
+                kwargs['expire'] = expire
+            return super(SignedURLCacheMixin, self).url(
+                name, headers, response_headers, **kwargs)
+
+        key = (name, int(time.time() // self.url_cache_ttl))
+        with self._signed_url_cache_lock:
+            url = self._signed_url_cache.pop(key, None)
+            if url is not None:
+                # Back at the end, so the least recently used URL is
+                # evicted first.
+                self._signed_url_cache[key] = url
+                self.url_cache_stats['hits'] += 1
+                return url
+            self.url_cache_stats['misses'] += 1
+
+        url = super(SignedURLCacheMixin, self).url(name)
+
+        with self._signed_url_cache_lock:
+            self._signed_url_cache[key] = url
+            while len(self._signed_url_cache) > self.url_cache_size:
+                self._signed_url_cache.popitem(last=False)
+                self.url_cache_stats['evictions'] += 1
+        return url
+
+    def clear_url_cache(self):
+        with self._signed_url_cache_lock:
+            self._signed_url_cache.clear()
+
+
+class PooledS3BotoStorage(MultipartUploadMixin, ThreadLocalConnectionMixin,
+                          S3BotoStorage):
+    pass
+
+
+# Marks names that aren't in a cache
+MISSING = object()
+
+
+class S3PipelineCachedStorage(PipelineMixin, InventoryMixin,
+                              ReferenceHashMixin, CachedFilesMixin,
+                              PooledS3BotoStorage):
+    """
+    ``url()`` looks hashed names up in the deploy manifest written by
+    deploystatic, so rendering a ``{% static %}`` tag doesn't touch the
+    cache backend or S3. The URL itself is built (and, with
+    ``AWS_QUERYSTRING_AUTH``, signed) on every call, so it never outlives
+    its signature.
+
+    Only the copy of the manifest in the bucket (``DEPLOY_MANIFEST_NAME``)
+    is read. Its ETag is checked at most every ``DEPLOY_MANIFEST_TTL``
+    seconds, and when a deploy has replaced it the manifest is reloaded.
+    Names the manifest doesn't have are hashed by CachedFilesMixin (from
+    the cache backend, or else from the file in the bucket) and the
+    outcome, including that the file doesn't exist, is kept in an LRU of
+    ``DEPLOY_URL_CACHE_SIZE`` names until the manifest is reloaded.
+    """
+    def __init__(self, *args, **kwargs):
+        super(S3PipelineCachedStorage, self).__init__(*args, **kwargs)
+        self._manifest_hashed_names = None
+        self._manifest_etag = None
+        self._manifest_expires = 0
+        self._manifest_ttl = getattr(settings, 'DEPLOY_MANIFEST_TTL', 60)
+        self._manifest_lock = threading.Lock()
+        self._fallback_names = OrderedDict()
+        self._fallback_names_size = getattr(settings, 'DEPLOY_URL_CACHE_SIZE',
+                                            2048)
+        self._fallback_names_lock = threading.Lock()
+
+    def get_manifest_etag(self, name):
+        key = self.bucket.get_key(self._encode_name(
+            self._normalize_name(self._clean_name(name))))
+        return key.etag if key is not None else None
+
+    def get_manifest_hashed_names(self):
+        """
+        Return the manifest's mapping of name to hashed name, reloading it
+        if the copy in the bucket has changed since it was last checked more
+        than ``DEPLOY_MANIFEST_TTL`` seconds ago.
+        """
+        with self._manifest_lock:
+            now = time.time()
+            if self._manifest_hashed_names is not None and \
+                    now < self._manifest_expires:
+                return self._manifest_hashed_names
+            self._manifest_expires = now + self._manifest_ttl
+            name = get_manifest_location()[1]
+            etag = self.get_manifest_etag(name) if name else None
+            if self._manifest_hashed_names is None or \
+                    etag != self._manifest_etag:
+                if etag is None:
+                    hashed_names = {}
+                else:
+                    hashed_names = DeployManifest.load(
+                        self, local=False).hashed_names()
+                self._manifest_etag = etag
+                self._manifest_hashed_names = hashed_names
+                with self._fallback_names_lock:
+                    self._fallback_names.clear()
+            return self._manifest_hashed_names
+
+    def stored_name(self, name):
+        hashed_names = self.get_manifest_hashed_names()
+        hashed_name = hashed_names.get(name)
+        if hashed_name is not None:
+            return hashed_name
+
+        with self._fallback_names_lock:
+            hashed_name = self._fallback_names.pop(name, MISSING)
+            if hashed_name is not MISSING:
+                # Back at the end, so the least recently used name is
+                # evicted first.
+                self._fallback_names[name] = hashed_name
+        if hashed_name is MISSING:
+            try:
+                hashed_name = super(S3PipelineCachedStorage,
+                                    self).stored_name(name)
+            except ValueError:
+                # Not in the bucket; remembered, so every call for it
+                # doesn't send another HEAD request
+                hashed_name = None
+            with self._fallback_names_lock:
+                # Unless the manifest was reloaded (and the LRU emptied)
+                # since this name was looked up
+                if hashed_names is self._manifest_hashed_names:
+                    self._fallback_names[name] = hashed_name
+                    while len(self._fallback_names) > \
+                            self._fallback_names_size:
+                        self._fallback_names.popitem(last=False)
+        if hashed_name is None:
+            raise ValueError("The file '%s' could not be found with %r." % (
+                name, self))
+        return hashed_name
+
+    def url(self, name, force=False):
+        # Hashed names come from the manifest even with DEBUG on
+        clean_name, fragment = urldefrag(name)
+        if fragment or '?' in clean_name or clean_name.endswith('/'):
+            return super(S3PipelineCachedStorage, self).url(name, True)
+        # HashedFilesMixin.url unquotes the URL, and with it the signature
+        return super(HashedFilesMixin, self).url(self.stored_name(name))
+
+
+class S3PipelineStorage(PipelineMixin, PooledS3BotoStorage):
+    pass
+
+
+# Django-storages can only use one S3 bucket, and has been resistant to using
+# more than one bucket (cf.
+# https://bitbucket.org/david/django-storages/issue/93/s3boto-seperate-buckets-for-static-and
+# )
+# So instead 'subclass' the S3BotoStorage to pass in the configured settings.
+# The developer of django storages recommends this sort of approach.
+#
+# Copied from this https://gist.github.com/antonagestam/6075199
+class S3StaticStorage(S3PipelineCachedStorage):
+    def __init__(self, *args, **kwargs):
+        kwargs['bucket'] = settings.AWS_STATIC_BUCKET_NAME
+        kwargs['connection_class'] = S3ProxyConnection
+        if (getattr(settings, 'CLOUDFRONT_ENABLED', False) and
+            getattr(settings, 'CLOUDFRONT_CUSTOM_STATIC_DOMAIN', None)):
+            kwargs['custom_domain'] = settings.CLOUDFRONT_CUSTOM_STATIC_DOMAIN
+        super(S3StaticStorage, self).__init__(*args, **kwargs)
+
+
+# Django-storages S3BotoStorage will overwrite the filename (cf.
+# settings.AWS_S3_FILE_OVERWRITE)
+class S3MediaStorage(SignedURLCacheMixin, S3PipelineStorage):
+    def __init__(self, *args, **kwargs):
+        kwargs['bucket'] = settings.AWS_MEDIA_BUCKET_NAME
+        kwargs['connection_class'] = S3ProxyConnection
+        if (getattr(settings, 'CLOUDFRONT_ENABLED', False) and
+            getattr(settings, 'CLOUDFRONT_CUSTOM_MEDIA_DOMAIN', None)):
+            kwargs['custom_domain'] = settings.CLOUDFRONT_CUSTOM_MEDIA_DOMAIN
+        super(S3MediaStorage, self).__init__(*args, **kwargs)
+
+
+# May be necessary to put this arg in as well (&static aswell):
+# see gist above
+# custom_domain=settings.AWS_MEDIA_CUSTOM_DOMAIN)
+
+
+class DummyS3PipelineCachedStorage(PrecompressMixin,
+                                   DummyPipelineMixin,
+                                   InventoryMixin,
+                                   ReferenceHashMixin,
+                                   CachedFilesMixin,
+                                   RetryMixin,
+                                   PooledS3BotoStorage):
+    pass
+
+
+DummyS3StaticStorage = lambda: DummyS3PipelineCachedStorage(
+    bucket=settings.AWS_STATIC_BUCKET_NAME,
+    connection_class=S3ProxyConnection,
+)
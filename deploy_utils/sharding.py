@@ -0,0 +1,80 @@
+'''
+Splits a deploy between several deploystatic processes (e.g. one per CI
+runner), each run with ``--shard=i/N``, and then merged with
+``python manage.py mergedeployshards --shards=N``.
+
+Every shard discovers the whole change set, but only deploys the static
+files whose relative path hashes to it, and only packs (and hashes) the
+pipeline packages whose output filename hashes to it. So every file and
+every package is handled by exactly one shard, whichever runner it runs
+on. Packages are packed from the local copies of their sources, which
+other shards may not have uploaded yet. Each shard saves the manifest
+entries it recorded (and its report) under its own name, which the merge
+step combines. Since the runners don't share a filesystem, only the copy
+of the manifest in storage (``DEPLOY_MANIFEST_NAME``, which sharded
+deploys require) is used.
+'''
+
+from __future__ import unicode_literals
+
+import hashlib
+import re
+
+
+SHARD_RE = re.compile(r'^\s*(\d+)\s*/\s*(\d+)\s*$')
+
+
+def shard_index(name, count):
+    """
+    Return which of ``count`` shards (numbered from 1) ``name`` belongs
+    to. Based on the md5 of the name, so it's the same for every process
+    and Python version, unlike ``hash()``.
+    """
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    digest = hashlib.md5(name.replace('\\', '/').encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % count + 1
+
+
+class Shard(object):
+    """
+    Shard ``index`` (from 1) of ``count``.
+    """
+    def __init__(self, index, count):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError('There is no shard %d of %d' % (index, count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parse an ``i/N`` shard, e.g. ``2/4``.
+        """
+        match = SHARD_RE.match(value or '')
+        if match is None:
+            raise ValueError('%r is not a shard; use i/N, e.g. 2/4' % value)
+        return cls(int(match.group(1)), int(match.group(2)))
+
+    @property
+    def suffix(self):
+        return '.%d-of-%d' % (self.index, self.count)
+
+    def path(self, path):
+        """
+        Return ``path`` (a file or storage name, or None) named for this
+        shard.
+        """
+        if not path:
+            return path
+        return path + self.suffix
+
+    def owns(self, name):
+        return shard_index(name, self.count) == self.index
+
+    def __str__(self):
+        return '%d/%d' % (self.index, self.count)
+
+
+def all_shards(count):
+    return [Shard(index, count) for index in range(1, count + 1)]
@@ -4,28 +4,67 @@ Created on 1 Jul 2016
 @author: James Bailey
 '''
 
+import errno
+import fnmatch
+import importlib
 import os
 import logging
-
-from boto.s3.connection import S3Connection
-from pipeline.storage import PipelineMixin
-from pipeline.packager import Packager
-from storages.backends.s3boto import S3BotoStorage
-
-from collections import OrderedDict
-
+import re
+import stat
+import sys
+import threading
+import types
+import uuid
+
+import django
+from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage, get_storage_class
 from django.conf import settings
-from django.contrib.staticfiles.storage import CachedFilesMixin, \
-    CachedStaticFilesStorage, StaticFilesStorage
 from django.contrib.staticfiles.finders import AppDirectoriesFinder, \
-    FileSystemFinder
+    FileSystemFinder, get_finders
 from django.contrib.staticfiles.utils import matches_patterns
 from django.utils import six
+from django.utils.encoding import force_bytes, force_text
 from django.utils.text import slugify
 from django.utils.functional import LazyObject
 
 
+# The S3 and pipeline storages (and their mixins) live in modules of their
+# own, so using this module (e.g. for OverwriteFilesystemStorage) doesn't
+# import boto, django-storages and django-pipeline. They are still
+# importable from here, and are imported on first use; see __getattr__.
+LAZY_ATTRIBUTES = dict(
+    [(name, 'deploy_utils.s3storage') for name in (
+        'S3ProxyConnection', 'ThreadLocalConnectionMixin',
+        'MULTIPART_MIN_CHUNK_SIZE', 'MultipartUploadMixin', 'RetryMixin',
+        'InventoryMixin', 'SignedURLCacheMixin', 'PooledS3BotoStorage',
+        'S3PipelineCachedStorage', 'S3PipelineStorage', 'S3StaticStorage',
+        'S3MediaStorage', 'DummyS3PipelineCachedStorage',
+        'DummyS3StaticStorage')] +
+    [(name, 'deploy_utils.pipelinestorage') for name in (
+        'DummyPipelineMixin', 'DummyPipelineStorage',
+        'DummyPipelineCachedStorage')])
+
+
+def __getattr__(name):
+    """
+    Import the module ``name`` (one of ``LAZY_ATTRIBUTES``) lives in the
+    first time it is used (PEP 562 on Python 3.7 and later, see
+    ``LazyModule`` before that).
+    """
+    module_name = LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError('module %r has no attribute %r' % (
+            __name__, name))
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES))
+
+
 def cleanfilename(filename):
     """
     Make sure filenames only contain a-z characters.
@@ -44,10 +83,14 @@ class OverwriteFilesystemStorage(FileSystemStorage):
     Default django behaviour is to append an underscore to the uploaded
     filename if it exists. We want to be able to force a filename on upload.
 
-    Note that this implementation is both stupid and naive in that it doesn't
-    log any messages to let you know it's overwritten an existing file. It also
-    ignores any potential race conditions that arise when more than 1 user
-    tries to access the same file.
+    Each file is written to a temporary file in the same directory and then
+    renamed over the target, so readers see either the old file or the new
+    one, never a partly written one. Content that is already a file on disk
+    is copied by the kernel (see ``copy_content``).
+
+    Note that this implementation doesn't log any messages to let you know
+    it's overwritten an existing file: when more than 1 user saves the same
+    file, the last one to finish wins.
     """
     def _save(self, name, content):
         full_path = self.path(name)
@@ -59,13 +102,23 @@ class OverwriteFilesystemStorage(FileSystemStorage):
         elif not os.path.isdir(directory):
             raise IOError("%s exists and is not a directory." % directory)
 
-        fp = open(full_path, 'wb')
-        for chunk in content.chunks():
-            fp.write(chunk)
-        fp.close()
-
-        if settings.FILE_UPLOAD_PERMISSIONS is not None:
-            os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
+        # Hidden, and unique so concurrent saves of the same name don't
+        # share a temporary file. Created with the same mode (after the
+        # umask) as a plain open() would use.
+        temp_path = os.path.join(directory, '.%s.%s.tmp' % (
+            os.path.basename(full_path), uuid.uuid4().hex))
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                copy_content(content, fp)
+            if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                os.chmod(temp_path, settings.FILE_UPLOAD_PERMISSIONS)
+            replace_file(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
         return name
 
@@ -73,62 +126,106 @@ class OverwriteFilesystemStorage(FileSystemStorage):
         return name
 
 
-# This Proxy class is to allow the use of a Fake S3:
-# https://github.com/philroche/fake-s3
-class S3ProxyConnection(S3Connection):
+# os.replace overwrites the target on Windows too, but is only in Python 3.3
+# and later; os.rename does on POSIX.
+replace_file = getattr(os, 'replace', os.rename)
+
+# Errors meaning a kernel copy isn't supported between these two files (e.g.
+# across filesystems, or sendfile to a regular file on macOS), rather than
+# that the copy failed. ENOTSUP is EOPNOTSUPP on most platforms.
+KERNEL_COPY_ERRNOS = frozenset(
+    getattr(errno, name) for name in (
+        'EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTSOCK')
+    if hasattr(errno, name))
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
 
-    def __init__(self, *args, **kwargs):
-        if getattr(settings, 'PROXY_S3', False):
-            kwargs['host'] = 'localhost'
-            kwargs['port'] = 4567
-            kwargs['is_secure'] = False
-            kwargs['calling_format'] = \
-                'boto.s3.connection.OrdinaryCallingFormat'
-        super(S3ProxyConnection, self).__init__(*args, **kwargs)
 
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
 
-class S3PipelineCachedStorage(PipelineMixin, CachedFilesMixin, S3BotoStorage):
-    def url(self, name, force=False):
-        return super().url(name, True)
 
+# Tried in order, each one carrying on from where the previous one stopped.
+KERNEL_COPIES = tuple(copy for name, copy in (
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+    ) if hasattr(os, name))
 
-class S3PipelineStorage(PipelineMixin, S3BotoStorage):
-    pass
 
+def local_fileno(content):
+    """
+    Return the file descriptor of the regular file on disk behind
+    ``content``, or None if it is held in memory (or isn't a regular file).
+    """
+    try:
+        fd = content.fileno()
+    except (AttributeError, ValueError, IOError, OSError):
+        # Including io.UnsupportedOperation, from BytesIO
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
 
-# Django-storages can only use one S3 bucket, and has been resistant to using
-# more than one bucket (cf.
-# https://bitbucket.org/david/django-storages/issue/93/s3boto-seperate-buckets-for-static-and
-# )
-# So instead 'subclass' the S3BotoStorage to pass in the configured settings.
-# The developer of django storages recommends this sort of approach.
-#
-# Copied from this https://gist.github.com/antonagestam/6075199
-class S3StaticStorage(S3PipelineCachedStorage):
-    def __init__(self, *args, **kwargs):
-        kwargs['bucket'] = settings.AWS_STATIC_BUCKET_NAME
-        kwargs['connection_class'] = S3ProxyConnection
-        if (getattr(settings, 'CLOUDFRONT_ENABLED', False) and
-            getattr(settings, 'CLOUDFRONT_CUSTOM_STATIC_DOMAIN', None)):
-            kwargs['custom_domain'] = settings.CLOUDFRONT_CUSTOM_STATIC_DOMAIN
-        super(S3StaticStorage, self).__init__(*args, **kwargs)
+
+def local_path(content):
+    """
+    Return the path of the regular file on disk behind ``content``, or None
+    if it is held in memory (or its path isn't known).
+    """
+    if local_fileno(content) is None:
+        return None
+    path = getattr(getattr(content, 'file', content), 'name', None)
+    if isinstance(path, six.string_types) and os.path.isfile(path):
+        return path
+    return None
 
 
-# Django-storages S3BotoStorage will overwrite the filename (cf.
-# settings.AWS_S3_FILE_OVERWRITE)
-class S3MediaStorage(S3PipelineStorage):
-    def __init__(self, *args, **kwargs):
-        kwargs['bucket'] = settings.AWS_MEDIA_BUCKET_NAME
-        kwargs['connection_class'] = S3ProxyConnection
-        if (getattr(settings, 'CLOUDFRONT_ENABLED', False) and
-            getattr(settings, 'CLOUDFRONT_CUSTOM_MEDIA_DOMAIN', None)):
-            kwargs['custom_domain'] = settings.CLOUDFRONT_CUSTOM_MEDIA_DOMAIN
-        super(S3MediaStorage, self).__init__(*args, **kwargs)
+def kernel_copy(in_fd, out_fd, size):
+    """
+    Copy the first ``size`` bytes of ``in_fd`` to ``out_fd`` (from its
+    current position) inside the kernel, with ``copy_file_range`` or else
+    ``sendfile``. The position of ``in_fd`` is left alone. Returns how many
+    bytes were copied, which is less than ``size`` when neither is
+    available for these files.
+    """
+    copied = 0
+    for copy in KERNEL_COPIES:
+        try:
+            while copied < size:
+                sent = copy(in_fd, out_fd, copied, size - copied)
+                if not sent:
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_ERRNOS:
+                raise
+            continue
+        break
+    return copied
 
 
-# May be necessary to put this arg in as well (&static aswell):
-# see gist above
-# custom_domain=settings.AWS_MEDIA_CUSTOM_DOMAIN)
+def copy_content(content, fp):
+    """
+    Write all of ``content`` (a django ``File``) to ``fp``, a file opened
+    for writing. When ``content`` is a file on disk the bytes are copied by
+    the kernel without passing through Python, falling back to copying it
+    in chunks.
+    """
+    in_fd = local_fileno(content)
+    copied = 0
+    if in_fd is not None:
+        fp.flush()
+        copied = kernel_copy(in_fd, fp.fileno(), os.fstat(in_fd).st_size)
+    if not copied:
+        for chunk in content.chunks():
+            fp.write(chunk)
+    else:
+        content.seek(copied)
+        for chunk in iter(lambda: content.read(content.DEFAULT_CHUNK_SIZE),
+                          b''):
+            fp.write(chunk)
 
 
 """
@@ -145,6 +242,12 @@ def get_files(storage, ignore_patterns=None, location=''):
     """
     if ignore_patterns is None:
         ignore_patterns = []
+    if isinstance(storage, FileSystemStorage) and hasattr(os, 'scandir'):
+        for fn in get_local_files(storage.path(location),
+                                  compile_patterns(ignore_patterns),
+                                  location):
+            yield fn
+        return
     directories, files = storage.listdir(location)
     for fn in files:
         if matches_patterns(fn, ignore_patterns) or (
@@ -165,6 +268,50 @@ def get_files(storage, ignore_patterns=None, location=''):
             yield fn
 
 
+_compiled_patterns = {}
+
+
+def compile_patterns(patterns):
+    """
+    Compile a list of glob ``patterns`` into a single regex that matches
+    the same (case-sensitive) names as ``matches_patterns``, or ``None``
+    if there are no patterns.
+    """
+    key = tuple(patterns)
+    if key not in _compiled_patterns:
+        regex = None
+        if patterns:
+            regex = re.compile('|'.join(
+                '(?:%s)' % fnmatch.translate(pattern) for pattern in patterns))
+        _compiled_patterns[key] = regex
+    return _compiled_patterns[key]
+
+
+def get_local_files(path, ignore_regex, location=''):
+    """
+    Like ``get_files`` for a directory on the local filesystem, listing
+    it with ``os.scandir`` and skipping ignored directories without
+    descending into them.
+    """
+    files = []
+    directories = []
+    for entry in os.scandir(path):
+        name = entry.name
+        rel_path = os.path.join(location, name) if location else name
+        if ignore_regex is not None and (ignore_regex.match(name) or (
+                location and ignore_regex.match(rel_path))):
+            continue
+        if entry.is_dir():
+            directories.append((entry.path, rel_path))
+        else:
+            files.append(rel_path)
+    for fn in files:
+        yield fn
+    for dir_path, rel_path in directories:
+        for fn in get_local_files(dir_path, ignore_regex, rel_path):
+            yield fn
+
+
 class AppDirectoriesFinder(AppDirectoriesFinder):
     """
     Like AppDirectoriesFinder, but doesn't return any additional ignored
@@ -194,60 +341,141 @@ class FileSystemFinder(FileSystemFinder):
                 yield path, storage
 
 
-class DummyPipelineMixin(PipelineMixin):
-
-    def post_process(self, paths, dry_run=False, **options):
-        if dry_run:
-            return
-
-        packager = Packager(storage=self)
-        for _abs_path, rel_path in paths:
-            files_to_process = OrderedDict()
-            files_to_process[rel_path] = (self, rel_path)
-            for package_name in packager.packages['css']:
-                package = packager.package_for('css', package_name)
-                output_file = package.output_filename
-
-                if rel_path in package.paths:
-                    if self.packing:
-                        packager.pack_stylesheets(package)
-                    files_to_process[output_file] = (self, output_file)
-                    yield output_file, output_file, True
-            for package_name in packager.packages['js']:
-                package = packager.package_for('js', package_name)
-                output_file = package.output_filename
-                if rel_path in package.paths:
-                    if self.packing:
-                        packager.pack_javascripts(package)
-                    files_to_process[output_file] = (self, output_file)
-                    yield output_file, output_file, True
-
-            super_class = super(PipelineMixin, self)
-
-            if hasattr(super_class, 'post_process'):
-                for name, hashed_name, processed in super_class.post_process(
-                        files_to_process.copy(), dry_run, **options):
-                    yield name, hashed_name, processed
-
+class StaticPathIndex(object):
+    """
+    Map absolute file paths to their relative static path and the finder
+    storage they belong to.
+
+    The root directory of every storage of every configured finder is
+    collected once up front. Classifying a file is then a dictionary lookup
+    per parent directory, with no filesystem access, and only whole
+    directory names can match (so ``/static`` never matches a file under
+    ``/static-old``).
+    """
+    def __init__(self, finders=None):
+        if finders is None:
+            finders = get_finders()
+        self.roots = {}
+        for finder in finders:
+            # Finders that don't keep per-location storages (e.g. pipeline's
+            # own finders) only ever find collected or packaged files, never
+            # sources from the working copy.
+            for storage in six.itervalues(getattr(finder, 'storages', {})):
+                location = getattr(storage, 'location', None)
+                if location:
+                    root = os.path.abspath(os.path.normpath(location))
+                    self.roots.setdefault(root, storage)
+
+    def find(self, abs_path):
+        """
+        Return ``(rel_path, storage)`` for ``abs_path``, or ``(None, None)``
+        if it isn't under any static root.
+        """
+        abs_path = os.path.abspath(abs_path)
+        directory = os.path.dirname(abs_path)
+        while True:
+            storage = self.roots.get(directory)
+            if storage is not None:
+                rel_path = os.path.relpath(abs_path, directory)
+                prefix = getattr(storage, 'prefix', None)
+                if prefix:
+                    rel_path = os.path.join(prefix, rel_path)
+                return rel_path, storage
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None, None
+            directory = parent
+
+
+class PrecompressMixin(object):
+    """
+    Hand every file saved to the storage to ``precompressor`` (a
+    ``deploy_utils.compress.Precompressor``), when one is set, so that
+    precompressed variants are saved alongside it.
 
-class DummyS3PipelineCachedStorage(DummyPipelineMixin,
-                                   CachedFilesMixin,
-                                   S3BotoStorage):
-    pass
+    Files on disk are handed over by path, and only read by the process
+    that compresses them. Other content is read into memory first, if it
+    isn't too big (see ``Precompressor.fits``).
 
+    S3BotoStorage saves each variant (content with a ``content_encoding``)
+    with that ``Content-Encoding``, and doesn't gzip it again when
+    ``AWS_IS_GZIPPED`` is on.
+    """
+    precompressor = None
 
-class DummyPipelineStorage(DummyPipelineMixin, StaticFilesStorage):
-    pass
+    def _save(self, name, content):
+        precompressor = self.precompressor
+        path = data = None
+        if precompressor is not None and precompressor.wants(name):
+            path = local_path(content)
+            if path is None and precompressor.fits(content.size):
+                # Read first, as S3BotoStorage gzips the content in place
+                content.seek(0)
+                data = content.read()
+        name = super(PrecompressMixin, self)._save(name, content)
+        if path is not None or data is not None:
+            precompressor.submit(name, data, path=path)
+        return name
 
+    def _compress_content(self, content):
+        if getattr(content, 'content_encoding', None):
+            return content
+        return super(PrecompressMixin, self)._compress_content(content)
 
-class DummyPipelineCachedStorage(DummyPipelineMixin, CachedStaticFilesStorage):
-    pass
+    def _save_content(self, key, content, headers):
+        encoding = getattr(content, 'content_encoding', None)
+        if encoding:
+            headers = dict(headers, **{'Content-Encoding': encoding})
+        return super(PrecompressMixin, self)._save_content(key, content,
+                                                           headers)
 
 
-DummyS3StaticStorage = lambda: DummyS3PipelineCachedStorage(
-    bucket=settings.AWS_STATIC_BUCKET_NAME,
-    connection_class=S3ProxyConnection,
-)
+class ReferenceHashMixin(object):
+    """
+    Name the files CachedFilesMixin adjusts (stylesheets) after their
+    content with the references to other files already rewritten to hashed
+    names, rather than after their original content.
+
+    Before Django 1.11 a stylesheet whose own content hasn't changed keeps
+    its hashed name when a file it references changes, so the rewritten
+    stylesheet overwrites the old one under a URL that is meant to be
+    immutable (and cached as such). Folding the referenced files' hashes
+    into the name gives it a new one instead. Django 1.11 and later already
+    do this, so there the mixin does nothing.
+
+    List it before CachedFilesMixin.
+    """
+    hash_references = django.VERSION < (1, 11)
+    _hashing = threading.local()
+
+    def file_hash(self, name, content=None):
+        hashing = self._hashing.__dict__.setdefault('names', set())
+        if (not self.hash_references or content is None or name in hashing or
+                not matches_patterns(name, self._patterns.keys())):
+            return super(ReferenceHashMixin, self).file_hash(name, content)
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        data = content.read()
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        text = force_text(data, settings.FILE_CHARSET)
+        # A stylesheet that (indirectly) references itself is hashed as it
+        # is where it does.
+        hashing.add(name)
+        try:
+            for patterns in self._patterns.values():
+                for pattern, template in patterns:
+                    text = pattern.sub(self.url_converter(name, template),
+                                       text)
+        except ValueError:
+            # A reference that can't be found; post_process reports it
+            text = None
+        finally:
+            hashing.discard(name)
+        if text is not None:
+            data = force_bytes(text)
+        return super(ReferenceHashMixin, self).file_hash(
+            name, ContentFile(data))
 
 
 class DummyStorage(LazyObject):
@@ -263,4 +491,23 @@ class DummyStorage(LazyObject):
         self._wrapped = get_storage_class(dummyStorage)()
 
 
-
+if sys.version_info < (3, 7):
+    class LazyModule(types.ModuleType):
+        """
+        Before PEP 562 a module's own ``__getattr__`` is never called, so on
+        older Pythons this module is made an instance of this class, which
+        calls it for the attributes the module doesn't have (yet).
+        """
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+        def __dir__(self):
+            return __dir__()
+
+    try:
+        # Python 3.5 and later
+        sys.modules[__name__].__class__ = LazyModule
+    except TypeError:
+        _lazy_module = LazyModule(__name__, __doc__)
+        _lazy_module.__dict__.update(globals())
+        sys.modules[__name__] = _lazy_module
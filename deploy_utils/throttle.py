@@ -0,0 +1,207 @@
+'''
+Retries and adaptive concurrency for requests to S3.
+
+S3 answers bursts of requests with ``503 SlowDown``, and long deploys see
+the odd timeout or reset connection. ``ThrottleController`` retries such
+failures with jittered exponential backoff, and limits how many requests
+are in flight at once with an AIMD (additive increase, multiplicative
+decrease) limit: the limit is halved whenever S3 throttles a request and
+grows by one after a full limit's worth of successful requests.
+'''
+
+from __future__ import unicode_literals
+
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+
+from boto.exception import BotoServerError, S3ResponseError
+from django.conf import settings
+from django.utils.six.moves.http_client import HTTPException
+
+
+RETRYABLE_STATUSES = (500, 502, 503, 504)
+RETRYABLE_ERROR_CODES = ('SlowDown', 'RequestTimeout', 'InternalError',
+                         'ServiceUnavailable')
+THROTTLE_ERROR_CODES = ('SlowDown', 'Throttling', 'ServiceUnavailable')
+RETRYABLE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.ECONNREFUSED,
+                    errno.EPIPE, errno.ETIMEDOUT)
+
+
+def is_throttle_error(error):
+    """
+    Return whether ``error`` means S3 wants requests to slow down.
+    """
+    return isinstance(error, BotoServerError) and (
+        error.status == 503 or error.error_code in THROTTLE_ERROR_CODES)
+
+
+def is_retryable_error(error):
+    """
+    Return whether the request that raised ``error`` is worth sending again:
+    throttling, server errors, timeouts and dropped connections.
+    """
+    if isinstance(error, (BotoServerError, S3ResponseError)):
+        return (error.status in RETRYABLE_STATUSES or
+                error.error_code in RETRYABLE_ERROR_CODES)
+    if isinstance(error, (socket.timeout, HTTPException)):
+        return True
+    if isinstance(error, (socket.error, IOError, OSError)):
+        return error.errno in RETRYABLE_ERRNOS
+    return False
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the number of requests in flight to ``limit``, which varies
+    between ``minimum`` and ``maximum``: ``throttled`` halves it and each
+    ``limit`` calls to ``succeeded`` raise it by one.
+    """
+    def __init__(self, maximum, minimum=1, initial=None):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = min(self.maximum, initial or self.maximum)
+        self.in_flight = 0
+        self.successes = 0
+        self.lowest = self.limit
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def succeeded(self):
+        with self._condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.successes = 0
+                self.limit += 1
+                self._condition.notify()
+
+    def throttled(self):
+        with self._condition:
+            self.successes = 0
+            self.limit = max(self.minimum, self.limit // 2)
+            self.lowest = min(self.lowest, self.limit)
+
+
+class ThrottleController(object):
+    """
+    Send requests through ``call``, which retries retryable failures up to
+    ``retries`` times, sleeping a random delay of up to ``base_delay * 2 **
+    attempt`` (capped at ``max_delay``) seconds in between, while an
+    ``AdaptiveLimiter`` caps how many requests are in flight.
+
+    Counts of requests, retries, throttled responses and failures are kept
+    in ``stats`` for the deploy report.
+    """
+    def __init__(self, max_concurrency=10, retries=5, base_delay=0.1,
+                 max_delay=20, min_concurrency=1):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = AdaptiveLimiter(max_concurrency, min_concurrency)
+        self.stats = dict.fromkeys(
+            ('requests', 'retries', 'throttled', 'failed'), 0)
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_settings(cls, max_concurrency=None):
+        """
+        Build a controller from the ``AWS_RETRIES``, ``AWS_RETRY_BASE_DELAY``
+        and ``AWS_RETRY_MAX_DELAY`` settings. The concurrency limit starts
+        at ``AWS_MAX_CONCURRENCY`` if set, else ``max_concurrency``, else 10.
+        """
+        return cls(
+            max_concurrency=getattr(settings, 'AWS_MAX_CONCURRENCY', None) or
+            max_concurrency or 10,
+            retries=getattr(settings, 'AWS_RETRIES', 5),
+            base_delay=getattr(settings, 'AWS_RETRY_BASE_DELAY', 0.1),
+            max_delay=getattr(settings, 'AWS_RETRY_MAX_DELAY', 20))
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def delay(self, attempt):
+        """
+        Return how long to sleep before retry number ``attempt`` (from 1),
+        using "full jitter" so retrying workers don't stay in step.
+        """
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call ``func(*args, **kwargs)`` once a slot is free, retrying if it
+        raises a retryable error, and return its result. The last error is
+        raised once the retries run out.
+
+        Calls made while another ``call`` is running on the same thread (a
+        storage method calling another) are passed straight through, so a
+        request is only retried, and only holds a slot, once.
+        """
+        return self._call(func, args, kwargs, limited=True)
+
+    def retry(self, func, *args, **kwargs):
+        """
+        Like ``call``, but without waiting for a slot; for requests made on
+        behalf of a ``call`` that already holds one (such as the parts of a
+        multipart upload, sent from other threads).
+        """
+        return self._call(func, args, kwargs, limited=False)
+
+    def _call(self, func, args, kwargs, limited):
+        if getattr(self._local, 'active', False):
+            return func(*args, **kwargs)
+        attempt = 0
+        while True:
+            if limited:
+                self.limiter.acquire()
+            self._local.active = True
+            self._count('requests')
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+                if is_throttle_error(e):
+                    self._count('throttled')
+                    self.limiter.throttled()
+                if attempt >= self.retries or not is_retryable_error(e):
+                    self._count('failed')
+                    raise
+            else:
+                self.limiter.succeeded()
+                return result
+            finally:
+                self._local.active = False
+                if limited:
+                    self.limiter.release()
+            attempt += 1
+            self._count('retries')
+            delay = self.delay(attempt)
+            logging.warning("Retrying %s in %.2fs (attempt %d): %s",
+                            getattr(func, '__name__', func), delay, attempt,
+                            error)
+            time.sleep(delay)
+
+    def report(self):
+        """
+        Return a one-line summary of the retries and throttling seen.
+        """
+        return ('%(requests)d requests to storage, %(retries)d retried, '
+                '%(throttled)d throttled, %(failed)d failed' % self.stats +
+                '; concurrency limit %d (lowest %d, maximum %d)' % (
+                    self.limiter.limit, self.limiter.lowest,
+                    self.limiter.maximum))
@@ -2,28 +2,157 @@ from __future__ import unicode_literals
 
 __author__ = 'Philip Roche'
 
+import errno
+import os
+import subprocess
+from collections import OrderedDict
+
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.core.files.base import File
+from django.core.management.base import CommandError
+
+
+ADDED = 'A'
+MODIFIED = 'M'
+DELETED = 'D'
+RENAMED = 'R'
+
+
+def get_changed_files_git(commit_id, path='../', working_tree=False):
+    """
+    Return the commit message and the list of files added, modified or
+    renamed by ``commit_id`` (see ``get_changes_git``). Deleted files are
+    left out, as there is nothing to deploy for them.
+    """
+    message, changes = get_changes_git(commit_id, path, working_tree)
+    files_changed = [file_path for file_path, status in changes.items()
+                     if status != DELETED]
+    return message, files_changed
+
 
+def get_changes_git(commit_id=None, path='../', working_tree=False):
+    """
+    Diff the git repository at ``path`` once and return ``(message,
+    changes)``, where ``changes`` is an OrderedDict mapping each path to its
+    status (``ADDED``, ``MODIFIED``, ``DELETED`` or ``RENAMED``). The old
+    path of a rename is reported as ``DELETED``.
 
-def get_changed_files_git(commit_id, path='../'):
+    ``commit_id`` is either a single commit (diffed against its first
+    parent) or an ``A..B`` range (a single diff between the two, so files
+    changed by several commits in the range only appear once). With
+    ``working_tree``, the working copy is diffed against ``commit_id``
+    (``HEAD`` by default) instead.
+
+    Uses pygit2 when it is installed and ``git diff --name-status``
+    otherwise. Raises CommandError if git can't produce the diff (e.g. an
+    unknown commit, or ``path`` isn't a git repository).
+    """
+    if working_tree and commit_id and '..' in commit_id:
+        raise CommandError("The working tree can only be diffed against a "
+                           "single commit, not the range %s." % commit_id)
     try:
         import pygit2
-        repo = pygit2.Repository(path)
-        commit = repo.revparse_single(commit_id)
-        message = commit.message
+    except ImportError:
+        return _get_changes_git_cli(commit_id, path, working_tree)
+    try:
+        return _get_changes_pygit2(pygit2, commit_id, path, working_tree)
+    except (KeyError, ValueError, pygit2.GitError) as e:
+        raise CommandError("Unable to diff %s in %s: %s" % (
+            commit_id or 'the working tree', path, e))
 
-        # Diff between specified parent and its immediate parent on the
+
+def _get_changes_pygit2(pygit2, commit_id, path, working_tree):
+    repo = pygit2.Repository(path)
+    if working_tree:
+        base = commit_id or 'HEAD'
+        message = 'Uncommitted changes against %s' % base
+        diff = repo.diff(base)
+    elif '..' in commit_id:
+        old, new = [rev or 'HEAD' for rev in commit_id.split('..', 1)]
+        walker = repo.walk(repo.revparse_single(new).id,
+                           pygit2.GIT_SORT_TOPOLOGICAL)
+        walker.hide(repo.revparse_single(old).id)
+        message = '\n'.join(commit.message.splitlines()[0]
+                            for commit in walker if commit.message)
+        diff = repo.diff(old, new)
+    else:
+        message = repo.revparse_single(commit_id).message
+        # Diff between specified commit and its immediate parent on the
         # current branch.
         # (See http://www.paulboxley.com/blog/2011/06/git-caret-and-tilde)
-        diff = repo.diff(commit_id, '%s~1' % commit_id)
-        files_changed = [p.delta.new_file.path for p in diff]
-        return message, files_changed
-    except ImportError:
-        raise Exception("Unable to proceed as pygit2 is not installed.")
+        diff = repo.diff('%s~1' % commit_id, commit_id)
+    diff.find_similar()
 
+    changes = OrderedDict()
+    for patch in diff:
+        delta = patch.delta
+        status = delta.status_char()
+        if status == RENAMED:
+            changes[delta.old_file.path] = DELETED
+        _add_change(changes, status, delta.new_file.path)
+    return message, changes
 
-def save_with_default_storage(abs_file_path, relative_file_path):
 
-    with open(abs_file_path) as fp:
-        default_storage.save(relative_file_path, ContentFile(fp.read()))
+def _get_changes_git_cli(commit_id, path, working_tree):
+    if working_tree:
+        base = commit_id or 'HEAD'
+        message = 'Uncommitted changes against %s' % base
+        revisions = [base]
+    elif '..' in commit_id:
+        old, new = [rev or 'HEAD' for rev in commit_id.split('..', 1)]
+        message = _run_git(path, 'log', '--format=%s',
+                           '%s..%s' % (old, new)).strip()
+        revisions = [old, new]
+    else:
+        message = _run_git(path, 'log', '-1', '--format=%B', commit_id)
+        revisions = ['%s~1' % commit_id, commit_id]
+
+    output = _run_git(path, 'diff', '--name-status', '-z', '-M', *revisions)
+    fields = output.split('\0')
+    changes = OrderedDict()
+    i = 0
+    while i < len(fields) and fields[i]:
+        # Renames and copies are followed by the old and new paths, every
+        # other status by a single path
+        status = fields[i][0]
+        if status in (RENAMED, 'C'):
+            if status == RENAMED:
+                changes[fields[i + 1]] = DELETED
+            _add_change(changes, status, fields[i + 2])
+            i += 3
+        else:
+            _add_change(changes, status, fields[i + 1])
+            i += 2
+    return message, changes
+
+
+def _add_change(changes, status, file_path):
+    if status not in (ADDED, DELETED, RENAMED):
+        status = MODIFIED
+    changes[file_path] = status
+
+
+def _run_git(path, *args):
+    try:
+        process = subprocess.Popen(('git',) + args, cwd=path,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError as e:
+        if e.errno == errno.ENOENT and os.path.isdir(path):
+            raise CommandError("Unable to proceed as neither pygit2 nor the "
+                               "git command line client is installed.")
+        raise CommandError("Unable to run git in %s: %s" % (path, e))
+    output, errors = process.communicate()
+    if process.returncode:
+        raise CommandError("git %s failed: %s" % (
+            args[0], errors.decode('utf-8', 'replace').strip()))
+    return output.decode('utf-8')
+
+
+def save_with_default_storage(abs_file_path, relative_file_path):
+    """
+    Stream the file at ``abs_file_path`` to the default storage in binary
+    chunks, without loading it into memory.
+    """
+    with open(abs_file_path, 'rb') as fp:
+        default_storage.save(relative_file_path, File(fp))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+'''
+Runs the deploy_utils test suite against a minimal settings module:
+
+python runtests.py
+python runtests.py tests.test_manifest
+'''
+
+import os
+import sys
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+
+def configure():
+    settings.configure(
+        SECRET_KEY='deploy-utils-tests',
+        INSTALLED_APPS=[
+            'django.contrib.staticfiles',
+            'pipeline',
+            'deploy_utils',
+            'deploy_utils.devtools',
+        ],
+        STATIC_URL='/static/',
+        PIPELINE={},
+        AWS_ACCESS_KEY_ID='deploy-utils-tests',
+        AWS_SECRET_ACCESS_KEY='deploy-utils-tests',
+    )
+    django.setup()
+
+
+def main(labels):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    configure()
+    test_runner = get_runner(settings)(verbosity=1)
+    failures = test_runner.run_tests(labels or ['tests'])
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile, File
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.compress import Precompressor, compress_content, \
+    compress_file
+from deploy_utils.devtools.fakes3 import FakeS3Server
+from deploy_utils.storage import DummyS3StaticStorage
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+CSS = b'.button { color: red; }\n' * 100
+
+
+def gunzip(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as fp:
+        return fp.read()
+
+
+class CompressContentTest(SimpleTestCase):
+
+    def test_gzip_variants_are_stable(self):
+        variants = compress_content(CSS, ['gzip'])
+        self.assertEqual([encoding for encoding, _data in variants],
+                         ['gzip'])
+        self.assertEqual(gunzip(variants[0][1]), CSS)
+        self.assertEqual(compress_content(CSS, ['gzip']), variants)
+
+    def test_variants_must_be_smaller(self):
+        self.assertEqual(compress_content(os.urandom(1000), ['gzip']), [])
+        self.assertEqual(compress_content(b'a', ['gzip']), [])
+
+
+@override_settings(PROXY_S3=True, AWS_STATIC_BUCKET_NAME='static',
+                   AWS_IS_GZIPPED=False)
+class PrecompressTest(SimpleTestCase):
+    """
+    The deploy storage saving precompressed variants to fakes3.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(PrecompressTest, cls).setUpClass()
+        cls.server = FakeS3Server().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super(PrecompressTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.server.buckets.clear()
+        self.server.buckets['static'] = {}
+        self.server.faults = None
+        self.storage = DummyS3StaticStorage()
+        self.precompressor = Precompressor(self.storage, workers=1,
+                                           encodings=['gzip'], max_size=4096)
+        self.storage.precompressor = self.precompressor
+        self.addCleanup(self.precompressor.executor.shutdown)
+        patcher = mock.patch.object(self.precompressor.executor, 'submit',
+                                    wraps=self.precompressor.executor.submit)
+        self.submit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save_file(self, name, data):
+        path = os.path.join(self.root, os.path.basename(name))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        with open(path, 'rb') as fp:
+            self.storage.save(name, File(fp))
+        return path
+
+    def stored(self, name):
+        return self.server.buckets['static'].get(name)
+
+    def header(self, name, header):
+        headers = dict((key.lower(), value)
+                       for key, value in self.stored(name).headers.items())
+        return headers.get(header)
+
+    def test_variants_are_saved_with_their_content_encoding(self):
+        self.save_file('css/site.css', CSS)
+        self.assertEqual(self.precompressor.finish(), ['css/site.css.gz'])
+        self.assertEqual(gunzip(self.stored('css/site.css.gz').data), CSS)
+        self.assertEqual(self.header('css/site.css.gz', 'content-encoding'),
+                         'gzip')
+        self.assertEqual(self.header('css/site.css.gz', 'content-type'),
+                         'text/css')
+        self.assertIsNone(self.header('css/site.css', 'content-encoding'))
+
+    @override_settings(AWS_IS_GZIPPED=True)
+    def test_variants_are_not_gzipped_again(self):
+        self.storage = DummyS3StaticStorage()
+        self.storage.precompressor = self.precompressor
+        self.precompressor.storage = self.storage
+        self.save_file('css/site.css', CSS)
+        self.precompressor.finish()
+        self.assertEqual(gunzip(self.stored('css/site.css.gz').data), CSS)
+
+    def test_variants_that_are_not_smaller_are_skipped(self):
+        self.save_file('js/random.js', os.urandom(1000))
+        self.save_file('img/logo.png', CSS)
+        self.assertEqual(self.precompressor.finish(), [])
+        self.assertEqual(sorted(self.server.buckets['static']),
+                         ['img/logo.png', 'js/random.js'])
+        self.assertEqual(self.precompressor.failed, [])
+
+    def test_files_on_disk_are_read_by_the_worker(self):
+        path = self.save_file('css/site.css', CSS)
+        self.storage.save('css/packed.css', ContentFile(CSS))
+        self.assertEqual(
+            [call[0][:2] for call in self.submit.call_args_list],
+            [(compress_file, path), (compress_content, CSS)])
+        self.assertEqual(sorted(self.precompressor.finish()),
+                         ['css/packed.css.gz', 'css/site.css.gz'])
+
+    def test_content_in_memory_is_limited_in_size(self):
+        self.storage.save('css/packed.css', ContentFile(CSS * 2))
+        self.save_file('css/site.css', CSS * 2)
+        self.assertEqual(self.precompressor.finish(), ['css/site.css.gz'])
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.cssgraph import CssReferenceGraph, get_css_references
+
+
+@override_settings(STATIC_URL='/static/')
+class CssReferencesTest(SimpleTestCase):
+
+    def test_references(self):
+        content = '''
+            @import "base.css";
+            a { background: url('../img/a.png?v=1#top'); }
+            b { background: url(/static/fonts/b.woff); }
+            c { background: url(data:image/png;base64,AAAA); }
+            d { background: url(http://example.com/d.png); }
+            e { background: url(//cdn.example.com/e.png); }
+            f { background: url(#shape); }
+            g { background: url(/elsewhere/g.png); }
+            h { background: url(../../outside.png); }
+        '''
+        self.assertEqual(get_css_references('css/site.css', content), [
+            'css/base.css', 'fonts/b.woff', 'img/a.png'])
+
+
+class CssReferenceGraphTest(SimpleTestCase):
+
+    def graph(self, references):
+        graph = CssReferenceGraph()
+        graph.references = references
+        return graph
+
+    def test_levels(self):
+        graph = self.graph({
+            'base.css': ['img/a.png'],
+            'site.css': ['base.css', 'img/b.png'],
+            'print.css': ['site.css'],
+            'other.css': ['img/c.png'],
+        })
+        self.assertEqual(graph.levels(['img/a.png']), [
+            ['img/a.png'], ['base.css'], ['site.css'], ['print.css']])
+        self.assertEqual(graph.levels(['img/b.png', 'img/c.png']), [
+            ['img/b.png', 'img/c.png'], ['other.css', 'site.css'],
+            ['print.css']])
+        self.assertEqual(graph.levels([]), [])
+
+    def test_cycles_end_up_in_the_last_level(self):
+        graph = self.graph({
+            'a.css': ['b.css', 'img/a.png'],
+            'b.css': ['a.css'],
+        })
+        self.assertEqual(graph.levels(['img/a.png']), [
+            ['img/a.png'], ['a.css', 'b.css']])
+
+    def test_save_and_load(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        css_path = os.path.join(root, 'site.css')
+        with open(css_path, 'w') as fp:
+            fp.write('a { background: url(img/a.png); }')
+        graph = CssReferenceGraph(os.path.join(root, 'graph.json'))
+        graph.build([(css_path, 'site.css'),
+                     (os.path.join(root, 'img', 'a.png'), 'img/a.png')])
+        graph.save()
+
+        loaded = CssReferenceGraph(graph.path)
+        self.assertTrue(loaded.load())
+        self.assertEqual(loaded.references, {'site.css': ['img/a.png']})
+        self.assertFalse(CssReferenceGraph(
+            os.path.join(root, 'missing.json')).load())
@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+from django.utils import six
+
+from deploy_utils.deployer import StaticDeployer, StaticFile
+from deploy_utils.file_utils import reset_static_storage
+from deploy_utils.manifest import DeployManifest, get_file_hash
+from deploy_utils.storage import DummyPipelineStorage
+
+from .test_pipelinestorage import SOURCES, PipelineStorageTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class CheckFileTest(SimpleTestCase):
+    """
+    Files are only read (hashed) when the manifest can't tell from their
+    size and modification time that they're unchanged.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        reset_static_storage()
+        self.addCleanup(reset_static_storage)
+        self.path = os.path.join(self.root, 'site.css')
+        self.write(b'body {}', 1000000000)
+        self.manifest = DeployManifest()
+        self.manifest.record('css/site.css', get_file_hash(self.path), 7,
+                             mtime=1000000000)
+        self.deployer = StaticDeployer(six.StringIO(), manifest=self.manifest)
+        patcher = mock.patch('deploy_utils.deployer.get_file_hash',
+                             side_effect=get_file_hash)
+        self.get_file_hash = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, data, mtime):
+        with open(self.path, 'wb') as fp:
+            fp.write(data)
+        os.utime(self.path, (mtime, mtime))
+
+    def check(self):
+        return self.deployer.check_file(self.path, 'css/site.css')
+
+    def test_unchanged_files_are_not_read(self):
+        self.assertIsNone(self.check())
+        self.assertFalse(self.get_file_hash.called)
+
+    def test_touched_files_are_hashed_once(self):
+        os.utime(self.path, (1000000060, 1000000060))
+        self.assertIsNone(self.check())
+        self.assertEqual(self.get_file_hash.call_count, 1)
+        self.assertEqual(self.manifest.files['css/site.css']['mtime'],
+                         1000000060)
+        # The new mtime is remembered
+        self.assertIsNone(self.check())
+        self.assertEqual(self.get_file_hash.call_count, 1)
+
+    def test_changed_files(self):
+        self.write(b'body { margin: 0 }', 1000000000)
+        file_hash, size, mtime, copied = self.check()
+        self.assertEqual(file_hash, get_file_hash(self.path))
+        self.assertEqual((size, mtime, copied), (18, 1000000000, False))
+
+    def test_forced_deploys_check_nothing(self):
+        self.deployer.force = True
+        file_hash, size, mtime, copied = self.check()
+        self.assertEqual((size, copied), (7, False))
+        self.assertEqual(self.manifest.files['css/site.css']['mtime'],
+                         1000000000)
+
+
+class DeployTest(PipelineStorageTestCase):
+    """
+    A whole deploy to a DummyPipelineStorage, through the upload pool and
+    the package queue.
+    """
+
+    def setUp(self):
+        super(DeployTest, self).setUp()
+        reset_static_storage()
+        self.addCleanup(reset_static_storage)
+        self.stdout = six.StringIO()
+        pack_package = DummyPipelineStorage.pack_package
+        patcher = mock.patch.object(
+            DummyPipelineStorage, 'pack_package', autospec=True,
+            side_effect=lambda storage, kind, package: (
+                self.packed.append(package.output_filename),
+                pack_package(storage, kind, package)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def static_files(self, *rel_paths, **kwargs):
+        return [StaticFile(abs_path, rel_path,
+                           kwargs.get('post_process', True))
+                for abs_path, rel_path in self.paths(*rel_paths)]
+
+    def test_files_are_copied_packed_and_processed(self):
+        # Deployed before, and unchanged
+        self.storage.save('css/shared.css',
+                          ContentFile(SOURCES['css/shared.css']))
+        deployer = StaticDeployer(self.stdout, workers=3)
+        failed = deployer.deploy(
+            self.static_files('css/base.css', 'js/app/one.js',
+                              'js/app/two.js', 'js/missing.js'),
+            iter(self.static_files('js/vendor.js', post_process=False)))
+        self.assertEqual([rel_path for rel_path, _error in failed],
+                         ['js/missing.js'])
+        # Each package once, by the package queue
+        self.assertEqual(sorted(self.packed), ['css/site.css', 'js/app.js'])
+        output = self.stdout.getvalue()
+        for line in ('copied js/vendor.js', 'packed js/app.js',
+                     'processed js/app/one.js'):
+            self.assertIn('\t%s ' % line, output)
+        self.assertNotIn('processed js/vendor.js', output)
+        self.assertEqual(self.read('js/app.js'),
+                         b'var one = 1;\n;var two = 2;')
+        self.assertEqual(self.read('js/vendor.js'), SOURCES['js/vendor.js'])
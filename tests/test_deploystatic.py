@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from django.utils import six
+
+from deploy_utils.deployer import StaticFile
+from deploy_utils.management.commands.deploystatic import Command
+
+
+class DeployStaticTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.static = os.path.join(self.root, 'static')
+        self.npm_root = os.path.join(self.root, 'frontend')
+        self.dist = os.path.join(self.npm_root, 'dist')
+        for path in (os.path.join(self.static, 'css', 'site.css'),
+                     os.path.join(self.dist, 'app.js'),
+                     os.path.join(self.dist, 'chunks', '1.js'),
+                     os.path.join(self.dist, '.cache'),
+                     os.path.join(self.npm_root, 'src', 'app.js')):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        settings = override_settings(
+            STATICFILES_DIRS=[self.static, ('npm', self.dist)],
+            NPM_ROOT_PATH=self.npm_root + os.sep,
+            STATIC_ROOT=os.path.join(self.root, 'collected'),
+            STATICFILES_STORAGE='pipeline.storage.PipelineStorage')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.command = Command(stdout=six.StringIO())
+
+    def test_only_npm_locations_are_walked(self):
+        self.assertEqual(sorted(self.command.discover_npm_files()), [
+            StaticFile(os.path.join(self.dist, 'app.js'), 'npm/app.js',
+                       False),
+            StaticFile(os.path.join(self.dist, 'chunks', '1.js'),
+                       'npm/chunks/1.js', False)])
+
+    def test_dry_runs_list_what_would_be_copied(self):
+        stdout = six.StringIO()
+        call_command('deploystatic', filelist=[
+            'static/css/site.css', 'frontend/src/app.js', 'manage.py'],
+            path=self.root, dry_run=True, interactive=False, stdout=stdout)
+        output = stdout.getvalue()
+        for rel_path in ('css/site.css', 'npm/app.js', 'npm/chunks/1.js'):
+            self.assertIn('\twould copy %s ' % rel_path, output)
+        self.assertNotIn('would copy npm/.cache', output)
+        self.assertIn('manage.py is _NOT_ a media/static file', output)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'collected')))
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+
+from deploy_utils.file_utils import copy_static_file, run_in_parallel
+
+
+# Not valid text in any encoding, and spanning a few chunks
+BINARY = b'\x89PNG\r\n\x1a\n\x00\xff' * 1000
+
+
+class ChunkedStorage(FileSystemStorage):
+    """
+    Saves files to ``location``, keeping the content it was given and the
+    size of the chunks it was read in.
+    """
+    def _save(self, name, content):
+        self.content = content
+        self.chunk_sizes = []
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            for chunk in content.chunks(chunk_size=1024):
+                self.chunk_sizes.append(len(chunk))
+                fp.write(chunk)
+        return name
+
+
+class RunInParallelTest(SimpleTestCase):
+
+    def test_results_keep_the_order_of_the_items(self):
+        def slow_square(n):
+            # Later items finish first
+            time.sleep((10 - n) * 0.002)
+            return n * n
+        self.assertEqual(
+            list(run_in_parallel(slow_square, range(10), workers=4)),
+            [(n, n * n, None) for n in range(10)])
+
+    def test_failures_are_yielded_not_raised(self):
+        def check(n):
+            if n % 3 == 0:
+                raise ValueError(n)
+            return n
+        results = list(run_in_parallel(check, range(7), workers=3))
+        self.assertEqual([item for item, _result, _error in results],
+                         list(range(7)))
+        for item, result, error in results:
+            if item % 3 == 0:
+                self.assertIsNone(result)
+                self.assertIsInstance(error, ValueError)
+            else:
+                self.assertEqual((result, error), (item, None))
+
+    def test_uses_the_workers(self):
+        threads = set()
+        lock = threading.Lock()
+
+        def record(n):
+            with lock:
+                threads.add(threading.current_thread().ident)
+            time.sleep(0.01)
+        list(run_in_parallel(record, range(8), workers=4))
+        self.assertEqual(len(threads), 4)
+
+    def test_items_are_pulled_as_workers_free_up(self):
+        pulled = []
+
+        def items():
+            for n in range(20):
+                pulled.append(n)
+                yield n
+        results = run_in_parallel(lambda n: n, items(), workers=2)
+        next(results)
+        # At most ``workers * 2`` in flight before the first is yielded
+        self.assertEqual(len(pulled), 4)
+        self.assertEqual(len(list(results)), 19)
+
+
+class CopyStaticFileTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'logo.png')
+        with open(self.path, 'wb') as fp:
+            fp.write(BINARY)
+        self.storage = ChunkedStorage(
+            location=os.path.join(self.root, 'static'))
+
+    def test_files_are_streamed_to_storage(self):
+        copy_static_file(self.path, 'img/logo.png',
+                         static_storage=self.storage)
+        # The open source file, not its contents read into memory
+        self.assertIs(type(self.storage.content), File)
+        self.assertEqual(self.storage.content.name, self.path)
+        self.assertEqual(self.storage.chunk_sizes,
+                         [1024] * 9 + [len(BINARY) - 9 * 1024])
+        with self.storage.open('img/logo.png') as fp:
+            self.assertEqual(fp.read(), BINARY)
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.devtools.fakes3 import FakeS3Server, FaultInjector
+from deploy_utils.inventory import BucketInventory, InventoryEntry
+from deploy_utils.storage import DummyS3StaticStorage
+
+
+def etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+def timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+
+class BucketInventoryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cache_path = os.path.join(self.root, 'inventory.json')
+
+    def test_md5_comes_from_plain_etags_only(self):
+        self.assertEqual(InventoryEntry(etag(b'a'), 1, None).md5,
+                         hashlib.md5(b'a').hexdigest())
+        self.assertIsNone(InventoryEntry('"0123456789abcdef-3"', 1, None).md5)
+        self.assertIsNone(InventoryEntry(None, 1, None).md5)
+
+    def test_lookups(self):
+        inventory = BucketInventory()
+        inventory.record('css/site.css', etag(b'body {}'), 7)
+        self.assertTrue(inventory.exists('css/site.css'))
+        self.assertFalse(inventory.exists('css/other.css'))
+        self.assertEqual(inventory.size('css/site.css'), 7)
+        self.assertEqual(inventory.size('css/other.css'), 0)
+        md5 = hashlib.md5(b'body {}').hexdigest()
+        self.assertFalse(inventory.is_changed('css/site.css', md5))
+        self.assertTrue(inventory.is_changed('css/site.css', 'f' * 32))
+        self.assertTrue(inventory.is_changed('css/other.css', md5))
+        inventory.invalidate('css/site.css')
+        self.assertTrue(inventory.is_changed('css/site.css', md5))
+
+    def test_cached_copies(self):
+        self.assertFalse(BucketInventory(self.cache_path).load())
+        inventory = BucketInventory(self.cache_path)
+        inventory.record('img/a.png', etag(b'a'), 1,
+                         '2026-01-01T00:00:00.000Z')
+        inventory.save()
+        cached = BucketInventory(self.cache_path)
+        self.assertTrue(cached.load())
+        self.assertEqual(cached.entries, inventory.entries)
+
+        # Copies in another format are ignored
+        BucketInventory.version += 1
+        try:
+            self.assertFalse(BucketInventory(self.cache_path).load())
+        finally:
+            BucketInventory.version -= 1
+
+
+@override_settings(PROXY_S3=True, AWS_STATIC_BUCKET_NAME='static',
+                   AWS_IS_GZIPPED=False)
+class InventoryMixinTest(SimpleTestCase):
+    """
+    The deploy storage answering lookups from the inventory of a fakes3
+    bucket, counting the requests to objects each one takes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(InventoryMixinTest, cls).setUpClass()
+        cls.server = FakeS3Server().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super(InventoryMixinTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.buckets.clear()
+        self.server.buckets['static'] = {}
+        self.server.faults = FaultInjector()
+        self.storage = DummyS3StaticStorage()
+
+    def store(self, name, data):
+        self.server.store(self.server.buckets['static'], name, data, {})
+
+    def requests(self):
+        return self.server.faults.stats['requests']
+
+    def test_every_page_of_the_bucket_is_listed(self):
+        for i in range(1005):
+            self.store('img/%04d.png' % i, b'%d' % i)
+        inventory = self.storage.load_inventory()
+        self.assertEqual(len(inventory.entries), 1005)
+        entry = inventory.get('img/1004.png')
+        self.assertEqual((entry.etag, entry.size), (etag(b'1004'), 4))
+        self.assertTrue(entry.last_modified)
+
+    def test_lookups_come_from_the_inventory(self):
+        self.store('img/a.png', b'image')
+        self.storage.load_inventory()
+        requests = self.requests()
+        self.assertTrue(self.storage.exists('img/a.png'))
+        self.assertFalse(self.storage.exists('img/b.png'))
+        self.assertEqual(self.storage.size('img/a.png'), 5)
+        self.assertEqual(self.requests(), requests)
+
+    def test_saves_and_deletes_keep_it_up_to_date(self):
+        inventory = self.storage.load_inventory()
+        before = timestamp()
+        self.storage.save('img/a.png', ContentFile(b'image'))
+        entry = inventory.get('img/a.png')
+        self.assertEqual(entry[:2], (etag(b'image'), 5))
+        # With the upload time, as a listing would have it
+        self.assertTrue(before <= entry.last_modified <= timestamp())
+        self.storage.delete('img/a.png')
+        self.assertFalse(self.storage.exists('img/a.png'))
+
+    def test_unchanged_files(self):
+        md5 = hashlib.md5(b'image').hexdigest()
+        self.store('img/a.png', b'image')
+        self.storage.load_inventory()
+        # Its hashed copy is missing
+        self.assertFalse(self.storage.is_unchanged('img/a.png', md5))
+        self.assertTrue(self.storage.is_unchanged('img/a.png', md5,
+                                                  post_process=False))
+        self.store('img/a.%s.png' % md5[:12], b'image')
+        self.storage.load_inventory()
+        self.assertTrue(self.storage.is_unchanged('img/a.png', md5))
+        self.assertFalse(self.storage.is_unchanged('img/a.png', 'f' * 32))
+
+    def test_hashed_names_come_from_etags(self):
+        self.store('img/a.png', b'image')
+        self.storage.load_inventory()
+        requests = self.requests()
+        md5 = hashlib.md5(b'image').hexdigest()
+        self.assertEqual(self.storage.hashed_name('img/a.png'),
+                         'img/a.%s.png' % md5[:12])
+        self.assertEqual(self.requests(), requests)
+
+    def test_cached_inventory(self):
+        cache_path = os.path.join(tempfile.mkdtemp(), 'inventory.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(cache_path))
+        self.store('img/a.png', b'image')
+        self.storage.load_inventory(cache_path).save()
+        self.store('img/b.png', b'image')
+        self.assertFalse(self.storage.load_inventory(cache_path).exists(
+            'img/b.png'))
+        self.assertTrue(self.storage.load_inventory(
+            cache_path, refresh=True).exists('img/b.png'))
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.journal import COPIED, PROCESSED, DeployJournal, \
+    get_journal_path
+from deploy_utils.manifest import DeployManifest
+
+
+class DeployJournalTest(SimpleTestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.path = os.path.join(root, 'deploy.journal')
+
+    def test_off_by_default(self):
+        with override_settings(DEPLOY_JOURNAL_PATH=None):
+            self.assertIsNone(get_journal_path())
+
+    def test_resume(self):
+        journal = DeployJournal(self.path)
+        journal.open()
+        journal.record(COPIED, 'a.css', 'aaa', size=1, mtime=1.0,
+                       post_process=True)
+        journal.record(PROCESSED, 'a.css', 'aaa', hashed_name='a.aaa.css')
+        journal.record(COPIED, 'b.css', 'bbb', size=2, mtime=2.0,
+                       post_process=True)
+        journal.record(COPIED, 'app.js', 'ccc', size=3, mtime=3.0,
+                       post_process=False)
+        journal.close()
+        with open(self.path, 'a') as fp:
+            # Cut short by a crash
+            fp.write('{"step": "copy", "pa')
+
+        resumed = DeployJournal(self.path)
+        self.assertTrue(resumed.load())
+        self.assertTrue(resumed.is_done('a.css', 'aaa'))
+        self.assertFalse(resumed.is_done('a.css', 'changed'))
+        # Copied, but still to be post-processed
+        self.assertFalse(resumed.is_done('b.css', 'bbb'))
+        self.assertIsNotNone(resumed.get(COPIED, 'b.css', size=2, mtime=2.0))
+        self.assertIsNone(resumed.get(COPIED, 'b.css', size=2, mtime=9.0))
+        # Needs no post-processing
+        self.assertTrue(resumed.is_done('app.js', size=3, mtime=3.0))
+
+        manifest = DeployManifest()
+        resumed.replay(manifest)
+        self.assertEqual(sorted(manifest.files), ['a.css', 'app.js'])
+        self.assertEqual(manifest.hashed_names(), {'a.css': 'a.aaa.css'})
+
+    def test_complete_deploy_removes_journal(self):
+        journal = DeployJournal(self.path)
+        journal.open()
+        journal.close(complete=False)
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertFalse(DeployJournal(self.path).load())
+        journal.open(resume=True)
+        journal.close(complete=True)
+        self.assertFalse(os.path.isfile(self.path))
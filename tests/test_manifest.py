@@ -0,0 +1,94 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.manifest import DeployManifest, get_file_hash, \
+    get_manifest_location, is_manifest_enabled
+
+
+class DeployManifestTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = FileSystemStorage(location=os.path.join(self.root,
+                                                               'storage'))
+        self.path = os.path.join(self.root, 'manifest.json')
+
+    def test_file_hash_is_md5(self):
+        path = os.path.join(self.root, 'a.css')
+        with open(path, 'wb') as fp:
+            fp.write(b'body {}')
+        self.assertEqual(get_file_hash(path, chunk_size=2),
+                         hashlib.md5(b'body {}').hexdigest())
+
+    def test_record_keeps_unset_fields(self):
+        manifest = DeployManifest()
+        manifest.record('a.css', 'abc', 10, mtime=1.0)
+        manifest.record('a.css', hashed_name='a.abc.css')
+        self.assertEqual(manifest.files['a.css'], {
+            'hash': 'abc', 'size': 10, 'mtime': 1.0,
+            'hashed_name': 'a.abc.css'})
+        self.assertEqual(manifest.hashed_names(), {'a.css': 'a.abc.css'})
+
+    def test_is_unchanged(self):
+        manifest = DeployManifest()
+        manifest.record('a.css', 'abc', 10, mtime=1.0)
+        self.assertTrue(manifest.is_unchanged('a.css', 'abc', 10))
+        self.assertFalse(manifest.is_unchanged('a.css', 'abd', 10))
+        self.assertFalse(manifest.is_unchanged('b.css', 'abc', 10))
+        self.assertTrue(manifest.is_unchanged_stat('a.css', 10, 1.0))
+        self.assertFalse(manifest.is_unchanged_stat('a.css', 10, 2.0))
+
+    def test_updates_and_merge(self):
+        manifest = DeployManifest({'a.css': {'hash': 'abc'}})
+        manifest.record('b.css', 'def', 3)
+        updates = manifest.updates()
+        self.assertEqual(list(updates.files), ['b.css'])
+
+        merged = DeployManifest({'a.css': {'hash': 'old'}})
+        merged.merge(DeployManifest({'a.css': {'hash': 'new'}}))
+        self.assertEqual(merged.files['a.css'], {'hash': 'new'})
+        self.assertEqual(merged.recorded, set(['a.css']))
+
+    def test_other_versions_are_ignored(self):
+        self.assertEqual(
+            DeployManifest.from_json('{"version": 0, "files": {"a": {}}}'
+                                     ).files, {})
+
+    def test_save_and_load_local_and_storage(self):
+        manifest = DeployManifest()
+        manifest.record('a.css', 'abc', 10, 'a.abc.css')
+        with override_settings(DEPLOY_MANIFEST_PATH=self.path,
+                               DEPLOY_MANIFEST_NAME='manifest.json'):
+            self.assertTrue(is_manifest_enabled())
+            manifest.save(self.storage)
+            self.assertTrue(os.path.isfile(self.path))
+            self.assertTrue(self.storage.exists('manifest.json'))
+
+            # The local copy wins unless it's turned off
+            DeployManifest({'a.css': {'hash': 'local'}}).save()
+            self.assertEqual(
+                DeployManifest.load(self.storage).files['a.css']['hash'],
+                'local')
+            self.assertEqual(
+                DeployManifest.load(self.storage, local=False
+                                    ).files['a.css']['hash'], 'abc')
+
+            DeployManifest.delete(self.storage)
+            self.assertFalse(DeployManifest.exists(self.storage))
+            self.assertEqual(DeployManifest.load(self.storage).files, {})
+
+    def test_suffix(self):
+        with override_settings(DEPLOY_MANIFEST_PATH=self.path,
+                               DEPLOY_MANIFEST_NAME='manifest.json'):
+            self.assertEqual(get_manifest_location('.1-of-2'), (
+                self.path + '.1-of-2', 'manifest.json.1-of-2'))
+        with override_settings(DEPLOY_MANIFEST_PATH=None,
+                               DEPLOY_MANIFEST_NAME=None):
+            self.assertFalse(is_manifest_enabled())
+            self.assertEqual(get_manifest_location('.1-of-2'), (None, None))
@@ -0,0 +1,118 @@
+import hashlib
+
+from boto.exception import BotoServerError
+from boto.s3.multipart import MultiPartUpload
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.devtools.fakes3 import FakeS3Server
+from deploy_utils.storage import MULTIPART_MIN_CHUNK_SIZE, \
+    DummyS3StaticStorage
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+# Two full parts of S3's minimum size and a short last one
+DATA = b''.join(hashlib.md5(str(i).encode()).digest()
+                for i in range(MULTIPART_MIN_CHUNK_SIZE * 5 // 2 // 16))
+
+
+@override_settings(PROXY_S3=True, AWS_STATIC_BUCKET_NAME='static',
+                   AWS_MULTIPART_THRESHOLD=1024 * 1024,
+                   AWS_MULTIPART_CHUNK_SIZE=1024 * 1024,
+                   AWS_MULTIPART_CONCURRENCY=2, AWS_RETRIES=2,
+                   AWS_RETRY_BASE_DELAY=0.001, AWS_RETRY_MAX_DELAY=0.01)
+class MultipartUploadTest(SimpleTestCase):
+    """
+    The deploy storage uploading large files to fakes3 in parts.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(MultipartUploadTest, cls).setUpClass()
+        cls.server = FakeS3Server().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super(MultipartUploadTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.buckets.clear()
+        self.server.buckets['static'] = {}
+        self.server.faults = None
+        self.storage = DummyS3StaticStorage()
+        self.parts = []
+        upload_part = MultiPartUpload.upload_part_from_file
+
+        def record_part(upload, fp, part_num, *args, **kwargs):
+            self.parts.append((part_num, len(fp.getvalue())))
+            return upload_part(upload, fp, part_num, *args, **kwargs)
+        patcher = mock.patch.object(MultiPartUpload, 'upload_part_from_file',
+                                    autospec=True, side_effect=record_part)
+        self.upload_part = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored(self, name):
+        return self.server.buckets['static'].get(name)
+
+    def test_large_files_are_uploaded_in_parts(self):
+        self.storage.save('video/intro.webm', ContentFile(DATA))
+        # The chunk size is never below S3's minimum
+        self.assertEqual(self.storage.multipart_chunk_size,
+                         MULTIPART_MIN_CHUNK_SIZE)
+        self.assertEqual(sorted(self.parts), [
+            (1, MULTIPART_MIN_CHUNK_SIZE), (2, MULTIPART_MIN_CHUNK_SIZE),
+            (3, len(DATA) - 2 * MULTIPART_MIN_CHUNK_SIZE)])
+        stored = self.stored('video/intro.webm')
+        self.assertEqual(stored.data, DATA)
+        digests = b''.join(
+            hashlib.md5(DATA[start:start + MULTIPART_MIN_CHUNK_SIZE]).digest()
+            for start in range(0, len(DATA), MULTIPART_MIN_CHUNK_SIZE))
+        self.assertEqual(stored.etag,
+                         '"%s-3"' % hashlib.md5(digests).hexdigest())
+        self.assertEqual(self.server.uploads, {})
+
+    def test_small_files_are_uploaded_whole(self):
+        self.storage.save('img/logo.png', ContentFile(b'logo'))
+        self.assertEqual(self.parts, [])
+        self.assertEqual(self.stored('img/logo.png').etag,
+                         '"%s"' % hashlib.md5(b'logo').hexdigest())
+
+    @override_settings(AWS_MULTIPART_THRESHOLD=None)
+    def test_multipart_uploads_can_be_turned_off(self):
+        DummyS3StaticStorage().save('video/intro.webm', ContentFile(DATA))
+        self.assertEqual(self.parts, [])
+        self.assertEqual(self.stored('video/intro.webm').data, DATA)
+
+    def test_failed_parts_are_retried_on_their_own(self):
+        record_part = self.upload_part.side_effect
+
+        def fail_once(upload, fp, part_num, *args, **kwargs):
+            if part_num == 2 and (2, None) not in self.parts:
+                self.parts.append((2, None))
+                raise BotoServerError(500, 'Internal Server Error')
+            return record_part(upload, fp, part_num, *args, **kwargs)
+        self.upload_part.side_effect = fail_once
+        with self.assertLogs(level='WARNING'):
+            self.storage.save('video/intro.webm', ContentFile(DATA))
+        self.assertEqual(
+            sorted(part_num for part_num, _size in self.parts), [1, 2, 2, 3])
+        self.assertEqual(self.storage.throttle.stats['retries'], 1)
+        self.assertEqual(self.stored('video/intro.webm').data, DATA)
+
+    def test_upload_is_cancelled_when_a_part_fails(self):
+        record_part = self.upload_part.side_effect
+
+        def fail(upload, fp, part_num, *args, **kwargs):
+            if part_num == 2:
+                raise ValueError('bad part')
+            return record_part(upload, fp, part_num, *args, **kwargs)
+        self.upload_part.side_effect = fail
+        with self.assertRaises(ValueError):
+            self.storage.save('video/intro.webm', ContentFile(DATA))
+        self.assertIsNone(self.stored('video/intro.webm'))
+        self.assertEqual(self.server.uploads, {})
@@ -0,0 +1,232 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, override_settings
+from django.utils import six
+
+from deploy_utils.deployer import PackageQueue, StaticDeployer, StaticFile
+from deploy_utils.file_utils import post_process_static_files
+from deploy_utils.storage import DummyPipelineStorage
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+PACKAGES = {
+    'STYLESHEETS': {
+        'site': {
+            'source_filenames': ['css/base.css', 'css/shared.css'],
+            'output_filename': 'css/site.css',
+        },
+    },
+    'JAVASCRIPT': {
+        'app': {
+            'source_filenames': ['js/app/*.js'],
+            'output_filename': 'js/app.js',
+        },
+        'vendor': {
+            'source_filenames': ['js/vendor.js'],
+            'output_filename': 'js/vendor.min.js',
+        },
+    },
+}
+
+SOURCES = {
+    'css/base.css': b'body { margin: 0; }',
+    'css/shared.css': b'.shared { color: red; }',
+    'js/app/one.js': b'var one = 1;',
+    'js/app/two.js': b'var two = 2;',
+    'js/vendor.js': b'var vendor = true;',
+}
+
+
+class PipelineStorageTestCase(SimpleTestCase):
+    """
+    A DummyPipelineStorage deploying ``SOURCES`` (from a static files
+    directory) to an empty STATIC_ROOT, with the pipeline packages in
+    ``PACKAGES``.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.source_root = os.path.join(self.root, 'static')
+        self.static_root = os.path.join(self.root, 'collected')
+        for rel_path, content in SOURCES.items():
+            path = os.path.join(self.source_root, rel_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fp:
+                fp.write(content)
+        pipeline = dict(PACKAGES, PIPELINE_ENABLED=True, CSS_COMPRESSOR=None,
+                        JS_COMPRESSOR=None, DISABLE_WRAPPER=True)
+        settings = override_settings(
+            STATICFILES_DIRS=[self.source_root],
+            STATICFILES_FINDERS=[
+                'django.contrib.staticfiles.finders.FileSystemFinder'],
+            STATIC_ROOT=self.static_root, PIPELINE=pipeline,
+            STATICFILES_STORAGE='pipeline.storage.PipelineStorage')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # Pipeline expands globs in the (already collected) static files
+        patcher = mock.patch('pipeline.glob.staticfiles_storage',
+                             FileSystemStorage(location=self.source_root))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = DummyPipelineStorage()
+        # Packed from the files being deployed, as deploystatic does
+        self.storage.local_files = dict(
+            (rel_path, os.path.join(self.source_root, rel_path))
+            for rel_path in SOURCES)
+        self.packed = []
+        pack_package = self.storage.pack_package
+
+        def record_pack(kind, package):
+            self.packed.append(package.output_filename)
+            return pack_package(kind, package)
+        self.storage.pack_package = record_pack
+
+    def paths(self, *rel_paths):
+        return [(os.path.join(self.source_root, rel_path), rel_path)
+                for rel_path in rel_paths]
+
+    def read(self, rel_path):
+        with open(os.path.join(self.static_root, rel_path), 'rb') as fp:
+            return fp.read()
+
+
+class PackageIndexTest(PipelineStorageTestCase):
+
+    def test_index_expands_globs(self):
+        index = self.storage.get_package_index()
+        self.assertEqual(
+            sorted(package.output_filename
+                   for kind, package in index['js/app/two.js']),
+            ['js/app.js'])
+        self.assertEqual(sorted(index), sorted(SOURCES))
+        self.assertIs(self.storage.get_package_index(), index)
+
+    def test_packages_for_lists_each_package_once(self):
+        packages = self.storage.packages_for(
+            ['css/base.css', 'css/shared.css', 'js/app/one.js',
+             'img/logo.png'])
+        self.assertEqual(list(packages), ['css/site.css', 'js/app.js'])
+        self.assertEqual(packages['css/site.css'][0], 'css')
+
+    def test_post_process_packs_each_affected_package_once(self):
+        hashed_names = post_process_static_files(
+            self.paths('css/base.css', 'css/shared.css', 'js/app/one.js',
+                       'js/app/two.js'), static_storage=self.storage)
+        self.assertEqual(sorted(self.packed), ['css/site.css', 'js/app.js'])
+        self.assertEqual(sorted(hashed_names), ['css/site.css', 'js/app.js'])
+        self.assertEqual(self.read('js/app.js'),
+                         b'var one = 1;\n;var two = 2;')
+        self.assertFalse(self.storage.exists('js/vendor.min.js'))
+
+    def test_packed_and_extra_packages(self):
+        post_process_static_files(
+            self.paths('css/base.css'), static_storage=self.storage,
+            packed=['css/site.css'], packages=['js/vendor.min.js'])
+        # Already packed by the caller, but still reported
+        self.assertEqual(self.packed, ['js/vendor.min.js'])
+
+
+class PackPackagesTest(PipelineStorageTestCase):
+
+    def packages(self):
+        packages = self.storage.packages_for(SOURCES)
+        return [packages[output_file] for output_file in sorted(packages)]
+
+    @override_settings(DEPLOY_PACK_WORKERS=2)
+    def test_packages_are_packed_on_the_workers(self):
+        self.assertEqual(self.storage.get_pack_workers(), 2)
+        lock = threading.Lock()
+        running = []
+        most_running = []
+
+        def slow_pack(kind, package):
+            with lock:
+                running.append(package.output_filename)
+                most_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(package.output_filename)
+            self.packed.append(package.output_filename)
+        self.storage.pack_package = slow_pack
+        self.storage.pack_packages(self.packages())
+        self.assertEqual(sorted(self.packed),
+                         ['css/site.css', 'js/app.js', 'js/vendor.min.js'])
+        self.assertEqual(max(most_running), 2)
+
+    @override_settings(DEPLOY_PACK_WORKERS=None)
+    def test_workers_default_to_the_cpus(self):
+        with mock.patch('deploy_utils.pipelinestorage.cpu_count',
+                        return_value=6):
+            self.assertEqual(self.storage.get_pack_workers(), 6)
+
+    @override_settings(DEPLOY_PACK_WORKERS=3)
+    def test_first_error_is_raised_once_the_rest_are_packed(self):
+        def failing_pack(kind, package):
+            if package.output_filename != 'js/vendor.min.js':
+                raise ValueError(package.output_filename)
+            time.sleep(0.05)
+            self.packed.append(package.output_filename)
+        self.storage.pack_package = failing_pack
+        with self.assertRaises(ValueError) as cm:
+            self.storage.pack_packages(self.packages())
+        self.assertEqual(cm.exception.args, ('css/site.css',))
+        self.assertEqual(self.packed, ['js/vendor.min.js'])
+
+
+class PackageQueueTest(PipelineStorageTestCase):
+
+    def setUp(self):
+        super(PackageQueueTest, self).setUp()
+        self.stdout = six.StringIO()
+        self.queue = PackageQueue(StaticDeployer(self.stdout), self.storage,
+                                  queue_size=4)
+
+    def static_file(self, rel_path):
+        return StaticFile(os.path.join(self.source_root, rel_path), rel_path,
+                          True)
+
+    def test_packages_wait_for_all_their_changed_files(self):
+        one, two = (self.static_file('js/app/one.js'),
+                    self.static_file('js/app/two.js'))
+        self.queue.track([one, two, self.static_file('js/vendor.js')])
+        self.queue.done(one, copied=True)
+        self.assertEqual(self.queue.queued, set())
+        # Unchanged, so there's nothing to pack
+        self.queue.done(self.static_file('js/vendor.js'), copied=False)
+        self.queue.done(two, copied=False)
+        self.assertEqual(self.queue.queued, set(['js/app.js']))
+
+    def test_failed_packages_are_packed_in_post_processing(self):
+        pack_package = self.storage.pack_package
+
+        def fail_once(kind, package):
+            self.storage.pack_package = pack_package
+            raise ValueError('out of memory')
+        self.storage.pack_package = fail_once
+        static_files = [self.static_file('js/app/one.js'),
+                        self.static_file('js/app/two.js')]
+        self.queue.start()
+        self.queue.track(static_files)
+        for static_file in static_files:
+            self.queue.done(static_file, copied=True)
+        packed = self.queue.finish()
+        self.assertEqual(packed, set())
+        self.assertIn('failed to pack js/app.js, will retry: out of memory',
+                      self.stdout.getvalue())
+
+        post_process_static_files(self.paths('js/app/one.js'),
+                                  static_storage=self.storage, packed=packed)
+        self.assertEqual(self.packed, ['js/app.js'])
+        self.assertEqual(self.read('js/app.js'),
+                         b'var one = 1;\n;var two = 2;')
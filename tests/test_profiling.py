@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from deploy_utils.profiling import DeployProfiler, merge_reports
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class DeployProfilerTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('time.time', return_value=1000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.profiler = DeployProfiler()
+
+    def tick(self, seconds):
+        self.time.return_value += seconds
+
+    def profile(self):
+        with self.profiler.phase('upload'):
+            with self.profiler.timer('upload', 'img/a.png', size=2048):
+                self.tick(2)
+            self.profiler.record('read', 'img/a.png', 0.5)
+            self.profiler.record('upload', 'css/site.css', 1, size=1024)
+            self.profiler.record('upload', 'css/site.css', 0.5, size=1024)
+        with self.profiler.phase('post_process'):
+            self.tick(1)
+        self.profiler.record_package('js/app.js', 0.25)
+        self.profiler.record_package('css/site.css', 0.75)
+        self.profiler.finish()
+
+    def test_timings(self):
+        self.profile()
+        self.assertEqual(dict(self.profiler.phases),
+                         {'upload': 2, 'post_process': 1})
+        self.assertEqual(self.profiler.bytes_sent, 4096)
+        self.assertEqual(self.profiler.stage_totals(), {
+            'upload': {'count': 2, 'total': 3.5, 'max': 2},
+            'read': {'count': 1, 'total': 0.5, 'max': 0.5}})
+        self.assertEqual(
+            [(path, seconds) for path, seconds, _timings
+             in self.profiler.slowest_files()],
+            [('img/a.png', 2.5), ('css/site.css', 1.5)])
+        self.assertEqual(self.profiler.slowest_files(1)[0][2],
+                         {'upload': 2, 'read': 0.5, 'bytes': 2048})
+        self.assertEqual(self.profiler.slowest_packages(),
+                         [('css/site.css', 0.75), ('js/app.js', 0.25)])
+
+    def test_report(self):
+        self.profile()
+        self.profiler.extra['failed'] = ['img/b.png']
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'report.json')
+        self.profiler.save(path)
+        with open(path) as fp:
+            report = json.load(fp)
+        self.assertEqual(report['duration'], 3)
+        self.assertEqual(report['bytes_sent'], 4096)
+        self.assertEqual(report['files'][0], {
+            'path': 'img/a.png', 'seconds': 2.5, 'bytes': 2048,
+            'read': 0.5, 'upload': 2})
+        self.assertEqual(report['packages'][0],
+                         {'output': 'css/site.css', 'seconds': 0.75})
+        self.assertEqual(report['failed'], ['img/b.png'])
+
+    def test_summary(self):
+        self.profile()
+        lines = self.profiler.summary(limit=1)
+        self.assertEqual(lines[0], 'Deploy took 3.00s')
+        self.assertIn('4096 bytes sent (1.3 KB/s)', lines)
+        self.assertEqual(lines[-4:], [
+            'Slowest files:', '     2.500  img/a.png',
+            'Slowest packages:', '     0.750  css/site.css'])
+
+    def test_merged_shard_reports(self):
+        self.profile()
+        first = self.profiler.report()
+        first['shard'] = '1/2'
+        second = DeployProfiler()
+        second.record('upload', 'img/c.png', 5, size=10)
+        self.tick(5)
+        second.finish()
+        second = second.report()
+        second.update(shard='2/2', failed=['img/c.png'])
+        merged = merge_reports([first, second])
+        # Side by side, so as long as the last one to finish
+        self.assertEqual((merged['started'], merged['duration']),
+                         (1000, 8))
+        self.assertEqual(merged['bytes_sent'], 4106)
+        self.assertEqual(merged['stages']['upload'],
+                         {'count': 3, 'total': 8.5, 'max': 5})
+        self.assertEqual([timings['path'] for timings in merged['files']],
+                         ['img/c.png', 'img/a.png', 'css/site.css'])
+        self.assertEqual(merged['failed'], ['img/c.png'])
+        self.assertEqual([shard['shard'] for shard in merged['shards']],
+                         ['1/2', '2/2'])
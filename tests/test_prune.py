@@ -0,0 +1,83 @@
+from django.test import SimpleTestCase
+
+from deploy_utils.inventory import InventoryEntry
+from deploy_utils.manifest import DeployManifest
+from deploy_utils.prune import find_stale_keys, parse_hashed_name
+
+
+def entry(last_modified, size=1):
+    return InventoryEntry('"etag"', size, last_modified)
+
+
+class ParseHashedNameTest(SimpleTestCase):
+
+    def test_hashed_copies(self):
+        originals = ('css/site.css', 'LICENSE')
+        self.assertEqual(parse_hashed_name('css/site.0123456789ab.css',
+                                           originals),
+                         ('css/site.css', '0123456789ab'))
+        self.assertEqual(parse_hashed_name('LICENSE.0123456789ab',
+                                           originals),
+                         ('LICENSE', '0123456789ab'))
+
+    def test_precompressed_variants(self):
+        self.assertEqual(parse_hashed_name('css/site.0123456789ab.css.gz',
+                                           ('css/site.css',)),
+                         ('css/site.css', '0123456789ab'))
+
+    def test_not_hashed_copies(self):
+        originals = ('css/site.css',)
+        for name in ('css/site.css', 'css/site.0123.css',
+                     'css/site.0123456789AB.css',
+                     'css/other.0123456789ab.css'):
+            self.assertIsNone(parse_hashed_name(name, originals))
+
+
+class FindStaleKeysTest(SimpleTestCase):
+
+    def test_keeps_generations_and_current(self):
+        manifest = DeployManifest()
+        manifest.record('site.css', hashed_name='site.000000000000.css')
+        entries = {
+            'static/site.css': entry('2016-01-05'),
+            'static/site.000000000000.css': entry('2016-01-01'),
+            'static/site.000000000000.css.gz': entry('2016-01-01'),
+            'static/site.111111111111.css': entry('2016-01-02', 5),
+            'static/site.111111111111.css.br': entry('2016-01-02', 2),
+            'static/site.222222222222.css': entry('2016-01-03'),
+            'static/site.333333333333.css': entry('2016-01-04'),
+            # Not in the manifest
+            'static/other.444444444444.css': entry('2016-01-01'),
+            # Outside the location
+            'elsewhere/site.555555555555.css': entry('2016-01-01'),
+        }
+        stale = find_stale_keys(manifest, entries, keep=2,
+                                location='/static/')
+        self.assertEqual(sorted(stale), [
+            ('static/site.111111111111.css', 5, 'site.css'),
+            ('static/site.111111111111.css.br', 2, 'site.css'),
+        ])
+
+    def test_nothing_stale(self):
+        manifest = DeployManifest()
+        manifest.record('site.css', hashed_name='site.000000000000.css')
+        entries = {'site.000000000000.css': entry('2016-01-01')}
+        self.assertEqual(find_stale_keys(manifest, entries, keep=0), [])
+
+    def test_keys_without_a_modification_time_are_kept(self):
+        manifest = DeployManifest()
+        manifest.record('site.css', hashed_name='site.333333333333.css')
+        entries = {
+            # Recorded by a save, not listed
+            'site.000000000000.css': entry(None),
+            'site.111111111111.css': entry('2016-01-02'),
+            'site.111111111111.css.gz': entry(None),
+            'site.222222222222.css': entry('2016-01-03'),
+            'site.333333333333.css': entry('2016-01-04'),
+            'site.444444444444.css': entry('2016-01-01'),
+        }
+        stale = find_stale_keys(manifest, entries, keep=2)
+        self.assertEqual(sorted(stale), [
+            ('site.222222222222.css', 1, 'site.css'),
+            ('site.444444444444.css', 1, 'site.css'),
+        ])
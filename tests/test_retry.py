@@ -0,0 +1,96 @@
+import gzip
+import io
+import threading
+
+from boto.exception import BotoServerError
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.devtools.fakes3 import FakeS3Server, FaultInjector
+from deploy_utils.storage import DummyS3StaticStorage, S3StaticStorage
+
+
+@override_settings(PROXY_S3=True, AWS_STATIC_BUCKET_NAME='static',
+                   AWS_RETRIES=5, AWS_RETRY_BASE_DELAY=0.001,
+                   AWS_RETRY_MAX_DELAY=0.01, AWS_MAX_CONCURRENCY=8)
+class RetryMixinTest(SimpleTestCase):
+    """
+    The deploy storage against fakes3, injecting faults into its requests.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(RetryMixinTest, cls).setUpClass()
+        cls.server = FakeS3Server().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super(RetryMixinTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.buckets.clear()
+        self.server.buckets['static'] = {}
+        self.server.faults = None
+        self.storage = DummyS3StaticStorage()
+        # Connect before faults are injected
+        self.storage.bucket
+
+    def stored(self, name):
+        return self.server.buckets['static'][name].data
+
+    def test_only_the_deploy_storage_retries(self):
+        self.assertIsNotNone(self.storage.throttle)
+        self.assertFalse(hasattr(S3StaticStorage(), 'throttle'))
+
+    def test_retries_until_it_succeeds(self):
+        self.server.faults = FaultInjector(slowdown_rate=0.1, error_rate=0.1,
+                                           seed=1)
+        with self.assertLogs(level='WARNING'):
+            for i in range(10):
+                self.storage.save('img/%d.png' % i,
+                                  ContentFile(b'image %d' % i))
+        for i in range(10):
+            self.assertEqual(self.stored('img/%d.png' % i), b'image %d' % i)
+        stats = self.storage.throttle.stats
+        self.assertGreater(stats['retries'], 0)
+        self.assertGreater(stats['throttled'], 0)
+        self.assertEqual(stats['failed'], 0)
+
+    def test_retried_saves_are_gzipped_once(self):
+        self.storage.gzip = True
+        self.server.faults = FaultInjector(error_rate=0.2, seed=2)
+        data = b'body { color: red; }' * 50
+        with self.assertLogs(level='WARNING'):
+            for i in range(10):
+                self.storage.save('css/%d.css' % i, ContentFile(data))
+        self.assertGreater(self.storage.throttle.stats['retries'], 0)
+        for i in range(10):
+            with gzip.GzipFile(fileobj=io.BytesIO(
+                    self.stored('css/%d.css' % i))) as fp:
+                self.assertEqual(fp.read(), data)
+
+    def test_gives_up(self):
+        self.server.faults = FaultInjector(error_rate=1)
+        with self.assertLogs(level='WARNING') as logs, \
+                self.assertRaises(BotoServerError):
+            self.storage.save('img/a.png', ContentFile(b'image'))
+        self.assertEqual(len(logs.records), 5)
+        stats = self.storage.throttle.stats
+        self.assertEqual((stats['requests'], stats['failed']), (6, 1))
+        self.assertNotIn('img/a.png', self.server.buckets['static'])
+
+    def test_backs_off_while_throttled(self):
+        # S3 only takes one request at a time
+        self.server.faults = FaultInjector(max_concurrency=1, latency=0.01)
+        threads = [threading.Thread(target=self.storage.save, args=(
+            'img/%d.png' % i, ContentFile(b'image'))) for i in range(16)]
+        with self.assertLogs(level='WARNING'):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.server.buckets['static']), 16)
+        limiter = self.storage.throttle.limiter
+        self.assertGreater(self.storage.throttle.stats['throttled'], 0)
+        self.assertLess(limiter.lowest, limiter.maximum)
@@ -0,0 +1,170 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from django.utils.six import StringIO
+
+from deploy_utils.devtools.benchmark import BENCHMARK_BUCKET, \
+    DeployBenchmark, StaticTreeGenerator
+from deploy_utils.devtools.fakes3 import FakeS3Server
+from deploy_utils.file_utils import get_static_storage, \
+    reset_static_storage
+from deploy_utils.manifest import DeployManifest
+from deploy_utils.sharding import all_shards
+
+
+MANIFEST_NAME = 'deploy-manifest.json'
+SHARDS = 3
+STALE_SOURCE = b'/* deployed before */'
+
+# Runs one shard of the deploy in a process of its own, as on a CI runner
+SHARD_SCRIPT = '''
+import json, sys
+import django
+from django.conf import settings
+from django.core.management import call_command
+options = json.loads(sys.argv[1])
+settings.configure(**options.pop('settings'))
+django.setup()
+call_command('deploystatic', **options)
+'''
+
+
+class ShardedDeployTest(SimpleTestCase):
+    """
+    Deploy a tree in ``SHARDS`` processes against fakes3, and check every
+    file and package is deployed by exactly one of them.
+
+    The shards run one after another, so each one packs packages whose
+    sources later shards haven't uploaded yet, and the bucket starts off
+    with stale copies of every source, which no package may be packed from.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        generator = StaticTreeGenerator(os.path.join(self.root, 'static'),
+                                        scale=0.1, seed=1)
+        generator.generate('small')
+        generator.generate('bundles')
+        self.files = generator.files
+        self.packages = generator.packages
+        self.outputs = [package['output_filename']
+                        for packages in generator.packages.values()
+                        for package in packages.values()]
+
+        self.settings = DeployBenchmark(None).get_settings(
+            self.root, generator.packages)
+        self.settings.update(
+            DEPLOY_MANIFEST_NAME=MANIFEST_NAME,
+            DEPLOY_MANIFEST_PATH=os.path.join(self.root, 'manifest.json'),
+            DEPLOY_JOURNAL_PATH=None)
+
+        self.server = FakeS3Server().start()
+        self.addCleanup(self.server.stop)
+        self.server.buckets[BENCHMARK_BUCKET] = {}
+        sources = [source for packages in generator.packages.values()
+                        for package in packages.values()
+                        for source in package['source_filenames']]
+        for source in sources:
+            self.server.store(self.server.buckets[BENCHMARK_BUCKET], source,
+                              STALE_SOURCE, {})
+        self.stored = Counter()
+        store = self.server.store
+        lock = threading.Lock()
+
+        def count_store(bucket, key_name, *args, **kwargs):
+            with lock:
+                self.stored[key_name] += 1
+            return store(bucket, key_name, *args, **kwargs)
+        self.server.store = count_store
+
+    def deploy_shards(self):
+        shard_settings = dict(
+            (name, getattr(settings, name)) for name in (
+                'SECRET_KEY', 'INSTALLED_APPS', 'STATIC_URL',
+                'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'))
+        shard_settings.update(self.settings)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        for shard in all_shards(SHARDS):
+            options = {
+                'settings': shard_settings,
+                'path': self.root,
+                'interactive': False,
+                'workers': 2,
+                'shard': str(shard),
+                'filelist': [os.path.join('static', rel_path)
+                             for rel_path in self.files],
+            }
+            process = subprocess.Popen(
+                [sys.executable, '-c', SHARD_SCRIPT, json.dumps(options)],
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _output, errors = process.communicate()
+            self.assertEqual(process.returncode, 0, errors.decode('utf-8'))
+
+    def test_every_file_and_package_is_deployed_by_one_shard(self):
+        self.deploy_shards()
+
+        # Only the copy of the manifest in storage is used
+        self.assertFalse(os.path.exists(self.settings['DEPLOY_MANIFEST_PATH']))
+        with override_settings(**self.settings):
+            reset_static_storage()
+            self.addCleanup(reset_static_storage)
+            storage = get_static_storage()
+            handled = Counter()
+            for shard in all_shards(SHARDS):
+                names = DeployManifest.load(storage, shard.suffix,
+                                            local=False).files
+                self.assertTrue(all(shard.owns(name) for name in names))
+                handled.update(list(names))
+            self.assertEqual(set(handled), set(self.files + self.outputs))
+            self.assertEqual(set(handled.values()), set([1]))
+
+            # Every package was packed from the sources being deployed
+            bucket = self.server.buckets[BENCHMARK_BUCKET]
+            for packages in self.packages.values():
+                for package in packages.values():
+                    output = bucket[package['output_filename']].data
+                    self.assertNotIn(STALE_SOURCE, output)
+                    for source in package['source_filenames']:
+                        with open(os.path.join(self.root, 'static', source),
+                                  'rb') as fp:
+                            self.assertIn(fp.read(), output)
+
+            # Nothing was uploaded twice, hashed copies included
+            self.assertEqual(
+                [name for name, count in self.stored.items() if count > 1],
+                [])
+            for name in self.files + self.outputs:
+                self.assertEqual(self.stored[name], 1, name)
+
+            call_command('mergedeployshards', shards=SHARDS,
+                         stdout=StringIO())
+            manifest = DeployManifest.load(storage, local=False)
+            self.assertEqual(set(manifest.files),
+                             set(self.files + self.outputs))
+            self.assertEqual(set(manifest.hashed_names()),
+                             set(self.files + self.outputs))
+            for shard in all_shards(SHARDS):
+                self.assertFalse(DeployManifest.exists(storage, shard.suffix,
+                                                       local=False))
+        self.assertFalse(os.path.exists(self.settings['DEPLOY_MANIFEST_PATH']))
+
+    def test_shards_need_a_manifest_in_storage(self):
+        self.settings['DEPLOY_MANIFEST_NAME'] = None
+        with override_settings(**self.settings):
+            with self.assertRaisesMessage(Exception, 'DEPLOY_MANIFEST_NAME'):
+                call_command('deploystatic', path=self.root,
+                             interactive=False, shard='1/2', filelist=[],
+                             stdout=StringIO())
+            with self.assertRaisesMessage(Exception, 'DEPLOY_MANIFEST_NAME'):
+                call_command('mergedeployshards', shards=2,
+                             stdout=StringIO())
@@ -0,0 +1,37 @@
+from django.test import SimpleTestCase
+
+from deploy_utils.sharding import Shard, all_shards, shard_index
+
+
+class ShardTest(SimpleTestCase):
+
+    def test_parse(self):
+        shard = Shard.parse(' 2 / 4 ')
+        self.assertEqual((shard.index, shard.count), (2, 4))
+        self.assertEqual(str(shard), '2/4')
+        for value in ('', '2', '0/4', '5/4', '1/0', 'a/b'):
+            with self.assertRaises(ValueError):
+                Shard.parse(value)
+
+    def test_path(self):
+        shard = Shard(1, 3)
+        self.assertEqual(shard.path('report.json'), 'report.json.1-of-3')
+        self.assertIsNone(shard.path(None))
+
+    def test_index_is_stable(self):
+        # md5 based, so the same in every process
+        self.assertEqual(shard_index('css/site.css', 4),
+                         shard_index(b'css/site.css', 4))
+        self.assertEqual(shard_index('css\\site.css', 4),
+                         shard_index('css/site.css', 4))
+        self.assertEqual(shard_index('css/site.css', 1), 1)
+
+    def test_every_name_has_exactly_one_shard(self):
+        names = ['img/%d.png' % i for i in range(200)]
+        shards = all_shards(3)
+        owned = [[shard for shard in shards if shard.owns(name)]
+                 for name in names]
+        self.assertTrue(all(len(owners) == 1 for owners in owned))
+        # And the names are spread between them
+        self.assertEqual(set(owners[0].index for owners in owned),
+                         set([1, 2, 3]))
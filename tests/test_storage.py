@@ -0,0 +1,252 @@
+import errno
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.contrib.staticfiles.utils import matches_patterns
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.test import SimpleTestCase, override_settings
+
+from deploy_utils.management.commands.deploystatic import \
+    get_static_file_path
+from deploy_utils.storage import FileSystemFinder, \
+    OverwriteFilesystemStorage, StaticPathIndex, compile_patterns, get_files
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+HEAVY_PACKAGES = ('boto', 'storages', 'pipeline')
+
+# Imports the storage module in a fresh interpreter and reports which of the
+# S3 and pipeline packages came with it
+IMPORT_SCRIPT = '''
+import json, sys
+import django
+from django.conf import settings
+settings.configure(**json.loads(sys.argv[1]))
+django.setup()
+before = set(sys.modules)
+import deploy_utils.storage as storage
+from deploy_utils.storage import OverwriteFilesystemStorage, DummyStorage
+imported = set(name.split('.')[0] for name in set(sys.modules) - before)
+result = {'heavy': sorted(imported.intersection(sys.argv[2].split(','))),
+          'dir': 'S3StaticStorage' in dir(storage), 'name': storage.__name__}
+if sys.argv[3]:
+    result['module'] = getattr(storage, sys.argv[3]).__module__
+print(json.dumps(result))
+'''
+
+
+class LazyStorageImportTest(SimpleTestCase):
+    """
+    The S3 and pipeline storages are only imported from
+    ``deploy_utils.storage`` once they are used, on every supported Python.
+    """
+
+    def run_script(self, attribute=''):
+        script_settings = dict(
+            (name, getattr(settings, name)) for name in (
+                'SECRET_KEY', 'INSTALLED_APPS', 'STATIC_URL'))
+        script_settings['PIPELINE'] = {}
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen(
+            [sys.executable, '-c', IMPORT_SCRIPT,
+             json.dumps(script_settings), ','.join(HEAVY_PACKAGES),
+             attribute],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        self.assertEqual(process.returncode, 0, errors.decode('utf-8'))
+        return json.loads(output.decode('utf-8'))
+
+    def test_s3_and_pipeline_are_not_imported_up_front(self):
+        result = self.run_script()
+        self.assertEqual(result['heavy'], [])
+        self.assertTrue(result['dir'])
+        self.assertEqual(result['name'], 'deploy_utils.storage')
+
+    def test_lazy_attributes_are_imported_on_use(self):
+        self.assertEqual(self.run_script('S3MediaStorage')['module'],
+                         'deploy_utils.s3storage')
+        self.assertEqual(self.run_script('DummyPipelineStorage')['module'],
+                         'deploy_utils.pipelinestorage')
+        with self.assertRaises(AssertionError) as error:
+            self.run_script('NoSuchStorage')
+        self.assertIn('NoSuchStorage', str(error.exception))
+
+
+class StaticPathIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.static = os.path.join(self.root, 'static')
+        self.vendor = os.path.join(self.root, 'vendor', 'dist')
+        for directory in (self.static, self.vendor):
+            os.makedirs(directory)
+        settings = override_settings(STATICFILES_DIRS=[
+            self.static, ('lib', self.vendor)])
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.index = StaticPathIndex([FileSystemFinder()])
+
+    def find(self, *parts):
+        return self.index.find(os.path.join(self.root, *parts))
+
+    def test_files_are_found_relative_to_their_root(self):
+        rel_path, storage = self.find('static', 'img', 'icons', 'arrow.png')
+        self.assertEqual(rel_path, 'img/icons/arrow.png')
+        self.assertEqual(storage.location, self.static)
+        # Prefixed roots add their prefix
+        rel_path, storage = self.find('vendor', 'dist', 'jquery.js')
+        self.assertEqual(rel_path, 'lib/jquery.js')
+        self.assertEqual(storage.prefix, 'lib')
+
+    def test_only_whole_directories_match(self):
+        for parts in (('static-old', 'a.css'), ('vendor', 'jquery.js'),
+                      ('static',), ('README',)):
+            self.assertEqual(self.find(*parts), (None, None))
+
+    def test_paths_are_normalised(self):
+        self.assertEqual(
+            self.find('vendor', '..', 'static', '.', 'css', 'a.css')[0],
+            'css/a.css')
+
+    def test_get_static_file_path(self):
+        self.assertEqual(
+            get_static_file_path(os.path.join(self.static, 'css', 'a.css'),
+                                 self.index), 'css/a.css')
+        self.assertIsNone(get_static_file_path(
+            os.path.join(self.root, 'manage.py'), self.index))
+        # Without an index, one is built from the configured finders
+        with override_settings(STATICFILES_FINDERS=[
+                'deploy_utils.storage.FileSystemFinder']):
+            self.assertEqual(get_static_file_path(
+                os.path.join(self.vendor, 'jquery.js')), 'lib/jquery.js')
+
+
+class ListingStorage(Storage):
+    """
+    A storage that can only list ``location``, so ``get_files`` walks it
+    with ``listdir``.
+    """
+    def __init__(self, location):
+        self.local = FileSystemStorage(location=location)
+
+    def listdir(self, path):
+        return self.local.listdir(path)
+
+
+class GetFilesTest(SimpleTestCase):
+
+    FILES = ('robots.txt', '.DS_Store', 'css/site.css', 'css/site.css.map',
+             'css/CVS/Entries', 'img/logo.png', 'img/venues/a.png',
+             'img/venues/seatmaps/b.png', 'js/lib/jquery.js')
+    IGNORE = ['CVS', '.*', '*.map', 'img/venues/seatmaps']
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for rel_path in self.FILES:
+            path = os.path.join(self.root, rel_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def test_ignored_files_and_directories_are_skipped(self):
+        files = list(get_files(FileSystemStorage(location=self.root),
+                               self.IGNORE))
+        self.assertEqual(sorted(files), [
+            'css/site.css', 'img/logo.png', 'img/venues/a.png',
+            'js/lib/jquery.js', 'robots.txt'])
+
+    def test_local_walk_matches_listdir(self):
+        for ignore_patterns in (self.IGNORE, None, []):
+            self.assertEqual(
+                list(get_files(FileSystemStorage(location=self.root),
+                               ignore_patterns)),
+                list(get_files(ListingStorage(self.root), ignore_patterns)))
+        self.assertEqual(
+            list(get_files(FileSystemStorage(location=self.root),
+                           self.IGNORE, location='img')),
+            list(get_files(ListingStorage(self.root), self.IGNORE,
+                           location='img')))
+
+    def test_compiled_patterns_match_like_matches_patterns(self):
+        patterns = ['*.map', 'CVS', 'img/venues/*', '[._]*']
+        regex = compile_patterns(patterns)
+        self.assertIs(compile_patterns(list(patterns)), regex)
+        self.assertIsNone(compile_patterns([]))
+        for name in ('site.css.map', 'site.css.MAP', 'CVS', 'cvs', 'CVS.txt',
+                     'img/venues/a.png', 'img/venues', '.git', '_build',
+                     'a.map.css', 'multi\nline.map'):
+            self.assertEqual(bool(regex.match(name)),
+                             matches_patterns(name, patterns), name)
+
+
+class OverwriteFilesystemStorageTest(SimpleTestCase):
+
+    DATA = b''.join(b'%06d\n' % i for i in range(20000))
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'source.js')
+        with open(self.path, 'wb') as fp:
+            fp.write(self.DATA)
+        self.storage = OverwriteFilesystemStorage(
+            location=os.path.join(self.root, 'static'))
+
+    def save(self, name='js/app.js'):
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(self.storage.save(name, File(fp)), name)
+        with self.storage.open(name) as fp:
+            return fp.read()
+
+    def failing_copy(self, error, after=0):
+        """
+        A kernel copy that copies ``after`` bytes and then fails with
+        ``error``.
+        """
+        def copy(in_fd, out_fd, offset, count):
+            if offset >= after:
+                raise OSError(error, os.strerror(error))
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            data = os.read(in_fd, min(count, after - offset))
+            return os.write(out_fd, data)
+        return copy
+
+    def test_files_are_overwritten(self):
+        self.storage.save('js/app.js', ContentFile(b'old'))
+        self.assertEqual(self.save(), self.DATA)
+        self.assertEqual(os.listdir(self.storage.path('js')), ['app.js'])
+
+    def test_unsupported_kernel_copies_fall_back(self):
+        for error in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                      errno.EOPNOTSUPP):
+            with mock.patch('deploy_utils.storage.KERNEL_COPIES',
+                            (self.failing_copy(error),)):
+                self.assertEqual(self.save(), self.DATA)
+        # Partly copied, then carried on by the next kind of copy or in
+        # Python
+        with mock.patch('deploy_utils.storage.KERNEL_COPIES', (
+                self.failing_copy(errno.EXDEV, after=1000),
+                self.failing_copy(errno.ENOSYS, after=5000))):
+            self.assertEqual(self.save(), self.DATA)
+
+    def test_other_errors_are_raised(self):
+        for error in (errno.EBADF, errno.EIO, errno.ENOSPC):
+            with mock.patch('deploy_utils.storage.KERNEL_COPIES',
+                            (self.failing_copy(error),)):
+                with self.assertRaises(OSError) as cm:
+                    self.save('js/%d.js' % error)
+            self.assertEqual(cm.exception.errno, error)
+        # Without leaving temporary files behind
+        self.assertEqual(os.listdir(self.storage.path('js')), [])
@@ -0,0 +1,105 @@
+import errno
+import socket
+
+from boto.exception import BotoServerError, S3ResponseError
+from django.test import SimpleTestCase
+
+from deploy_utils.throttle import AdaptiveLimiter, ThrottleController, \
+    is_retryable_error, is_throttle_error
+
+
+def slow_down():
+    return BotoServerError(503, 'Slow Down',
+                           '<Error><Code>SlowDown</Code></Error>')
+
+
+class ErrorClassificationTest(SimpleTestCase):
+
+    def test_throttling(self):
+        self.assertTrue(is_throttle_error(slow_down()))
+        self.assertTrue(is_retryable_error(slow_down()))
+        self.assertFalse(is_throttle_error(socket.timeout()))
+
+    def test_retryable(self):
+        self.assertTrue(is_retryable_error(
+            S3ResponseError(500, 'Internal Error')))
+        self.assertTrue(is_retryable_error(socket.timeout()))
+        self.assertTrue(is_retryable_error(
+            socket.error(errno.ECONNRESET, 'reset')))
+
+    def test_not_retryable(self):
+        self.assertFalse(is_retryable_error(
+            S3ResponseError(403, 'Forbidden')))
+        self.assertFalse(is_retryable_error(
+            S3ResponseError(404, 'Not Found')))
+        self.assertFalse(is_retryable_error(
+            IOError(errno.ENOENT, 'missing')))
+        self.assertFalse(is_retryable_error(ValueError()))
+
+
+class AdaptiveLimiterTest(SimpleTestCase):
+
+    def test_aimd(self):
+        limiter = AdaptiveLimiter(8, minimum=2)
+        self.assertEqual(limiter.limit, 8)
+        limiter.throttled()
+        self.assertEqual(limiter.limit, 4)
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual((limiter.limit, limiter.lowest), (2, 2))
+        # One more after a full limit's worth of successes
+        limiter.succeeded()
+        self.assertEqual(limiter.limit, 2)
+        limiter.succeeded()
+        self.assertEqual(limiter.limit, 3)
+        for _i in range(100):
+            limiter.succeeded()
+        self.assertEqual((limiter.limit, limiter.lowest), (8, 2))
+
+
+class ThrottleControllerTest(SimpleTestCase):
+
+    def controller(self, **kwargs):
+        controller = ThrottleController(base_delay=0, **kwargs)
+        controller.delay = lambda attempt: 0
+        return controller
+
+    def test_retries_until_it_succeeds(self):
+        errors = [slow_down(), socket.timeout()]
+
+        def request():
+            if errors:
+                raise errors.pop(0)
+            return 'done'
+        controller = self.controller(max_concurrency=4)
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(controller.call(request), 'done')
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(controller.stats, {
+            'requests': 3, 'retries': 2, 'throttled': 1, 'failed': 0})
+        self.assertEqual(controller.limiter.lowest, 2)
+
+    def test_gives_up(self):
+        def request():
+            raise slow_down()
+        controller = self.controller(retries=2)
+        with self.assertLogs(level='WARNING'), \
+                self.assertRaises(BotoServerError):
+            controller.call(request)
+        self.assertEqual(controller.stats['requests'], 3)
+        self.assertEqual(controller.stats['failed'], 1)
+
+    def test_other_errors_are_not_retried(self):
+        def request():
+            raise ValueError()
+        controller = self.controller()
+        with self.assertRaises(ValueError):
+            controller.call(request)
+        self.assertEqual(controller.stats['requests'], 1)
+
+    def test_nested_calls_pass_through(self):
+        controller = self.controller(max_concurrency=1)
+        self.assertEqual(
+            controller.call(controller.call, lambda: 'inner'), 'inner')
+        self.assertEqual(controller.stats['requests'], 1)
+        self.assertIn('1 requests to storage', controller.report())
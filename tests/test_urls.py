@@ -0,0 +1,180 @@
+from storages.backends.s3boto import S3BotoStorage
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, override_settings
+from django.utils.six.moves.urllib.parse import parse_qs, urlsplit
+
+from deploy_utils.devtools.fakes3 import FakeS3Server, FaultInjector
+from deploy_utils.manifest import DeployManifest
+from deploy_utils.storage import S3MediaStorage, S3StaticStorage
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def query(url):
+    return parse_qs(urlsplit(url).query)
+
+
+@override_settings(AWS_MEDIA_BUCKET_NAME='media', AWS_URL_CACHE_TTL=None,
+                   AWS_URL_CACHE_SIZE=2048, CLOUDFRONT_ENABLED=False)
+class SignedURLCacheTest(SimpleTestCase):
+    """
+    Signed media URLs (expiring after django-storages' default of an hour)
+    are reused within a window and signed again after.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('time.time', return_value=1000000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_urls_are_signed_once_per_window(self):
+        storage = S3MediaStorage()
+        self.assertEqual(storage.url_cache_ttl, 900)
+        url = storage.url('img/a.png')
+        self.assertIn('Signature', query(url))
+        self.time.return_value += 100
+        self.assertIs(storage.url('img/a.png'), url)
+        self.assertEqual(storage.url_cache_stats,
+                         {'hits': 1, 'misses': 1, 'evictions': 0})
+
+        # The next window signs it again, valid for longer
+        self.time.return_value += 900
+        renewed = storage.url('img/a.png')
+        self.assertGreater(int(query(renewed)['Expires'][0]),
+                           int(query(url)['Expires'][0]))
+        self.assertEqual(storage.url_cache_stats['misses'], 2)
+
+    @override_settings(AWS_URL_CACHE_TTL=3000)
+    def test_ttl_is_at_most_half_the_expiry(self):
+        self.assertEqual(S3MediaStorage().url_cache_ttl, 1800)
+
+    @override_settings(AWS_URL_CACHE_SIZE=2)
+    def test_least_recently_used_are_evicted(self):
+        storage = S3MediaStorage()
+        url = storage.url('a.png')
+        storage.url('b.png')
+        storage.url('a.png')
+        storage.url('c.png')
+        self.assertEqual(storage.url_cache_stats['evictions'], 1)
+        self.assertIs(storage.url('a.png'), url)
+        storage.url('b.png')
+        self.assertEqual(storage.url_cache_stats,
+                         {'hits': 2, 'misses': 4, 'evictions': 2})
+
+    def test_extra_arguments_bypass_the_cache(self):
+        storage = S3MediaStorage()
+        url = storage.url('doc.pdf', response_headers={
+            'response-content-disposition': 'attachment'})
+        self.assertEqual(query(url)['response-content-disposition'],
+                         ['attachment'])
+        self.assertNotEqual(storage.url('doc.pdf'), url)
+        self.assertEqual(storage.url_cache_stats['misses'], 1)
+
+    def test_cache_can_be_turned_off(self):
+        for setting in ({'AWS_URL_CACHE_SIZE': 0},
+                        {'AWS_URL_CACHE_TTL': 0}):
+            with override_settings(**setting):
+                storage = S3MediaStorage()
+                self.assertIn('Signature', query(storage.url('img/a.png')))
+                storage.url('img/a.png')
+                self.assertEqual(storage.url_cache_stats,
+                                 {'hits': 0, 'misses': 0, 'evictions': 0})
+
+
+@override_settings(PROXY_S3=True, AWS_STATIC_BUCKET_NAME='static',
+                   CLOUDFRONT_ENABLED=False, DEBUG=False,
+                   DEPLOY_MANIFEST_NAME='deploy-manifest.json',
+                   DEPLOY_MANIFEST_PATH=None, DEPLOY_MANIFEST_TTL=60,
+                   DEPLOY_URL_CACHE_SIZE=2048)
+class ManifestURLTest(SimpleTestCase):
+    """
+    S3StaticStorage URLs from the deploy manifest in fakes3, counting the
+    requests each one takes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(ManifestURLTest, cls).setUpClass()
+        cls.server = FakeS3Server().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super(ManifestURLTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.buckets.clear()
+        self.server.buckets['static'] = {}
+        self.server.faults = FaultInjector()
+        # CachedFilesMixin keeps the hashed names it works out in here
+        cache.clear()
+        patcher = mock.patch('time.time', return_value=1000000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = S3StaticStorage()
+        self.save_manifest({'css/site.css': 'css/site.0123456789ab.css'})
+
+    def save_manifest(self, hashed_names):
+        manifest = DeployManifest()
+        for name, hashed_name in hashed_names.items():
+            manifest.record(name, hashed_name=hashed_name)
+        manifest.save(self.storage, local=False)
+
+    def requests(self):
+        return self.server.faults.stats['requests']
+
+    def test_hashed_names_come_from_the_manifest(self):
+        url = self.storage.url('css/site.css')
+        self.assertIn('/css/site.0123456789ab.css?', url)
+        # Signed as is, without being unquoted like HashedFilesMixin's
+        self.assertEqual(url, S3BotoStorage.url(self.storage,
+                                                'css/site.0123456789ab.css'))
+        requests = self.requests()
+        url = self.storage.url('css/site.css#top')
+        self.assertIn('/css/site.0123456789ab.css?', url)
+        self.assertTrue(url.endswith('#top'))
+        self.assertEqual(self.requests(), requests)
+
+    def test_urls_are_signed_on_every_call(self):
+        url = self.storage.url('css/site.css')
+        self.time.return_value += 7200
+        renewed = self.storage.url('css/site.css')
+        self.assertGreater(int(query(renewed)['Expires'][0]),
+                           self.time.return_value)
+        self.assertGreater(int(query(renewed)['Expires'][0]),
+                           int(query(url)['Expires'][0]))
+
+    def test_names_missing_from_the_manifest(self):
+        self.storage.save('img/logo.png', ContentFile(b'logo'))
+        self.assertIn('/img/logo.96d6f2e7e1f7.png?',
+                      self.storage.url('img/logo.png'))
+        with self.assertRaises(ValueError):
+            self.storage.url('img/missing.png')
+
+        # Worked out once, not on every call
+        cache.clear()
+        requests = self.requests()
+        self.assertIn('/img/logo.96d6f2e7e1f7.png?',
+                      self.storage.url('img/logo.png'))
+        with self.assertRaises(ValueError):
+            self.storage.url('img/missing.png')
+        self.assertEqual(self.requests(), requests)
+
+    def test_new_manifests_are_picked_up(self):
+        with self.assertRaises(ValueError):
+            self.storage.url('img/new.png')
+        self.save_manifest({'css/site.css': 'css/site.ba9876543210.css',
+                            'img/new.png': 'img/new.0123456789ab.png'})
+        # Not until the manifest is next checked
+        self.assertIn('/css/site.0123456789ab.css?',
+                      self.storage.url('css/site.css'))
+        self.time.return_value += 61
+        self.assertIn('/css/site.ba9876543210.css?',
+                      self.storage.url('css/site.css'))
+        self.assertIn('/img/new.0123456789ab.png?',
+                      self.storage.url('img/new.png'))
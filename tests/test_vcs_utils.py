@@ -0,0 +1,145 @@
+import errno
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.core.files.base import File
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+
+from deploy_utils.vcs_utils import ADDED, DELETED, MODIFIED, RENAMED, \
+    _run_git, get_changed_files_git, get_changes_git, \
+    save_with_default_storage
+
+from .test_file_utils import BINARY, ChunkedStorage
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class SaveWithDefaultStorageTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = ChunkedStorage(
+            location=os.path.join(self.root, 'media'))
+        patcher = mock.patch('deploy_utils.vcs_utils.default_storage',
+                             self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_files_are_streamed_in_binary(self):
+        path = os.path.join(self.root, 'upload.png')
+        with open(path, 'wb') as fp:
+            fp.write(BINARY)
+        save_with_default_storage(path, 'uploads/upload.png')
+        self.assertIs(type(self.storage.content), File)
+        self.assertEqual(len(self.storage.chunk_sizes), 10)
+        with self.storage.open('uploads/upload.png') as fp:
+            self.assertEqual(fp.read(), BINARY)
+
+
+class GitChangesTest(SimpleTestCase):
+    """
+    Changes in a scratch git repository, made one commit at a time.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.git('init', '-q')
+        self.commit('Add the site', {'static/css/site.css': 'body {}',
+                                     'static/js/app.js': 'var a;',
+                                     'static/img/logo.svg': '<svg/>' * 50})
+        self.first = self.git('rev-parse', 'HEAD').strip()
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ('git', '-c', 'user.name=Deployer',
+             '-c', 'user.email=deploy@example.com') + args,
+            cwd=self.root).decode('utf-8')
+
+    def write(self, files):
+        for rel_path, content in files.items():
+            path = os.path.join(self.root, rel_path)
+            if content is None:
+                os.remove(path)
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fp:
+                fp.write(content)
+
+    def commit(self, message, files):
+        self.write(files)
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', message)
+
+    def test_single_commit(self):
+        self.commit('Restyle', {'static/css/site.css': 'body { margin: 0 }',
+                                'static/css/print.css': 'body {}',
+                                'static/js/app.js': None})
+        message, changes = get_changes_git('HEAD', self.root)
+        self.assertEqual(message.strip(), 'Restyle')
+        self.assertEqual(dict(changes), {
+            'static/css/print.css': ADDED,
+            'static/css/site.css': MODIFIED,
+            'static/js/app.js': DELETED})
+        self.assertEqual(
+            sorted(get_changed_files_git('HEAD', self.root)[1]),
+            ['static/css/print.css', 'static/css/site.css'])
+
+    def test_ranges_are_diffed_once(self):
+        self.commit('Restyle', {'static/css/site.css': 'body { margin: 0 }'})
+        self.commit('Restyle again', {'static/css/site.css': 'body {}',
+                                      'static/js/app.js': 'var b;'})
+        message, changes = get_changes_git('%s..HEAD' % self.first,
+                                           self.root)
+        self.assertEqual(message.splitlines(), ['Restyle again', 'Restyle'])
+        # Changed and changed back
+        self.assertEqual(dict(changes), {'static/js/app.js': MODIFIED})
+        # An empty end means HEAD
+        self.assertEqual(
+            get_changes_git('%s..' % self.first, self.root)[1], changes)
+
+    def test_renames_are_a_delete_and_an_add(self):
+        self.git('mv', 'static/img/logo.svg', 'static/img/brand.svg')
+        self.git('commit', '-q', '-m', 'Rename the logo')
+        _message, changes = get_changes_git('HEAD', self.root)
+        self.assertEqual(list(changes.items()), [
+            ('static/img/logo.svg', DELETED),
+            ('static/img/brand.svg', RENAMED)])
+        self.assertEqual(get_changed_files_git('HEAD', self.root)[1],
+                         ['static/img/brand.svg'])
+
+    def test_working_tree(self):
+        self.commit('Restyle', {'static/css/site.css': 'body { margin: 0 }'})
+        self.write({'static/js/app.js': 'var b;', 'static/css/site.css': None})
+        message, changes = get_changes_git(path=self.root, working_tree=True)
+        self.assertEqual(message, 'Uncommitted changes against HEAD')
+        self.assertEqual(dict(changes), {'static/css/site.css': DELETED,
+                                         'static/js/app.js': MODIFIED})
+        # Against an earlier commit, the committed changes are included
+        _message, changes = get_changes_git(self.first, self.root,
+                                            working_tree=True)
+        self.assertEqual(dict(changes), {'static/css/site.css': DELETED,
+                                         'static/js/app.js': MODIFIED})
+        with self.assertRaises(CommandError):
+            get_changes_git('%s..HEAD' % self.first, self.root,
+                            working_tree=True)
+
+    def test_errors_are_command_errors(self):
+        with self.assertRaises(CommandError):
+            get_changes_git('no-such-commit', self.root)
+        with self.assertRaises(CommandError):
+            get_changes_git('HEAD', os.path.join(self.root, 'missing'))
+        with mock.patch('subprocess.Popen',
+                        side_effect=OSError(errno.ENOENT, 'not found')):
+            with self.assertRaises(CommandError) as cm:
+                _run_git(self.root, 'status')
+        self.assertIn('neither pygit2 nor the git command line client',
+                      str(cm.exception))